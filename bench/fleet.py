@@ -0,0 +1,260 @@
+### Load test: a simulated agent fleet plus dashboard readers against a seeded database.
+###
+###   python bench/fleet.py [--sizes 10000,100000,1000000] [--agents 200] [--duration 30]
+###                         [--save bench/baseline.json] [--compare bench/baseline.json]
+###
+### For each size the results table is seeded with that many rows (with their
+### full-text index entries) before the server starts, in a scratch directory.
+### During --duration seconds:
+###   agents      register (retrying when shed), check in every --interval
+###               seconds, post a result for each command they receive (every
+###               --large-every-th one above the compression threshold), and
+###               every --transfer-every-th check-in push a file through the
+###               chunked /transfer API
+###   operator    POST /command_all every --broadcast-interval seconds
+###   dashboard   --readers clients cycling through the /api/* listing queries
+### Each request is timed by name; the report holds count, errors, throughput
+### and p50/p99 latency per name. --save writes it as a JSON baseline and
+### --compare exits 1 when a p99 or throughput moved past --tolerance against
+### a stored one, when the stored one was recorded in a different environment,
+### or when it has no numbers for a mode, size or endpoint measured here.
+### Regenerate bench/baseline.json with --save after changing a hot path.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from serving import ROOT, run_server, http, percentile, process_usage
+
+WORDS = ('uid gid root admin users proc kernel eth0 inet mask route dns tcp udp listen established '
+         'bash python systemd cron sshd nginx docker config passwd shadow hosts token session').split()
+
+DASHBOARD_QUERIES = {
+    'api/agents': '/api/agents?page=1&per_page=10',
+    'api/results': '/api/results?page=1&per_page=10',
+    'api/results.cursor': '/api/results?cursor=&per_page=10',
+    'api/results.agent': '/api/results?agent_id={agent_id}&per_page=10',
+    'api/results.search': '/api/results?q={word}&per_page=10',
+    'api/files': '/api/files?page=1&per_page=10',
+    'api/scheduled': '/api/scheduled',
+    'api/stats': '/api/stats',
+    'api/tags': '/api/tags',
+}
+
+def seed(workdir, rows, agents, batch=50000):
+    # Schema from the server's own migrations, then bulk rows straight into SQLite
+    subprocess.run([sys.executable, '-c', 'import developementC2; developementC2.init_db()'], cwd=workdir, check=True,
+                   env=dict(os.environ, PYTHONPATH=ROOT), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    rng = random.Random(rows)
+    now = time.time()
+    agent_ids = [f'seed-{i:06d}' for i in range(agents)]
+    conn = sqlite3.connect(os.path.join(workdir, 'c2.db'))
+    conn.executemany("""INSERT INTO agents (id, ip, info, last_seen, active, reconnect_attempts, last_reconnect)
+                        VALUES (?, '10.0.0.1', 'seeded', ?, 0, 0, NULL)""",
+                     [(agent_id, now - 86400) for agent_id in agent_ids])
+    for start in range(0, rows, batch):
+        outputs = [(agent_ids[rng.randrange(agents)], ' '.join(rng.choices(WORDS, k=rng.randint(5, 40))),
+                    now - rng.uniform(0, 5 * 86400)) for _ in range(min(batch, rows - start))]
+        first = conn.execute("SELECT COALESCE(MAX(id), 0) FROM results").fetchone()[0] + 1
+        conn.executemany("""INSERT INTO results (agent_id, output, output_size, spilled, timestamp, is_file)
+                            VALUES (?, ?, ?, 0, ?, 0)""",
+                         [(agent_id, output, len(output), ts) for agent_id, output, ts in outputs])
+        conn.executemany("INSERT INTO results_fts (rowid, output) VALUES (?, ?)",
+                         [(first + i, output) for i, (_, output, _) in enumerate(outputs)])
+        conn.commit()
+    conn.close()
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # name -> [seconds]
+        self.errors = {}
+
+    async def timed(self, name, port, method, path, body=None, data=None, ok=(200,)):
+        start = time.perf_counter()
+        try:
+            status, payload = await http(port, method, path, body, data)
+        except (OSError, asyncio.IncompleteReadError, IndexError, ValueError):
+            status, payload = None, None
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        if status not in ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        return payload
+
+    def report(self, duration):
+        return {name: {
+            'count': len(values),
+            'errors': self.errors.get(name, 0),
+            'rps': round(len(values) / duration, 1),
+            'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+        } for name, values in sorted(self.latencies.items())}
+
+async def agent(port, index, args, recorder, deadline, agent_ids):
+    rng = random.Random(index)
+    # Agents come up spread over one interval, and like real ones retry a
+    # registration the server shed (admission control answers 503 + Retry-After)
+    await asyncio.sleep(rng.uniform(0, args.interval))
+    registered = None
+    while not registered:
+        if time.monotonic() >= deadline:
+            return
+        registered = await recorder.timed('register', port, 'POST', '/register', {'info': f'fleet-{index}'})
+        if not registered:
+            await asyncio.sleep(rng.uniform(1, 2))
+    agent_id = registered['agent_id']
+    agent_ids.append(agent_id)
+    if index % 10 == 0:
+        await recorder.timed('tags', port, 'POST', f'/tags/{agent_id}', {'tags': ['fleet', f'group-{index % 4}']})
+    checkins = 0
+    while time.monotonic() < deadline:
+        checkins += 1
+        command = await recorder.timed('checkin', port, 'GET', f'/checkin/{agent_id}')
+        if command and command.get('command'):
+            large = rng.randrange(args.large_every) == 0
+            output = ' '.join(rng.choices(WORDS, k=2000 if large else rng.randint(5, 60)))
+            await recorder.timed('result', port, 'POST', f'/result/{agent_id}', {'output': output})
+        if args.transfer_every and checkins % args.transfer_every == 0:
+            await transfer(port, agent_id, rng, args, recorder)
+        await asyncio.sleep(args.interval * rng.uniform(0.8, 1.2))
+
+async def transfer(port, agent_id, rng, args, recorder):
+    data = rng.randbytes(args.transfer_size)
+    created = await recorder.timed('transfer.create', port, 'POST', f'/transfer/{agent_id}', {
+        'filename': 'loot.bin', 'direction': 'download', 'size': len(data), 'chunk_size': args.chunk_size,
+    }, ok=(201,))
+    if not created:
+        return
+    for offset in range(0, len(data), args.chunk_size):
+        chunk = data[offset:offset + args.chunk_size]
+        if not await recorder.timed('transfer.chunk', port, 'PUT',
+                                    f"/transfer/{created['transfer_id']}/chunk?offset={offset}", data=chunk):
+            return
+
+async def operator(port, args, recorder, deadline):
+    await asyncio.sleep(args.broadcast_interval)
+    while time.monotonic() < deadline:
+        await recorder.timed('command_all', port, 'POST', '/command_all', {'command': 'id'})
+        await asyncio.sleep(args.broadcast_interval)
+
+async def dashboard(port, index, recorder, deadline, agent_ids):
+    rng = random.Random(-index)
+    names = list(DASHBOARD_QUERIES)
+    while time.monotonic() < deadline:
+        name = names[rng.randrange(len(names))]
+        path = DASHBOARD_QUERIES[name].format(agent_id=rng.choice(agent_ids) if agent_ids else '',
+                                              word=rng.choice(WORDS))
+        await recorder.timed(name, port, 'GET', path)
+
+async def run_fleet(port, pid, args):
+    recorder = Recorder()
+    agent_ids = []
+    start = time.monotonic()
+    deadline = start + args.duration
+    tasks = [agent(port, i, args, recorder, deadline, agent_ids) for i in range(args.agents)]
+    tasks.append(operator(port, args, recorder, deadline))
+    tasks += [dashboard(port, i, recorder, deadline, agent_ids) for i in range(args.readers)]
+
+    async def sample():
+        await asyncio.sleep(args.duration / 2)
+        return process_usage(pid)
+
+    usage, *_ = await asyncio.gather(sample(), *tasks)
+    return {'endpoints': recorder.report(time.monotonic() - start), 'server': usage}
+
+def bench_size(mode, rows, args):
+    workdir = tempfile.mkdtemp(prefix=f'c2-fleet-{mode}-{rows}-')
+    try:
+        start = time.monotonic()
+        seed(workdir, rows, args.seed_agents)
+        seeded = round(time.monotonic() - start, 1)
+        with run_server(mode, workdir, startup_timeout=300) as (port, pid):
+            report = asyncio.run(run_fleet(port, pid, args))
+        report['seed_seconds'] = seeded
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(baseline, current, tolerance, floor_ms):
+    # Failures as readable lines; latency within floor_ms of the baseline is noise.
+    # Numbers from another machine or interpreter say nothing about this change
+    regressions = []
+    stored = baseline.get('environment', {})
+    for key, value in current['environment'].items():
+        if stored.get(key) != value:
+            regressions.append(f"environment {key}: baseline {stored.get(key)!r}, this run {value!r}")
+    for mode, sizes in current['runs'].items():
+        for rows, run in sizes.items():
+            base_run = baseline.get('runs', {}).get(mode, {}).get(rows)
+            if not base_run:
+                regressions.append(f'{mode} rows={rows}: not in the baseline')
+                continue
+            for name, now in run['endpoints'].items():
+                where = f'{mode} rows={rows} {name}'
+                base = base_run['endpoints'].get(name)
+                if not base:
+                    regressions.append(f'{where}: not in the baseline')
+                    continue
+                if now['p99_ms'] > base['p99_ms'] * (1 + tolerance) and now['p99_ms'] - base['p99_ms'] > floor_ms:
+                    regressions.append(f"{where}: p99 {base['p99_ms']} -> {now['p99_ms']} ms")
+                if now['rps'] < base['rps'] * (1 - tolerance):
+                    regressions.append(f"{where}: throughput {base['rps']} -> {now['rps']} req/s")
+                if now['errors'] > base['errors']:
+                    regressions.append(f"{where}: errors {base['errors']} -> {now['errors']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated agent fleet against a seeded database')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='results rows seeded per run')
+    parser.add_argument('--seed-agents', type=int, default=1000, help='historical agents owning the seeded rows')
+    parser.add_argument('--agents', type=int, default=200, help='simulated agents')
+    parser.add_argument('--readers', type=int, default=4, help='concurrent dashboard clients')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load per size')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between an agent\'s check-ins')
+    parser.add_argument('--broadcast-interval', type=float, default=5.0)
+    parser.add_argument('--large-every', type=int, default=20, help='one result in N is a large output')
+    parser.add_argument('--transfer-every', type=int, default=25, help='check-ins between transfers; 0 disables')
+    parser.add_argument('--transfer-size', type=int, default=256 * 1024)
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    parser.add_argument('--modes', default='flask', help='comma-separated: flask, asgi')
+    parser.add_argument('--save', help='write the report to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON to check this run against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative change')
+    parser.add_argument('--floor-ms', type=float, default=2.0, help='p99 changes smaller than this are ignored')
+    args = parser.parse_args()
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': {key: value for key, value in vars(args).items() if key not in ('save', 'compare')},
+        'runs': {mode: {str(rows): bench_size(mode, rows, args) for rows in map(int, args.sizes.split(','))}
+                 for mode in args.modes.split(',')},
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance, args.floor_ms)
+        for line in regressions:
+            print(f'FAIL {line}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
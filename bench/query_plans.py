@@ -0,0 +1,45 @@
+### Query-plan check: every HOT_QUERIES entry must be served by an index.
+###
+###   python bench/query_plans.py [--db c2.db]
+###
+### Builds an empty database from SCHEMA_MIGRATIONS in a scratch directory (or
+### migrates a copy of --db) and runs find_query_scans() over it. Prints each
+### query that falls back to a full table scan or a temporary sort and exits 1
+### if there are any, so it can gate a change to a query or an index.
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from serving import ROOT
+
+def main():
+    parser = argparse.ArgumentParser(description='Fail when a hot query falls back to a table scan')
+    parser.add_argument('--db', help='check a copy of this database instead of an empty one')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='c2-plans-')
+    try:
+        path = os.path.join(scratch, 'c2.db')
+        if args.db:
+            shutil.copyfile(args.db, path)
+        sys.path.insert(0, ROOT)
+        import developementC2 as c2
+
+        conn = sqlite3.connect(path)
+        c2.migrate_db(conn)
+        problems = c2.find_query_scans(conn)
+        conn.close()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    for name, detail in problems:
+        print(f"{name}: {detail}")
+    print(f"{len(c2.HOT_QUERIES)} queries, {len(problems)} scans")
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+### Flask (threaded Werkzeug) vs ASGI (asgiC2.py under uvicorn) serving comparison.
+###
+###   python bench/serving.py [--agents 500] [--requests 2000] [--concurrency 50]
+###
+### Each server is started in a scratch directory with an empty database. The
+### client is plain asyncio with one connection per request, so both servers
+### see the same traffic. Reported per mode:
+###   register_rps    agent registrations per second
+###   checkin_rps     empty check-ins per second
+###   longpoll_*      --agents check-ins held open with ?wait=, then one
+###                   /command_all; latency is broadcast -> response received
+###   rss_mb/threads  server process while the long polls are held open
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every simulated client connects from 127.0.0.1, so the per-address rate
+# limits are off; per-agent limits and the concurrency limit stay on
+CONFIG = {'RATE_LIMIT_IP_RATE': 0, 'RATE_LIMIT_DASHBOARD_RATE': 0}
+
+SERVERS = {
+    'flask': "import developementC2 as c2; c2.create_app({config}).run(host='127.0.0.1', port={port}, threaded=True)",
+    'asgi': "import uvicorn, asgiC2; uvicorn.run(asgiC2.create_app({config}), host='127.0.0.1', port={port}, "
+            "log_level='warning', backlog=4096)",
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def http(port, method, path, body=None, data=None):
+    # body is sent as JSON, data as raw bytes
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    if body is not None:
+        data = json.dumps(body).encode()
+    data = data or b''
+    head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\nContent-Length: {len(data)}\r\n"
+    if body is not None:
+        head += "Content-Type: application/json\r\n"
+    writer.write(head.encode() + b"\r\n" + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status = int(response.split(b' ', 2)[1])
+    payload = response.split(b"\r\n\r\n", 1)[1]
+    return status, json.loads(payload) if payload.startswith(b'{') else payload
+
+async def bounded(concurrency, jobs):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with semaphore:
+            return await job
+
+    return await asyncio.gather(*(run(job) for job in jobs))
+
+def process_usage(pid):
+    usage = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                usage['rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+            elif line.startswith('Threads:'):
+                usage['threads'] = int(line.split()[1])
+    return usage
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+async def run_bench(port, pid, args):
+    report = {}
+
+    start = time.monotonic()
+    registered = await bounded(args.concurrency, [http(port, 'POST', '/register', {'info': f'bench-{i}'})
+                                                  for i in range(args.agents)])
+    report['register_rps'] = round(args.agents / (time.monotonic() - start), 1)
+    agent_ids = [body['agent_id'] for _, body in registered]
+
+    start = time.monotonic()
+    await bounded(args.concurrency, [http(port, 'GET', f'/checkin/{agent_ids[i % len(agent_ids)]}')
+                                     for i in range(args.requests)])
+    report['checkin_rps'] = round(args.requests / (time.monotonic() - start), 1)
+
+    received = {}
+
+    async def long_poll(agent_id):
+        status, body = await http(port, 'GET', f'/checkin/{agent_id}?wait={args.wait}')
+        if status == 200 and body.get('command'):
+            received[agent_id] = time.monotonic()
+
+    polls = [asyncio.create_task(long_poll(agent_id)) for agent_id in agent_ids]
+    await asyncio.sleep(args.settle)
+    report.update(process_usage(pid))
+    sent = time.monotonic()
+    await http(port, 'POST', '/command_all', {'command': 'bench'})
+    await asyncio.gather(*polls)
+    latencies = [(t - sent) * 1000 for t in received.values()]
+    report['longpoll_delivered'] = len(latencies)
+    report['longpoll_p50_ms'] = round(percentile(latencies, 0.5), 1) if latencies else None
+    report['longpoll_p99_ms'] = round(percentile(latencies, 0.99), 1) if latencies else None
+    return report
+
+@contextlib.contextmanager
+def run_server(mode, workdir, startup_timeout=30):
+    # Yields (port, pid) of a server running in workdir, stopped on exit
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    server = subprocess.Popen([sys.executable, '-c', SERVERS[mode].format(port=port, config=repr(CONFIG))], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError(f'{mode} server did not start')
+                time.sleep(0.2)
+        yield port, server.pid
+    finally:
+        server.terminate()
+        server.wait()
+
+def bench_mode(mode, args):
+    workdir = tempfile.mkdtemp(prefix=f'c2-bench-{mode}-')
+    try:
+        with run_server(mode, workdir) as (port, pid):
+            return asyncio.run(run_bench(port, pid, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the Flask and ASGI serving modes')
+    parser.add_argument('--agents', type=int, default=500, help='registered agents / concurrent long polls')
+    parser.add_argument('--requests', type=int, default=2000, help='empty check-ins for checkin_rps')
+    parser.add_argument('--concurrency', type=int, default=50, help='client connections for the rps phases')
+    parser.add_argument('--wait', type=int, default=20, help='long-poll ?wait= seconds')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds to let long polls connect')
+    parser.add_argument('--modes', default='flask,asgi')
+    args = parser.parse_args()
+
+    results = {mode: bench_mode(mode, args) for mode in args.modes.split(',')}
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,263 +1,3487 @@
 ### Requires valid cert for HTTPS
 
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, request, jsonify, render_template, send_file, Response, stream_with_context
 import uuid
+import hashlib
 import time
 import os
-from collections import deque
+from collections import deque, OrderedDict
 import threading
 import sqlite3
 import json
+import base64
+import zlib
+import csv
+import io
 from datetime import datetime, timedelta
-import schedule
+import heapq
+import itertools
+import bisect
+import logging
+import re
 import atexit
+import signal
+import sys
+from contextlib import contextmanager
+import functools
+import ipaddress
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
 
 # Configuration
-UPLOAD_FOLDER = 'uploads'
+UPLOAD_FOLDER = 'uploads'  # per-transfer copies written before the blob store
 DOWNLOAD_FOLDER = 'downloads'
+TRANSFER_FOLDER = 'transfers'  # partial chunked transfers
+BLOB_FOLDER = 'blobs'  # file contents, stored once per SHA-256
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
-SCHEDULER_INTERVAL = 60  # seconds
+MAX_TAG_LENGTH = 64
+TRANSFER_CHUNK_SIZE = 4 * 1024 * 1024  # default chunk size for chunked transfers
+MAX_TRANSFER_SIZE = 10 * 1024 * 1024 * 1024  # 10GB
+TRANSFER_EXPIRY = 24 * 3600  # seconds before an idle partial transfer is discarded
+STREAM_BLOCK_SIZE = 64 * 1024
+SCHEDULER_BATCH_SIZE = 500  # due jobs enqueued per transaction
+CLEANUP_INTERVAL = 60  # seconds between maintenance passes
+AGENT_TIMEOUT = 300  # seconds without a check-in before an agent is marked inactive
+RECONNECT_TRACK_WINDOW = 24 * 3600  # an agent dropped longer than this is lost rather than reconnecting
+RETENTION = {  # seconds each table keeps rows
+    'results': 7 * 24 * 3600,
+    'files': 7 * 24 * 3600,
+    'fanouts': 7 * 24 * 3600,  # fan-out commands and their delivery records
+    'commands': 7 * 24 * 3600,  # delivered commands, counted from delivery
+}
+CLEANUP_BATCH_SIZE = 1000  # rows per maintenance transaction
+CLEANUP_PAUSE = 0.01  # seconds between batches, lets check-ins take the write lock
+INCREMENTAL_VACUUM_PAGES = 1000  # free pages returned to the OS per pass
+RESULT_COMPRESS_THRESHOLD = 4096  # outputs longer than this (characters) are compressed out of the results table
+RESULT_PREVIEW_CHARS = 512  # characters of a compressed output kept inline for listings
+RESULT_COMPRESS_LEVEL = 6
+RESULT_CACHE_SIZE = 1000  # newest results held in memory for /api/results
+RESULT_CACHE_PER_AGENT = 50  # newest results held per agent
+RESULT_CACHE_AGENTS = 500  # agents with a per-agent ring, least recently written evicted first
+EXPORT_BATCH_SIZE = 500  # rows read per connection checkout during an export
+EXPORT_COMPRESS_LEVEL = 6
+STATS_RECONCILE_INTERVAL = 600  # seconds between re-reading /api/stats windows from SQLite
+HEARTBEAT_FLUSH_INTERVAL_MS = 500  # max delay before check-in timestamps reach SQLite
+HEARTBEAT_BATCH_SIZE = 500  # flush early once this many agents are dirty
+RESULT_QUEUE_SIZE = 10000  # results accepted but not yet committed; /result answers 429 beyond this
+RESULT_BATCH_SIZE = 500  # results per group commit
+RESULT_BATCH_LATENCY_MS = 20  # max time a result waits for its batch to fill
+RESULT_DURABLE_TIMEOUT = 10  # seconds a /result?durable=1 request waits for its commit
+RESULT_RETRY_AFTER = 1  # Retry-After seconds on a 429 from a full result queue
+LONG_POLL_MAX_WAIT = 30  # seconds a /checkin?wait=N request may be held open
+LONG_POLL_MAX_WAITERS = 1000  # beyond this, long-poll check-ins answer immediately
+RATE_LIMIT_AGENT_RATE = 5  # /checkin and /result requests per second per agent id; 0 disables
+RATE_LIMIT_AGENT_BURST = 20
+RATE_LIMIT_IP_RATE = 200  # /register, /checkin and /result requests per second per source address; 0 disables
+RATE_LIMIT_IP_BURST = 1000
+RATE_LIMIT_DASHBOARD_RATE = 50  # /api/* requests per second per source address; 0 disables
+RATE_LIMIT_DASHBOARD_BURST = 200
+RATE_LIMIT_SHARDS = 16  # independently locked bucket maps
+ADMISSION_MAX_CONCURRENT = 64  # agent and /api/* requests processed at once; 0 disables
+ADMISSION_DASHBOARD_RESERVED = 8  # of those, slots only /api/* requests may take
+ADMISSION_RETRY_AFTER = 1  # Retry-After seconds when every slot is taken
+EVENT_HISTORY = 2000  # published events kept for Last-Event-ID resume
+EVENT_SUBSCRIBER_BUFFER = 500  # undelivered events per dashboard stream before it is reset
+EVENT_MAX_SUBSCRIBERS = 50  # concurrent /api/events streams
+EVENT_KEEPALIVE = 15  # seconds between SSE comments on an idle stream
+EVENT_STATS_INTERVAL = 2  # seconds between stats pushes while they change
+EVENT_OUTPUT_PREVIEW = 4096  # characters of result output carried in a 'result' event
+STATE_BACKEND = os.environ.get('C2_STATE_BACKEND', 'local')  # 'sqlite' to run several worker processes on one box
+LEADER_LEASE_TTL = 10  # seconds a scheduler/maintenance leader keeps the role without renewing
+BROKER_POLL_INTERVAL_MS = 100  # how often a worker reads the other workers' broker messages
+BROKER_RETENTION = 300  # seconds broker messages are kept for lagging workers
+BACKEND_SYNC_INTERVAL = 5  # seconds between merging other workers' agent check-ins
+BACKEND_RESYNC_INTERVAL = 60  # seconds between re-reading row counters and stats windows
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # histogram bounds, seconds
+METRICS_QUERY_NAMES = 2048  # distinct SQL strings whose query name is cached
+RESPONSE_CACHE_ENTRIES = 512  # cached dashboard responses, least recently used evicted first
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024  # total body size the response cache may hold
+RESPONSE_CACHE_SHARED_MAX_AGE = 2  # seconds a cached response lives when other workers also write
+LOG_LEVEL = os.environ.get('C2_LOG_LEVEL', 'INFO')
+LOG_RATE_LIMIT = 20  # records per event name per window; the rest are counted, not written
+LOG_RATE_WINDOW = 60  # seconds
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+# Names create_app(config) accepts; the DB_* settings are added below
+CONFIG_KEYS = {name for name in globals() if name.isupper()}
+
+# Logging: one JSON object per line, e.g.
+#   {"ts": 1700000000.123, "level": "info", "event": "agent_registered", "agent_id": "...", "ip": "..."}
+# Each event name may write LOG_RATE_LIMIT records per LOG_RATE_WINDOW; the
+# first record of the next window carries the number dropped as "suppressed".
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname.lower(), 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.windows = {}  # event -> [window start, records written, records suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            state = self.windows.get(record.msg)
+            if state is None or record.created - state[0] >= self.window:
+                if state and state[2]:
+                    record.fields = dict(getattr(record, 'fields', {}), suppressed=state[2])
+                state = self.windows[record.msg] = [record.created, 0, 0]
+            if state[1] >= self.limit:
+                state[2] += 1
+                return False
+            state[1] += 1
+            return True
+
+logger = logging.getLogger('c2')
+if not logger.handlers:
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(JsonLogFormatter())
+    log_handler.addFilter(RateLimitFilter())
+    logger.addHandler(log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+def log_event(level, event, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+# Metrics, served in the Prometheus text format from /metrics. Recording is a
+# dict update under one lock, cheap enough for every request and statement.
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class MetricsRegistry:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.families = {}  # name -> (type, help)
+        self.samples = {}  # name -> {labels: number or Histogram}; labels are ((key, value), ...)
+        self.collectors = {}  # name -> callable returning a number or {labels: number}
+
+    def describe(self, name, kind, help_text, collect=None):
+        self.families[name] = (kind, help_text)
+        self.samples.setdefault(name, {})
+        if collect is not None:
+            self.collectors[name] = collect
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.samples[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.samples[name].get(labels)
+            if histogram is None:
+                histogram = self.samples[name][labels] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            snapshot = {name: {labels: (value.counts[:], value.sum) if isinstance(value, Histogram) else value
+                               for labels, value in series.items()}
+                        for name, series in self.samples.items()}
+        for name, (kind, help_text) in self.families.items():
+            series = snapshot[name]
+            if name in self.collectors:
+                try:
+                    collected = self.collectors[name]()
+                except Exception as e:
+                    log_event(logging.WARNING, 'metrics_collect_error', metric=name, error=str(e))
+                    continue
+                series = collected if isinstance(collected, dict) else {(): collected}
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series.items():
+                if kind != 'histogram':
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._labels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{self._labels(labels)} {total}')
+                lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('c2_http_requests_total', 'counter', 'Requests answered, by route, method and status')
+metrics.describe('c2_http_request_seconds', 'histogram', 'Time to produce a response, by route and method')
+metrics.describe('c2_db_query_seconds', 'histogram', 'SQLite statement execution time, by query name')
+metrics.describe('c2_db_pool_wait_seconds', 'histogram', 'Time spent waiting for a pooled connection')
+metrics.describe('c2_scheduler_lag_seconds', 'histogram', 'Scheduled command fire time minus its intended time')
+metrics.describe('c2_cleanup_pass_seconds', 'histogram', 'Duration of a maintenance pass')
+metrics.describe('c2_transfer_bytes_total', 'counter', 'Chunked transfer bytes written, by direction')
+metrics.describe('c2_transfer_inflight_bytes', 'gauge', 'Declared chunk bytes still being received')
+
+# Per SQL string: the query name for c2_db_query_seconds (the HOT_QUERIES key
+# when the statement is one of them, otherwise the verb and table, e.g.
+# 'insert results') and the table it writes, if any
+query_info_cache = {}
+query_name_pattern = re.compile(r'\s*(?:(UPDATE)\s+(\w+)|(\w+)(?:.*?\b(?:FROM|INTO)\s+(\w+))?)', re.S | re.I)
+WRITE_VERBS = ('insert', 'update', 'delete', 'replace')
+
+def query_info(sql):
+    info = query_info_cache.get(sql)
+    if info is None:
+        match = query_name_pattern.match(sql)
+        parts = [part.lower() for part in match.groups() if part] if match else []
+        written = parts[1] if len(parts) == 2 and parts[0] in WRITE_VERBS else None
+        name = hot_query_names().get(' '.join(sql.split())) or ' '.join(parts) or 'other'
+        info = (name, written)
+        if len(query_info_cache) < METRICS_QUERY_NAMES:
+            query_info_cache[sql] = info
+    return info
+
+def query_name(sql):
+    return query_info(sql)[0]
+
+def hot_query_names():
+    global hot_query_index
+    if hot_query_index is None:
+        hot_query_index = {' '.join(sql.split()): name for name, (sql, _) in HOT_QUERIES.items()}
+    return hot_query_index
+
+hot_query_index = None
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(sql, start)
+
+    def _observe(self, sql, start):
+        name, written = query_info(sql)
+        metrics.observe('c2_db_query_seconds', time.perf_counter() - start, (('query', name),))
+        if written:
+            self.connection.written.add(written)
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute() does not go through cursor(), so both are routed here.
+    # Tables written in the open transaction are bumped in table_versions on commit.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.written = set()
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        super().commit()
+        if self.written:
+            table_versions.bump(self.written)
+            self.written = set()
+
+    def rollback(self):
+        super().rollback()
+        self.written = set()
+
+# Change counters per table, bumped after each commit that wrote the table.
+# Cached dashboard responses and their ETags are keyed on these.
+class TableVersions:
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]  # ETags from a previous process never match
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def bump(self, tables):
+        with self.lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+
+    def get(self, tables):
+        with self.lock:
+            return tuple(self.versions.get(table, 0) for table in tables)
+
+table_versions = TableVersions()
+
+# Database
+DB_PATH = 'c2.db'
+DB_POOL_SIZE = 20
+DB_POOL_TIMEOUT = 10  # seconds to wait for a free connection
+DB_HEALTH_CHECK_INTERVAL = 30  # seconds a connection may idle before it is re-checked
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',  # readers no longer block on /result writes
+    'synchronous': 'NORMAL',  # safe with WAL, fsyncs only on checkpoint
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16000,  # KiB, per connection
+    'busy_timeout': 10000,  # ms
+    'temp_store': 'MEMORY',
+}
+CONFIG_KEYS.update(('DB_PATH', 'DB_POOL_SIZE', 'DB_POOL_TIMEOUT', 'DB_HEALTH_CHECK_INTERVAL', 'DB_PRAGMAS'))
+
+class PoolTimeout(Exception):
+    pass
 
 # Database setup with connection pooling
 class DBConnectionPool:
-    def __init__(self, max_connections=10):
+    def __init__(self, database=DB_PATH, max_connections=10, timeout=DB_POOL_TIMEOUT, pragmas=None):
+        self.database = database
         self.max_connections = max_connections
-        self.pool = deque(maxlen=max_connections)
+        self.timeout = timeout
+        self.pragmas = DB_PRAGMAS if pragmas is None else pragmas
+        self.pool = deque()  # idle (connection, returned_at) pairs
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.opened = 0
+        self.in_use = 0
+        self.waiters = 0
+        self.stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False,
+                               factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _healthy(self, conn, returned_at):
+        if time.time() - returned_at < DB_HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            self.stats['health_check_failures'] += 1
+            return False
+
+    def get_connection(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        with self.available:
+            self.waiters += 1
+            try:
+                while not self.pool and self.opened >= self.max_connections:
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0 or not self.available.wait(remaining):
+                        if not self.pool and self.opened >= self.max_connections:
+                            self.stats['timeouts'] += 1
+                            raise PoolTimeout(f"No database connection free after {timeout}s")
+            finally:
+                self.waiters -= 1
+
+            conn = None
+            while self.pool and conn is None:
+                conn, returned_at = self.pool.pop()
+                if not self._healthy(conn, returned_at):
+                    conn.close()
+                    self.opened -= 1
+                    conn = None
+            if conn is None:
+                # Reserve the slot before connecting outside the lock
+                self.opened += 1
+
+            waited = time.monotonic() - start
+            self.in_use += 1
+            self.stats['checkouts'] += 1
+            self.stats['wait_time_total'] += waited
+            self.stats['wait_time_max'] = max(self.stats['wait_time_max'], waited)
+        metrics.observe('c2_db_pool_wait_seconds', waited)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self.available:
+                    self.opened -= 1
+                    self.in_use -= 1
+                    self.available.notify()
+                raise
+        return conn
+
+    def return_connection(self, conn):
+        # Never hand out a connection with a transaction left open by a failed request
+        reset = False
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            reset = True
+        finally:
+            if not reset:
+                # Could not be rolled back; drop it and let the slot open a fresh one
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            with self.available:
+                self.in_use -= 1
+                if reset:
+                    self.pool.append((conn, time.time()))
+                else:
+                    self.opened -= 1
+                self.available.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.get_connection(timeout)
+        try:
+            yield conn
+        finally:
+            self.return_connection(conn)
+
+    def metrics(self):
+        with self.lock:
+            checkouts = self.stats['checkouts']
+            return {
+                'max_connections': self.max_connections,
+                'open': self.opened,
+                'idle': len(self.pool),
+                'in_use': self.in_use,
+                'waiters': self.waiters,
+                'checkouts': checkouts,
+                'timeouts': self.stats['timeouts'],
+                'health_check_failures': self.stats['health_check_failures'],
+                'wait_time_avg_ms': round(self.stats['wait_time_total'] / checkouts * 1000, 3) if checkouts else 0,
+                'wait_time_max_ms': round(self.stats['wait_time_max'] * 1000, 3),
+            }
+
+    def close_all(self):
+        with self.available:
+            while self.pool:
+                conn, _ = self.pool.pop()
+                conn.close()
+                self.opened -= 1
+
+db_pool = DBConnectionPool(DB_PATH, max_connections=DB_POOL_SIZE)
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Never edit a migration that has shipped; append a new one instead.
+SCHEMA_MIGRATIONS = [
+    # 1: base tables
+    ['''CREATE TABLE IF NOT EXISTS agents
+        (id TEXT PRIMARY KEY, ip TEXT, info TEXT, last_seen REAL, active INTEGER,
+         reconnect_attempts INTEGER DEFAULT 0, last_reconnect REAL)''',
+     '''CREATE TABLE IF NOT EXISTS commands
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         agent_id TEXT, command TEXT, timestamp REAL,
+         is_file INTEGER DEFAULT 0, file_path TEXT,
+         is_scheduled INTEGER DEFAULT 0, scheduled_time REAL,
+         is_recurring INTEGER DEFAULT 0, interval_seconds INTEGER)''',
+     '''CREATE TABLE IF NOT EXISTS results
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         agent_id TEXT, output TEXT, timestamp REAL,
+         is_file INTEGER DEFAULT 0, file_path TEXT)''',
+     '''CREATE TABLE IF NOT EXISTS files
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         agent_id TEXT, filename TEXT, filepath TEXT,
+         size INTEGER, upload_time REAL, direction TEXT)'''],
+    # 2: indexes for the check-in, cleanup and dashboard access paths
+    ["CREATE INDEX IF NOT EXISTS idx_agents_last_seen ON agents (last_seen)",
+     "CREATE INDEX IF NOT EXISTS idx_agents_active_last_seen ON agents (active, last_seen)",
+     "CREATE INDEX IF NOT EXISTS idx_commands_agent_id ON commands (agent_id, id)",
+     "CREATE INDEX IF NOT EXISTS idx_commands_scheduled ON commands (is_scheduled, scheduled_time)",
+     "CREATE INDEX IF NOT EXISTS idx_results_timestamp ON results (timestamp)",
+     "CREATE INDEX IF NOT EXISTS idx_results_agent_timestamp ON results (agent_id, timestamp)",
+     "CREATE INDEX IF NOT EXISTS idx_files_upload_time ON files (upload_time)",
+     "CREATE INDEX IF NOT EXISTS idx_files_direction_time ON files (direction, upload_time)",
+     "CREATE INDEX IF NOT EXISTS idx_files_agent_direction_time ON files (agent_id, direction, upload_time)"],
+    # 3: resumable chunked transfer sessions
+    ['''CREATE TABLE IF NOT EXISTS transfers
+        (id TEXT PRIMARY KEY, agent_id TEXT, filename TEXT, direction TEXT,
+         command TEXT, total_size INTEGER, received INTEGER DEFAULT 0,
+         chunk_size INTEGER, sha256 TEXT, temp_path TEXT, status TEXT,
+         file_id INTEGER, created REAL, updated REAL)''',
+     "CREATE INDEX IF NOT EXISTS idx_transfers_status_updated ON transfers (status, updated)"],
+    # 4: content-addressed blob store; files.filepath points at the blob
+    ['''CREATE TABLE IF NOT EXISTS blobs
+        (sha256 TEXT PRIMARY KEY, path TEXT, size INTEGER,
+         refcount INTEGER DEFAULT 0, created REAL)''',
+     "CREATE INDEX IF NOT EXISTS idx_blobs_refcount ON blobs (refcount)",
+     "ALTER TABLE files ADD COLUMN sha256 TEXT",
+     "CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files (sha256)"],
+    # 5: agents still carrying reconnect attempts, for the cleanup reset
+    ["CREATE INDEX IF NOT EXISTS idx_agents_reconnecting ON agents (active) WHERE reconnect_attempts > 0"],
+    # 6: per-agent file listing without a direction filter
+    ["CREATE INDEX IF NOT EXISTS idx_files_agent_time ON files (agent_id, upload_time)"],
+    # 7: shared state backend: role leases and the inter-worker message log
+    ["CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT, expires REAL)",
+     '''CREATE TABLE IF NOT EXISTS broker
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, topic TEXT,
+         payload TEXT, created REAL)''',
+     "CREATE INDEX IF NOT EXISTS idx_broker_created ON broker (created)"],
+    # 8: large outputs move to result_bodies compressed, leaving a preview in
+    # results; contentless full-text index over every output
+    ["ALTER TABLE results ADD COLUMN output_size INTEGER",
+     "ALTER TABLE results ADD COLUMN spilled INTEGER DEFAULT 0",
+     "CREATE TABLE IF NOT EXISTS result_bodies (result_id INTEGER PRIMARY KEY, codec TEXT, body BLOB)",
+     "CREATE VIRTUAL TABLE IF NOT EXISTS results_fts USING fts5(output, content='')",
+     "UPDATE results SET output_size = length(output)",
+     "INSERT INTO results_fts (rowid, output) SELECT id, output FROM results WHERE output != ''"],
+    # 9: agent groups, and fan-out commands stored once with per-recipient
+    # delivery state (commands.target: '*' for every active agent, else a tag)
+    ["CREATE TABLE IF NOT EXISTS agent_tags (tag TEXT, agent_id TEXT, PRIMARY KEY (tag, agent_id)) WITHOUT ROWID",
+     "CREATE INDEX IF NOT EXISTS idx_agent_tags_agent ON agent_tags (agent_id)",
+     "ALTER TABLE commands ADD COLUMN target TEXT",
+     "CREATE INDEX IF NOT EXISTS idx_commands_fanout ON commands (timestamp) WHERE target IS NOT NULL",
+     '''CREATE TABLE IF NOT EXISTS deliveries
+        (command_id INTEGER, agent_id TEXT, status TEXT DEFAULT 'pending', delivered REAL,
+         PRIMARY KEY (command_id, agent_id)) WITHOUT ROWID''',
+     "CREATE INDEX IF NOT EXISTS idx_deliveries_pending ON deliveries (command_id) WHERE status = 'pending'"],
+    # 10: warm-start snapshot, dropped by any write to the tables it summarizes;
+    # direct pending commands without walking past fan-out rows
+    ["CREATE TABLE IF NOT EXISTS warm_state (name TEXT PRIMARY KEY, body TEXT, written REAL)",
+     '''CREATE TRIGGER IF NOT EXISTS warm_state_results_insert AFTER INSERT ON results
+        WHEN EXISTS (SELECT 1 FROM warm_state) BEGIN DELETE FROM warm_state; END''',
+     '''CREATE TRIGGER IF NOT EXISTS warm_state_results_delete AFTER DELETE ON results
+        WHEN EXISTS (SELECT 1 FROM warm_state) BEGIN DELETE FROM warm_state; END''',
+     '''CREATE TRIGGER IF NOT EXISTS warm_state_files_insert AFTER INSERT ON files
+        WHEN EXISTS (SELECT 1 FROM warm_state) BEGIN DELETE FROM warm_state; END''',
+     '''CREATE TRIGGER IF NOT EXISTS warm_state_files_delete AFTER DELETE ON files
+        WHEN EXISTS (SELECT 1 FROM warm_state) BEGIN DELETE FROM warm_state; END''',
+     "CREATE INDEX IF NOT EXISTS idx_commands_pending ON commands (is_scheduled, id) WHERE target IS NULL"],
+    # 11: command history exports in time order
+    ["CREATE INDEX IF NOT EXISTS idx_commands_timestamp ON commands (timestamp)",
+     "CREATE INDEX IF NOT EXISTS idx_commands_agent_timestamp ON commands (agent_id, timestamp)"],
+    # 12: delivered commands stay, stamped with their delivery time, as history
+    ["ALTER TABLE commands ADD COLUMN delivered REAL",
+     "DROP INDEX IF EXISTS idx_commands_pending",
+     """CREATE INDEX idx_commands_pending ON commands (is_scheduled, id)
+        WHERE target IS NULL AND delivered IS NULL""",
+     "CREATE INDEX IF NOT EXISTS idx_commands_delivered ON commands (delivered) WHERE delivered IS NOT NULL"],
+    # 13: the pre-scheduler code stored every firing of a recurring command as
+    # another recurring row (scheduled_time NULL, timestamp = firing time).
+    # Keep each job's first row, due one interval after its last firing
+    ["""CREATE TEMP TABLE legacy_recurring AS
+        SELECT MIN(id) AS id, MAX(timestamp) + interval_seconds AS due FROM commands
+        WHERE is_scheduled = 1 AND is_recurring = 1 AND scheduled_time IS NULL
+        GROUP BY agent_id, command, interval_seconds""",
+     """DELETE FROM commands WHERE is_scheduled = 1 AND is_recurring = 1 AND scheduled_time IS NULL
+        AND id NOT IN (SELECT id FROM legacy_recurring)""",
+     """UPDATE commands SET scheduled_time = (SELECT due FROM legacy_recurring WHERE legacy_recurring.id = commands.id)
+        WHERE id IN (SELECT id FROM legacy_recurring)""",
+     "DROP TABLE legacy_recurring"],
+    # 14: blob sweep lookup by path; broadcast uploads belong to no agent
+    ["CREATE INDEX IF NOT EXISTS idx_commands_file_path ON commands (file_path) WHERE file_path IS NOT NULL",
+     "UPDATE files SET agent_id = NULL WHERE agent_id = 'broadcast'"],
+]
+
+def migrate_db(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target in range(version + 1, len(SCHEMA_MIGRATIONS) + 1):
+        try:
+            # Write lock first, then re-check: another worker may have migrated meanwhile
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+                conn.rollback()
+                continue
+            for statement in SCHEMA_MIGRATIONS[target - 1]:
+                conn.execute(statement)
+            # PRAGMA does not take bound parameters
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log_event(logging.INFO, 'schema_migrated', version=target)
+
+# Queries issued by the endpoints and background threads. find_query_scans()
+# runs EXPLAIN QUERY PLAN over each one and reports any that fall back to a
+# full table scan or a temporary sort; bench/query_plans.py exits 1 on any.
+HOT_QUERIES = {
+    'startup.pending_commands': ("""SELECT id, agent_id, command, is_file, file_path
+                                    FROM commands WHERE is_scheduled = 0 AND target IS NULL AND delivered IS NULL
+                                    ORDER BY id""", ()),
+    'startup.active_agents': ("SELECT id, last_seen FROM agents WHERE active = 1", ()),
+    'checkin.dequeue': ("""UPDATE commands SET delivered = ?
+                          WHERE id = ? AND is_scheduled = 0 AND delivered IS NULL""", (0, 0)),
+    'checkin.claim_fanout': ("""UPDATE deliveries SET status = 'delivered', delivered = ?
+                               WHERE command_id = ? AND agent_id = ? AND status = 'pending'""", (0, 0, '')),
+    'fanout.recipients': ("SELECT agent_id FROM deliveries WHERE command_id = ? AND status = 'pending'", (0,)),
+    'fanout.total': ("SELECT COUNT(*) FROM deliveries WHERE command_id = ?", (0,)),
+    'fanout.pending': ("SELECT COUNT(*) FROM deliveries WHERE command_id = ? AND status = 'pending'", (0,)),
+    'api.fanouts': ("""SELECT id, command, is_file, target, timestamp FROM commands
+                      WHERE target IS NOT NULL
+                      ORDER BY timestamp DESC LIMIT ?""", (20,)),
+    'cleanup.prune_fanouts': ("""SELECT id FROM commands
+                                 WHERE target IS NOT NULL AND timestamp < ? LIMIT ?""", (0, 1)),
+    'cleanup.prune_commands': ("SELECT id FROM commands WHERE delivered < ? LIMIT ?", (0, 1)),
+    'cleanup.sweep_blobs': ("SELECT 1 FROM commands WHERE file_path = ? LIMIT 1", ('',)),
+    'backend.broker_poll': ("SELECT id, origin, topic, payload FROM broker WHERE id > ? ORDER BY id LIMIT ?", (0, 1)),
+    'backend.broker_prune': ("DELETE FROM broker WHERE created < ?", (0,)),
+    'cleanup.newly_inactive': ("SELECT id FROM agents WHERE active = 1 AND last_seen < ? LIMIT ?", (0, 1)),
+    'cleanup.reconnect_attempts': ("""UPDATE agents SET reconnect_attempts = reconnect_attempts + 1, last_reconnect = ?
+                                      WHERE active = 0 AND last_seen >= ? AND last_seen < ?""", (0, 0, 0)),
+    'cleanup.reconnect_cutoff': ("""SELECT MAX(last_reconnect) FROM agents
+                                    WHERE active = 0 AND reconnect_attempts > 0""", ()),
+    'cleanup.reconnected': ("UPDATE agents SET reconnect_attempts = 0 WHERE reconnect_attempts > 0 AND active = 1", ()),
+    'cleanup.prune_results': ("""SELECT id, agent_id, output, spilled FROM results
+                                 WHERE timestamp < ? LIMIT ?""", (0, 1)),
+    'cleanup.prune_files': ("""SELECT id, agent_id, direction, filepath, sha256 FROM files
+                               WHERE upload_time < ? LIMIT ?""", (0, 1)),
+    'api.results': ("""SELECT r.id, r.agent_id, a.ip, r.output, r.output_size, r.spilled,
+                       r.timestamp, r.is_file, r.file_path
+                       FROM results r JOIN agents a ON r.agent_id = a.id
+                       ORDER BY r.timestamp DESC, r.id DESC LIMIT ? OFFSET ?""", (10, 0)),
+    'api.results.by_agent': ("""SELECT r.id, r.agent_id, a.ip, r.output, r.output_size, r.spilled,
+                                r.timestamp, r.is_file, r.file_path
+                                FROM results r JOIN agents a ON r.agent_id = a.id
+                                WHERE r.agent_id = ?
+                                ORDER BY r.timestamp DESC, r.id DESC LIMIT ? OFFSET ?""", ('', 10, 0)),
+    'api.files.by_agent_direction': ("""SELECT f.id, f.agent_id, a.ip, f.filename, f.filepath,
+                                               f.size, f.upload_time, f.direction
+                                        FROM files f JOIN agents a ON f.agent_id = a.id
+                                        WHERE f.agent_id = ? AND f.direction = ?
+                                        ORDER BY f.upload_time DESC, f.id DESC LIMIT ? OFFSET ?""",
+                                     ('', 'upload', 10, 0)),
+    'api.files.by_direction': ("""SELECT f.id, f.agent_id, a.ip, f.filename, f.filepath,
+                                         f.size, f.upload_time, f.direction
+                                  FROM files f JOIN agents a ON f.agent_id = a.id
+                                  WHERE f.direction = ?
+                                  ORDER BY f.upload_time DESC, f.id DESC LIMIT ? OFFSET ?""", ('upload', 10, 0)),
+    'api.results.keyset': ("""SELECT r.id, r.agent_id, a.ip, r.output, r.output_size, r.spilled,
+                              r.timestamp, r.is_file, r.file_path
+                              FROM results r JOIN agents a ON r.agent_id = a.id
+                              WHERE (r.timestamp, r.id) < (?, ?)
+                              ORDER BY r.timestamp DESC, r.id DESC LIMIT ?""", (0, 0, 10)),
+    'api.results.by_agent.keyset': ("""SELECT r.id, r.agent_id, a.ip, r.output, r.output_size, r.spilled,
+                                       r.timestamp, r.is_file, r.file_path
+                                       FROM results r JOIN agents a ON r.agent_id = a.id
+                                       WHERE r.agent_id = ? AND (r.timestamp, r.id) < (?, ?)
+                                       ORDER BY r.timestamp DESC, r.id DESC LIMIT ?""", ('', 0, 0, 10)),
+    'api.files.by_agent': ("""SELECT f.id, f.agent_id, a.ip, f.filename, f.filepath,
+                                     f.size, f.upload_time, f.direction
+                              FROM files f JOIN agents a ON f.agent_id = a.id
+                              WHERE f.agent_id = ?
+                              ORDER BY f.upload_time DESC, f.id DESC LIMIT ? OFFSET ?""", ('', 10, 0)),
+    'api.files.keyset': ("""SELECT f.id, f.agent_id, a.ip, f.filename, f.filepath,
+                                   f.size, f.upload_time, f.direction
+                            FROM files f JOIN agents a ON f.agent_id = a.id
+                            WHERE (f.upload_time, f.id) < (?, ?)
+                            ORDER BY f.upload_time DESC, f.id DESC LIMIT ?""", (0, 0, 10)),
+    'api.scheduled': ("""SELECT c.id, c.agent_id, a.ip, c.command, c.timestamp,
+                                c.is_recurring, c.interval_seconds, c.scheduled_time
+                         FROM commands c JOIN agents a ON c.agent_id = a.id
+                         WHERE c.is_scheduled = 1
+                         ORDER BY c.scheduled_time ASC""", ()),
+    'export.results': ("""SELECT id, agent_id, output, output_size, timestamp, is_file, file_path, spilled
+                          FROM results WHERE (timestamp, id) > (?, ?)
+                          ORDER BY timestamp, id LIMIT ?""", (0, 0, 500)),
+    'export.results.by_agent': ("""SELECT id, agent_id, output, output_size, timestamp, is_file, file_path, spilled
+                                   FROM results WHERE (timestamp, id) > (?, ?) AND agent_id = ?
+                                   ORDER BY timestamp, id LIMIT ?""", (0, 0, '', 500)),
+    'export.files.by_agent_direction': ("""SELECT id, agent_id, filename, filepath, size, upload_time, direction, sha256
+                                           FROM files WHERE (upload_time, id) > (?, ?)
+                                           AND agent_id = ? AND direction = ?
+                                           ORDER BY upload_time, id LIMIT ?""", (0, 0, '', 'upload', 500)),
+    'export.commands': ("""SELECT id, agent_id, command, timestamp, is_file, file_path, is_scheduled,
+                                  scheduled_time, is_recurring, interval_seconds, target, delivered
+                           FROM commands WHERE (timestamp, id) > (?, ?)
+                           ORDER BY timestamp, id LIMIT ?""", (0, 0, 500)),
+    'export.commands.by_agent': ("""SELECT id, agent_id, command, timestamp, is_file, file_path, is_scheduled,
+                                           scheduled_time, is_recurring, interval_seconds, target, delivered
+                                    FROM commands WHERE (timestamp, id) > (?, ?) AND agent_id = ?
+                                    ORDER BY timestamp, id LIMIT ?""", (0, 0, '', 500)),
+    'cleanup.expired_transfers': ("""SELECT id, temp_path FROM transfers
+                                     WHERE status = 'open' AND updated < ? LIMIT ?""", (0, 1)),
+}
+
+def find_query_scans(conn, queries=None):
+    problems = []
+    for name, (query, params) in (queries or HOT_QUERIES).items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall():
+            detail = row[3]
+            if (detail.startswith('SCAN') and 'INDEX' not in detail) or detail.startswith('USE TEMP B-TREE'):
+                problems.append((name, detail))
+    return problems
+
+def init_db():
+    with db_pool.connection() as conn:
+        # Only settable before the first table exists; lets maintenance return pages incrementally
+        if not conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")  # empty file, instant; rewrites the header with the new mode
+        migrate_db(conn)
+        for name, detail in find_query_scans(conn):
+            log_event(logging.WARNING, 'query_plan_scan', query=name, plan=detail)
+
+# Pending commands, written through to the commands table. SQLite stays the
+# system of record; the in-memory copy lets an empty check-in return without
+# touching the database and makes the dequeue a single atomic pop.
+class CommandQueue:
+    def __init__(self):
+        self.queues = {}  # agent_id -> deque of pending command dicts, oldest first
+        self.fanouts = {}  # command_id -> {'entry': command dict, 'pending': set of agent_ids}
+        self.agent_fanouts = {}  # agent_id -> sorted ids of the fan-outs still pending for it
+        self.lock = threading.Lock()
+        self.waiting = {}  # agent_id -> [Condition, number of held check-ins]
+        self.watchers = {}  # agent_id -> set of wake callbacks (async check-ins)
+        self.total_waiting = 0
+        self.total = 0  # pending commands across all agents
+
+    def load(self, conn):
+        rows = conn.execute("""SELECT id, agent_id, command, is_file, file_path
+                               FROM commands WHERE is_scheduled = 0 AND target IS NULL AND delivered IS NULL
+                               ORDER BY id""").fetchall()
+        pending = conn.execute("""SELECT c.id, c.command, c.is_file, c.file_path, d.agent_id
+                                  FROM deliveries d JOIN commands c ON c.id = d.command_id
+                                  WHERE d.status = 'pending'""").fetchall()
+        with self.lock:
+            self.queues.clear()
+            for row in rows:
+                self.queues.setdefault(row['agent_id'], deque()).append(self._entry(row))
+            self.fanouts.clear()
+            self.agent_fanouts.clear()
+            for row in sorted(pending, key=lambda r: r['id']):
+                fanout = self.fanouts.get(row['id'])
+                if fanout is None:
+                    fanout = self.fanouts[row['id']] = {'entry': self._entry(row, fanout=True), 'pending': set()}
+                fanout['pending'].add(row['agent_id'])
+                self.agent_fanouts.setdefault(row['agent_id'], []).append(row['id'])
+            self.total = len(rows) + len(pending)
+
+    @staticmethod
+    def _entry(row, fanout=False):
+        entry = {
+            'id': row['id'],
+            'command': row['command'],
+            'is_file': bool(row['is_file']),
+            'file_path': row['file_path'],
+        }
+        if fanout:
+            entry['fanout'] = True
+        return entry
+
+    def _publish(self, agent_id, entry):
+        queue = self.queues.setdefault(agent_id, deque())
+        queue.append(entry)
+        self.total += 1
+        # Concurrent writers can commit out of id order; keep delivery FIFO
+        if len(queue) > 1 and queue[-2]['id'] > entry['id']:
+            self.queues[agent_id] = deque(sorted(queue, key=lambda e: e['id']))
+        self._wake(agent_id)
+
+    def _wake(self, agent_id):
+        # Wake a long-polling check-in for this agent
+        waiter = self.waiting.get(agent_id)
+        if waiter:
+            waiter[0].notify()
+        for wake in self.watchers.get(agent_id, ()):
+            wake()
+
+    def add_batch(self, conn, items, timestamp=None):
+        # items: (agent_id, command, is_file, file_path) tuples, committed together
+        timestamp = time.time() if timestamp is None else timestamp
+        c = conn.cursor()
+        added = []
+        for agent_id, command, is_file, file_path in items:
+            c.execute("""INSERT INTO commands 
+                        (agent_id, command, timestamp, is_file, file_path)
+                        VALUES (?, ?, ?, ?, ?)""",
+                     (agent_id, command, timestamp, 1 if is_file else 0, file_path))
+            added.append((agent_id, {
+                'id': c.lastrowid,
+                'command': command,
+                'is_file': bool(is_file),
+                'file_path': file_path,
+            }))
+        state_backend.publish(conn, 'commands', [[agent_id, entry['id'], entry['command'], entry['is_file'],
+                                                  entry['file_path']] for agent_id, entry in added])
+        conn.commit()
+
+        # Only visible to check-ins once the rows are durable
+        with self.lock:
+            for agent_id, entry in added:
+                self._publish(agent_id, entry)
+        return len(added)
+
+    def add_many(self, conn, agent_ids, command, is_file=False, file_path=None, timestamp=None):
+        return self.add_batch(conn, [(agent_id, command, is_file, file_path) for agent_id in agent_ids],
+                              timestamp)
+
+    def add(self, conn, agent_id, command, is_file=False, file_path=None, timestamp=None):
+        return self.add_many(conn, [agent_id], command, is_file, file_path, timestamp)
+
+    def add_fanout(self, conn, command, is_file=False, file_path=None, tag=None, timestamp=None):
+        # One command row for every recipient; the recipient set is written by a
+        # single INSERT ... SELECT. Returns (command_id, recipient count).
+        timestamp = time.time() if timestamp is None else timestamp
+        c = conn.cursor()
+        c.execute("""INSERT INTO commands
+                    (agent_id, command, timestamp, is_file, file_path, target)
+                    VALUES (NULL, ?, ?, ?, ?, ?)""",
+                  (command, timestamp, 1 if is_file else 0, file_path, '*' if tag is None else tag))
+        command_id = c.lastrowid
+        if tag is None:
+            c.execute("""INSERT INTO deliveries (command_id, agent_id)
+                         SELECT ?, id FROM agents WHERE active = 1""", (command_id,))
+        else:
+            c.execute("""INSERT INTO deliveries (command_id, agent_id)
+                         SELECT ?, t.agent_id FROM agent_tags t JOIN agents a ON a.id = t.agent_id
+                         WHERE t.tag = ? AND a.active = 1""", (command_id, tag))
+        recipients = self._recipients(conn, command_id)
+        state_backend.publish(conn, 'fanout', [command_id, command, bool(is_file), file_path])
+        conn.commit()
+
+        with self.lock:
+            self._publish_fanout({'id': command_id, 'command': command, 'is_file': bool(is_file),
+                                  'file_path': file_path, 'fanout': True}, recipients)
+        return command_id, len(recipients)
+
+    @staticmethod
+    def _recipients(conn, command_id):
+        return {row[0] for row in conn.execute("""SELECT agent_id FROM deliveries
+                                                 WHERE command_id = ? AND status = 'pending'""",
+                                              (command_id,))}
+
+    def _publish_fanout(self, entry, recipients):
+        if not recipients:
+            return
+        self.fanouts[entry['id']] = {'entry': entry, 'pending': recipients}
+        self.total += len(recipients)
+        for agent_id in recipients:
+            bisect.insort(self.agent_fanouts.setdefault(agent_id, []), entry['id'])
+        # Only agents parked in a long poll need a wake-up
+        for agent_id in recipients & (self.waiting.keys() | self.watchers.keys()):
+            self._wake(agent_id)
+
+    def _has_pending(self, agent_id):
+        return bool(self.queues.get(agent_id)) or agent_id in self.agent_fanouts
+
+    def pop(self, agent_id, wait=0):
+        with self.lock:
+            if wait > 0 and self.total_waiting < LONG_POLL_MAX_WAITERS and not self._has_pending(agent_id):
+                self._wait(agent_id, wait)
+            queue = self.queues.get(agent_id)
+            # Oldest of the agent's own queue head and the fan-outs still addressed to it
+            fanout_ids = self.agent_fanouts.get(agent_id)
+            fanout = self.fanouts[fanout_ids[0]] if fanout_ids else None
+            if fanout and (not queue or fanout['entry']['id'] < queue[0]['id']):
+                self._settle_fanout(fanout, agent_id)
+                return fanout['entry']
+            if not queue:
+                return None
+            entry = queue.popleft()
+            self.total -= 1
+            if not queue:
+                del self.queues[agent_id]
+            return entry
+
+    def _settle_fanout(self, fanout, agent_id):
+        fanout['pending'].discard(agent_id)
+        self.total -= 1
+        self._unindex_fanout(agent_id, fanout['entry']['id'])
+        if not fanout['pending']:
+            del self.fanouts[fanout['entry']['id']]
+
+    def _unindex_fanout(self, agent_id, command_id):
+        fanout_ids = self.agent_fanouts.get(agent_id)
+        if not fanout_ids:
+            return
+        i = bisect.bisect_left(fanout_ids, command_id)
+        if i < len(fanout_ids) and fanout_ids[i] == command_id:
+            del fanout_ids[i]
+        if not fanout_ids:
+            del self.agent_fanouts[agent_id]
+
+    def _wait(self, agent_id, timeout):
+        # Called with self.lock held; the per-agent condition shares that lock
+        waiter = self.waiting.get(agent_id)
+        if waiter is None:
+            waiter = self.waiting[agent_id] = [threading.Condition(self.lock), 0]
+        waiter[1] += 1
+        self.total_waiting += 1
+        try:
+            deadline = time.monotonic() + timeout
+            while not self._has_pending(agent_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                waiter[0].wait(remaining)
+        finally:
+            waiter[1] -= 1
+            self.total_waiting -= 1
+            if not waiter[1]:
+                del self.waiting[agent_id]
+
+    def receive(self, items):
+        # Commands queued by another worker; ids already held here are skipped
+        with self.lock:
+            for agent_id, command_id, command, is_file, file_path in items:
+                if any(e['id'] == command_id for e in self.queues.get(agent_id, ())):
+                    continue
+                self._publish(agent_id, {
+                    'id': command_id,
+                    'command': command,
+                    'is_file': bool(is_file),
+                    'file_path': file_path,
+                })
+
+    def receive_fanout(self, conn, item):
+        # Fan-out queued by another worker; recipients are read from its delivery rows
+        command_id, command, is_file, file_path = item
+        recipients = self._recipients(conn, command_id)
+        with self.lock:
+            if command_id in self.fanouts:
+                return
+            self._publish_fanout({'id': command_id, 'command': command, 'is_file': bool(is_file),
+                                  'file_path': file_path, 'fanout': True}, recipients)
+
+    def drop_fanout(self, command_id):
+        # Pruned fan-out: forget any recipients that never checked in
+        with self.lock:
+            fanout = self.fanouts.pop(command_id, None)
+            if fanout:
+                self.total -= len(fanout['pending'])
+                for agent_id in fanout['pending']:
+                    self._unindex_fanout(agent_id, command_id)
+
+    def discard(self, agent_id, command_id):
+        # Delivered by another worker
+        with self.lock:
+            fanout = self.fanouts.get(command_id)
+            if fanout:
+                if agent_id in fanout['pending']:
+                    self._settle_fanout(fanout, agent_id)
+                return
+            queue = self.queues.get(agent_id)
+            if not queue:
+                return
+            for entry in queue:
+                if entry['id'] == command_id:
+                    queue.remove(entry)
+                    self.total -= 1
+                    break
+            if not queue:
+                del self.queues[agent_id]
+
+    def watch(self, agent_id, wake):
+        # Non-blocking counterpart of _wait: wake() is called when a command is queued
+        with self.lock:
+            if self.total_waiting >= LONG_POLL_MAX_WAITERS:
+                return False
+            self.watchers.setdefault(agent_id, set()).add(wake)
+            self.total_waiting += 1
+            return True
+
+    def unwatch(self, agent_id, wake):
+        with self.lock:
+            watchers = self.watchers.get(agent_id)
+            if watchers and wake in watchers:
+                watchers.discard(wake)
+                self.total_waiting -= 1
+                if not watchers:
+                    del self.watchers[agent_id]
+
+    def pending(self, agent_id=None):
+        with self.lock:
+            if agent_id is not None:
+                return len(self.queues.get(agent_id, ())) + len(self.agent_fanouts.get(agent_id, ()))
+            return self.total
+
+# Row totals for the dashboard list endpoints, kept current on insert and
+# delete so paginated responses never run COUNT(*). Every change is applied
+# to each filter combination the endpoints accept, e.g. ('files', None,
+# 'upload') or ('results', agent_id).
+class RowCounters:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def load(self, conn):
+        counts = {}
+
+        def bump(keys, n):
+            for key in keys:
+                counts[key] = counts.get(key, 0) + n
+
+        for row in conn.execute("SELECT agent_id, COUNT(*) FROM results GROUP BY agent_id"):
+            bump(self._result_keys(row[0]), row[1])
+        for row in conn.execute("SELECT agent_id, direction, COUNT(*) FROM files GROUP BY agent_id, direction"):
+            bump(self._file_keys(row[0], row[1]), row[2])
+        with self.lock:
+            self.counts = counts
+        table_versions.bump(('results', 'files'))
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), n] for key, n in self.counts.items()]
+
+    def restore(self, snapshot):
+        with self.lock:
+            self.counts = {tuple(key): n for key, n in snapshot}
+        table_versions.bump(('results', 'files'))
+
+    @staticmethod
+    def _result_keys(agent_id):
+        return [('results',), ('results', agent_id)]
+
+    @staticmethod
+    def _file_keys(agent_id, direction):
+        if agent_id is None:
+            # Broadcast uploads have no agent and never appear in the listings
+            return []
+        return [('files', None, None), ('files', agent_id, None),
+                ('files', None, direction), ('files', agent_id, direction)]
+
+    def _add(self, keys, n):
+        with self.lock:
+            for key in keys:
+                value = self.counts.get(key, 0) + n
+                if value > 0:
+                    self.counts[key] = value
+                else:
+                    self.counts.pop(key, None)
+        # Totals are applied after the commit that bumped the table; bump again
+        # so a response cached in between is not kept with the old total
+        table_versions.bump({key[0] for key in keys})
+
+    def result_added(self, agent_id, n=1):
+        self._add(self._result_keys(agent_id), n)
+
+    def file_added(self, agent_id, direction, n=1):
+        self._add(self._file_keys(agent_id, direction), n)
+
+    def results(self, agent_id=None):
+        key = ('results', agent_id) if agent_id else ('results',)
+        with self.lock:
+            return self.counts.get(key, 0)
+
+    def files(self, agent_id=None, direction=None):
+        with self.lock:
+            return self.counts.get(('files', agent_id or None, direction or None), 0)
+
+# Count and sum of events over a sliding time window, kept in a ring of
+# fixed-width buckets. Reads and writes only clear the buckets time has moved
+# past, so both are O(1) amortized.
+class SlidingWindow:
+    def __init__(self, window, bucket):
+        self.bucket = bucket
+        self.size = int(window // bucket)
+        self.counts = [0] * self.size
+        self.sums = [0] * self.size
+        self.head = int(time.time() // bucket)  # newest bucket index
+        self.count = 0
+        self.total = 0
+
+    def _advance(self, index):
+        if index <= self.head:
+            return
+        if index - self.head >= self.size:
+            self.counts = [0] * self.size
+            self.sums = [0] * self.size
+            self.count = self.total = 0
+        else:
+            for i in range(self.head + 1, index + 1):
+                slot = i % self.size
+                self.count -= self.counts[slot]
+                self.total -= self.sums[slot]
+                self.counts[slot] = self.sums[slot] = 0
+        self.head = index
+
+    def add(self, timestamp, value=0, n=1):
+        self._advance(int(time.time() // self.bucket))
+        index = int(timestamp // self.bucket)
+        if index <= self.head - self.size or index > self.head:
+            return
+        slot = index % self.size
+        self.counts[slot] += n
+        self.sums[slot] += value
+        self.count += n
+        self.total += value
+
+    def read(self):
+        self._advance(int(time.time() // self.bucket))
+        return self.count, self.total
+
+# Rolling counters behind /api/stats. Updated as results and files are
+# recorded and rebuilt from SQLite every STATS_RECONCILE_INTERVAL to correct
+# any drift; point-in-time figures come from the live structures directly.
+# A rebuild reads the windows and the highest row ids in one snapshot; rows
+# recorded while it reads are logged and replayed onto the new windows if
+# they are newer than the snapshot, and skipped afterwards if they are not.
+class LiveStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reconcile_lock = threading.Lock()  # one rebuild at a time (maintenance, backend resync)
+        self.results = SlidingWindow(3600, 60)
+        self.transfers = {
+            'upload': SlidingWindow(86400, 300),
+            'download': SlidingWindow(86400, 300),
+        }
+        self.high_water = {'results': 0, 'files': 0}  # newest row id counted by the last rebuild
+        self.replay = None  # (table, row id, args) recorded during a rebuild
+        self.reconciled = 0
+
+    def result_added(self, result_id, timestamp):
+        self._add('results', result_id, (timestamp,))
+
+    def file_added(self, file_id, direction, size, timestamp):
+        self._add('files', file_id, (timestamp, size or 0, direction))
+
+    def _add(self, table, row_id, args):
+        with self.lock:
+            if self.replay is not None:
+                self.replay.append((table, row_id, args))
+            if row_id > self.high_water[table]:
+                self._apply(self.results, self.transfers, table, args)
+
+    @staticmethod
+    def _apply(results, transfers, table, args):
+        if table == 'results':
+            results.add(args[0])
+        elif args[2] in transfers:
+            transfers[args[2]].add(args[0], args[1])
+
+    def due(self):
+        return time.time() - self.reconciled >= STATS_RECONCILE_INTERVAL
+
+    def reconcile(self, conn):
+        with self.reconcile_lock:
+            self._reconcile(conn)
+
+    def _reconcile(self, conn):
+        with self.lock:
+            self.replay = []
+        now = time.time()
+        results = SlidingWindow(3600, 60)
+        conn.execute("BEGIN")  # one read snapshot for the windows and high-water ids
+        high_water = {table: conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                      for table in ('results', 'files')}
+        for row in conn.execute("""SELECT CAST(timestamp / 60 AS INTEGER) AS bucket, COUNT(*)
+                                   FROM results WHERE timestamp > ? GROUP BY bucket""", (now - 3600,)):
+            results.add(row[0] * 60, 0, row[1])
+        transfers = {direction: SlidingWindow(86400, 300) for direction in self.transfers}
+        for direction, window in transfers.items():
+            for row in conn.execute("""SELECT CAST(upload_time / 300 AS INTEGER) AS bucket, COUNT(*), SUM(size)
+                                       FROM files WHERE direction = ? AND upload_time > ?
+                                       GROUP BY bucket""", (direction, now - 86400)):
+                window.add(row[0] * 300, row[2] or 0, row[1])
+        conn.commit()
+        with self.lock:
+            for table, row_id, args in self.replay:
+                if row_id > high_water[table]:
+                    self._apply(results, transfers, table, args)
+            self.replay = None
+            self.results = results
+            self.transfers = transfers
+            self.high_water = high_water
+            self.reconciled = now
+
+    def snapshot(self):
+        with self.lock:
+            recent_results, _ = self.results.read()
+            uploads, upload_bytes = self.transfers['upload'].read()
+            downloads, download_bytes = self.transfers['download'].read()
+        return {
+            'active_agents': len(heartbeats.last_seen),
+            'recent_results': recent_results,
+            'pending_commands': command_queue.pending(),
+            'scheduled_tasks': len(scheduler.jobs),
+            'uploads_last_24h': uploads,
+            'downloads_last_24h': downloads,
+            'upload_volume_mb': round(upload_bytes / (1024 * 1024), 2),
+            'download_volume_mb': round(download_bytes / (1024 * 1024), 2),
+            'timestamp': time.time()
+        }
+
+# In-memory caches for performance
+active_agents = set()
+command_queue = CommandQueue()
+row_counters = RowCounters()
+live_stats = LiveStats()
+
+# Hot tier for /api/results: the newest results in a global ring plus one
+# ring per recently active agent, each ordered by (timestamp, id). A ring
+# always holds every result newer than its oldest entry, so a page is served
+# from memory when the ring reaches past it or holds the agent's whole count;
+# anything older, and all searches, go to SQLite.
+class CachedResult:
+    __slots__ = ('id', 'agent_id', 'ip', 'output', 'output_size', 'spilled', 'timestamp', 'is_file', 'file_path')
+
+    def __init__(self, id, agent_id, ip, output, output_size, spilled, timestamp, is_file, file_path):
+        self.id = id
+        self.agent_id = agent_id
+        self.ip = ip
+        self.output = output
+        self.output_size = output_size
+        self.spilled = spilled
+        self.timestamp = timestamp
+        self.is_file = is_file
+        self.file_path = file_path
+
+    def __getitem__(self, key):
+        # Reads like a sqlite3.Row in result_json()
+        return getattr(self, key)
+
+    def key(self):
+        return (self.timestamp, self.id)
+
+class ResultCache:
+    def __init__(self, size=RESULT_CACHE_SIZE, per_agent=RESULT_CACHE_PER_AGENT, max_agents=RESULT_CACHE_AGENTS):
+        self.size = size
+        self.per_agent = per_agent
+        self.max_agents = max_agents
+        self.recent = deque()  # oldest first
+        self.agents = OrderedDict()  # agent_id -> deque, least recently written first
+        self.ips = {}  # agent_id -> ip, for agents known to the agents table
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'added': 0,
+        }
+
+    def load(self, conn):
+        rows = conn.execute("""SELECT r.id, r.agent_id, a.ip, r.output, r.output_size, r.spilled,
+                                      r.timestamp, r.is_file, r.file_path
+                               FROM results r JOIN agents a ON r.agent_id = a.id
+                               ORDER BY r.timestamp DESC, r.id DESC LIMIT ?""", (self.size,)).fetchall()
+        with self.lock:
+            self.recent.clear()
+            self.agents.clear()
+            for row in reversed(rows):
+                record = CachedResult(row['id'], row['agent_id'], row['ip'], row['output'], row['output_size'],
+                                      bool(row['spilled']), row['timestamp'], bool(row['is_file']), row['file_path'])
+                self.ips[record.agent_id] = record.ip
+                self.recent.append(record)
+                # Rings filled oldest first keep their newest results, so stay contiguous
+                self._insert(self._agent_ring(record.agent_id), record, self.per_agent)
+
+    def agent_registered(self, agent_id, ip):
+        with self.lock:
+            self.ips[agent_id] = ip
+
+    def add(self, result_id, agent_id, output, is_file, file_path, timestamp):
+        ip = self.ips.get(agent_id)
+        if ip is None:
+            with db_pool.connection() as conn:
+                row = conn.execute("SELECT ip FROM agents WHERE id = ?", (agent_id,)).fetchone()
+            if row is None:
+                return  # hidden from /api/results by its join on agents
+            ip = row['ip']
+        # Same inline/spilled split as pack_output()
+        spilled = len(output) > RESULT_COMPRESS_THRESHOLD
+        record = CachedResult(result_id, agent_id, ip, output[:RESULT_PREVIEW_CHARS] if spilled else output,
+                              len(output), spilled, timestamp, bool(is_file), file_path)
+        with self.lock:
+            self.ips[agent_id] = ip
+            self.stats['added'] += 1
+            self._insert(self.recent, record, self.size)
+            self._insert(self._agent_ring(agent_id), record, self.per_agent)
+
+    def _agent_ring(self, agent_id):
+        ring = self.agents.get(agent_id)
+        if ring is None:
+            ring = self.agents[agent_id] = deque()
+            if len(self.agents) > self.max_agents:
+                self.agents.popitem(last=False)
+        else:
+            self.agents.move_to_end(agent_id)
+        return ring
+
+    @staticmethod
+    def _insert(ring, record, limit):
+        key = record.key()
+        if not ring or key >= ring[-1].key():
+            ring.append(record)
+        elif key > ring[0].key():
+            # Committed out of timestamp order; rare, and the rings are short
+            ring.insert(bisect.bisect(list(ring), key, key=CachedResult.key), record)
+        else:
+            # Older than the ring reaches; the ring stays contiguous without it
+            return
+        while len(ring) > limit:
+            ring.popleft()
+
+    def expire(self, cutoff):
+        # Drop what the retention prune deleted
+        with self.lock:
+            for ring in [self.recent, *self.agents.values()]:
+                while ring and ring[0].timestamp < cutoff:
+                    ring.popleft()
+
+    def page(self, agent_id, total, per_page, offset=0, before=None):
+        # Newest-first records for the page, or None when SQLite has to answer.
+        # before: a (timestamp, id) cursor key; offset counts from there.
+        if state_backend.name != 'local':
+            return None  # other workers' results never reach this cache
+        with self.lock:
+            ring = self.agents.get(agent_id) if agent_id else self.recent
+            records = None
+            if ring is not None and (before is None or (ring and tuple(before) >= ring[0].key())):
+                newest = reversed(ring)
+                skipped = 0
+                if before is not None:
+                    for record in reversed(ring):
+                        if record.key() < tuple(before):
+                            break
+                        skipped += 1
+                available = len(ring) - skipped - offset
+                # Complete when the ring holds every result, even if the page runs short
+                if available >= per_page or len(ring) >= total:
+                    records = list(itertools.islice(newest, skipped + offset, skipped + offset + per_page))
+            self.stats['hits' if records is not None else 'misses'] += 1
+            return records
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats,
+                        recent=len(self.recent),
+                        agent_rings=len(self.agents),
+                        agent_records=sum(len(ring) for ring in self.agents.values()),
+                        size=self.size,
+                        per_agent=self.per_agent,
+                        max_agents=self.max_agents)
+
+result_cache = ResultCache()
+
+# Agent heartbeats. Check-ins only touch the live last_seen map; a flusher
+# thread writes the dirty entries back in one executemany transaction every
+# HEARTBEAT_FLUSH_INTERVAL_MS or HEARTBEAT_BATCH_SIZE entries.
+class HeartbeatBuffer:
+    def __init__(self, interval_ms=HEARTBEAT_FLUSH_INTERVAL_MS, batch_size=HEARTBEAT_BATCH_SIZE):
+        self.interval = interval_ms / 1000.0
+        self.batch_size = batch_size
+        self.last_seen = {}  # agent_id -> last check-in time, for every live agent
+        self.dirty = {}  # agent_id -> check-in time not yet written to SQLite
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.stats = {
+            'flushes': 0,
+            'rows_flushed': 0,
+            'rows_last_flush': 0,
+            'rows_max_flush': 0,
+            'flush_errors': 0,
+            'flush_time_total': 0.0,
+            'flush_time_last': 0.0,
+            'flush_time_max': 0.0,
+        }
+
+    def load(self, conn):
+        rows = conn.execute("SELECT id, last_seen FROM agents WHERE active = 1").fetchall()
+        with self.lock:
+            self.last_seen = {row['id']: row['last_seen'] for row in rows}
+
+    def seen(self, agent_id, timestamp):
+        # Agent already persisted with this timestamp (register)
+        with self.lock:
+            self.last_seen[agent_id] = timestamp
+
+    def beat(self, agent_id):
+        now = time.time()
+        with self.lock:
+            new = agent_id not in self.last_seen
+            self.last_seen[agent_id] = now
+            self.dirty[agent_id] = now
+            full = len(self.dirty) >= self.batch_size
+        agent_registry.touch(agent_id, now)
+        if new:
+            # The live agent count is part of the /api/agents response
+            table_versions.bump(('agents',))
+        if full:
+            self.wakeup.set()
+        return now
+
+    def evict(self, agent_ids, cutoff):
+        # Forget agents that timed out, unless they checked in since the flush
+        evicted = []
+        with self.lock:
+            for agent_id in agent_ids:
+                if self.last_seen.get(agent_id, 0) < cutoff and agent_id not in self.dirty:
+                    self.last_seen.pop(agent_id, None)
+                    evicted.append(agent_id)
+        if evicted:
+            table_versions.bump(('agents',))
+        return evicted
+
+    def sync(self, conn, cutoff):
+        # Merge check-ins other workers flushed, and drop agents timed out elsewhere
+        rows = conn.execute("SELECT id, last_seen FROM agents WHERE active = 1").fetchall()
+        added = []
+        removed = []
+        with self.lock:
+            live = set()
+            for row in rows:
+                live.add(row['id'])
+                if row['id'] not in self.last_seen:
+                    added.append(row['id'])
+                if row['last_seen'] > self.last_seen.get(row['id'], 0):
+                    self.last_seen[row['id']] = row['last_seen']
+            for agent_id in list(self.last_seen):
+                if agent_id not in live and agent_id not in self.dirty and self.last_seen[agent_id] < cutoff:
+                    del self.last_seen[agent_id]
+                    removed.append(agent_id)
+        if added or removed:
+            table_versions.bump(('agents',))
+        return added, removed
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return 0
+                batch, self.dirty = self.dirty, {}
+
+            start = time.monotonic()
+            try:
+                with db_pool.connection() as conn:
+                    conn.executemany("UPDATE agents SET last_seen = ?, active = 1 WHERE id = ?",
+                                     [(seen, agent_id) for agent_id, seen in batch.items()])
+                    conn.commit()
+            except Exception:
+                # Put the batch back without clobbering newer check-ins
+                with self.lock:
+                    for agent_id, seen in batch.items():
+                        if self.dirty.get(agent_id, 0) < seen:
+                            self.dirty[agent_id] = seen
+                    self.stats['flush_errors'] += 1
+                raise
+            elapsed = time.monotonic() - start
+
+            with self.lock:
+                self.stats['flushes'] += 1
+                self.stats['rows_flushed'] += len(batch)
+                self.stats['rows_last_flush'] = len(batch)
+                self.stats['rows_max_flush'] = max(self.stats['rows_max_flush'], len(batch))
+                self.stats['flush_time_total'] += elapsed
+                self.stats['flush_time_last'] = elapsed
+                self.stats['flush_time_max'] = max(self.stats['flush_time_max'], elapsed)
+            return len(batch)
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log_event(logging.ERROR, 'heartbeat_flush_error', error=str(e))
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.flush()
+
+    def metrics(self):
+        with self.lock:
+            flushes = self.stats['flushes']
+            return {
+                'flush_interval_ms': self.interval * 1000,
+                'batch_size': self.batch_size,
+                'live_agents': len(self.last_seen),
+                'dirty': len(self.dirty),
+                'flushes': flushes,
+                'flush_errors': self.stats['flush_errors'],
+                'rows_flushed': self.stats['rows_flushed'],
+                'rows_last_flush': self.stats['rows_last_flush'],
+                'rows_max_flush': self.stats['rows_max_flush'],
+                'rows_avg_flush': round(self.stats['rows_flushed'] / flushes, 2) if flushes else 0,
+                'flush_time_last_ms': round(self.stats['flush_time_last'] * 1000, 3),
+                'flush_time_max_ms': round(self.stats['flush_time_max'] * 1000, 3),
+                'flush_time_avg_ms': round(self.stats['flush_time_total'] / flushes * 1000, 3) if flushes else 0,
+            }
+
+heartbeats = HeartbeatBuffer()
+
+# Agent registry: every agents row in memory as a compact record, with
+# secondary indexes for the /api/agents filters: active/inactive id sets and
+# sorted (key, rowid) lists by last_seen and by IP, where an address or a
+# whole subnet is one bisect range. agents stays the system of record; the
+# registry follows registrations, check-ins and maintenance transitions, and
+# is re-read whole at startup and on a backend resync.
+AGENT_STATUSES = ('active', 'reconnecting', 'lost')  # lost: inactive past RECONNECT_TRACK_WINDOW
+
+def parse_info(info):
+    # Fields of an agent's info string: a JSON object, or key=value pairs
+    # separated by ';', ',' or whitespace. Free text has none.
+    info = (info or '').strip()
+    if info.startswith('{'):
+        try:
+            data = json.loads(info)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            return {str(key).lower(): str(value) for key, value in data.items()
+                    if not isinstance(value, (dict, list))}
+    fields = {}
+    for part in re.split(r'[;,\s]+', info):
+        key, sep, value = part.partition('=')
+        if sep and key:
+            fields[key.lower()] = value
+    return fields
+
+def ip_order(address):
+    # One integer per address, IPv4 below IPv6; -1 for anything unparseable
+    if not isinstance(address, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return -1
+    return int(address) + (1 << 128 if address.version == 6 else 0)
+
+class AgentRecord:
+    __slots__ = ('id', 'rowid', 'ip', 'ip_order', 'info', 'fields', 'last_seen', 'active',
+                 'reconnect_attempts', 'last_reconnect')
+
+    def __init__(self, rowid, id, ip, info, last_seen, active, reconnect_attempts=0, last_reconnect=None):
+        self.id = id
+        self.rowid = rowid
+        self.ip = ip
+        self.ip_order = ip_order(ip)
+        self.info = info
+        self.fields = parse_info(info)
+        self.last_seen = last_seen or 0
+        self.active = bool(active)
+        self.reconnect_attempts = reconnect_attempts or 0
+        self.last_reconnect = last_reconnect
+
+    def status(self, now):
+        if self.active:
+            return 'active'
+        return 'reconnecting' if self.last_seen >= now - RECONNECT_TRACK_WINDOW else 'lost'
+
+class AgentRegistry:
+    SORT_KEYS = {
+        'last_seen': lambda record: (record.last_seen, record.rowid),
+        'ip': lambda record: (record.ip_order, record.rowid),
+        'reconnect_attempts': lambda record: (record.reconnect_attempts, record.rowid),
+    }
+
+    def __init__(self):
+        self.records = {}  # agent_id -> AgentRecord
+        self.by_rowid = {}  # rowid -> AgentRecord
+        self.active = set()
+        self.inactive = set()
+        self.by_seen = []  # sorted (last_seen, rowid)
+        self.by_ip = []  # sorted (ip_order, rowid)
+        self.lock = threading.Lock()
+        self.stats = {
+            'queries': 0,
+            'walked': 0,
+            'sorted': 0,
+        }
+
+    def load(self, conn):
+        rows = conn.execute("""SELECT rowid, id, ip, info, last_seen, active, reconnect_attempts, last_reconnect
+                               FROM agents""").fetchall()
+        with heartbeats.lock:
+            live = dict(heartbeats.last_seen)
+        records = []
+        for row in rows:
+            record = AgentRecord(*row)
+            # Check-ins not yet flushed are newer than the row
+            if record.id in live:
+                record.last_seen = max(record.last_seen, live[record.id])
+                record.active = True
+            records.append(record)
+        with self.lock:
+            self.records = {record.id: record for record in records}
+            self.by_rowid = {record.rowid: record for record in records}
+            self.active = {record.id for record in records if record.active}
+            self.inactive = {record.id for record in records if not record.active}
+            self.by_seen = sorted(self.SORT_KEYS['last_seen'](record) for record in records)
+            self.by_ip = sorted(self.SORT_KEYS['ip'](record) for record in records)
+
+    def refresh(self, conn, agent_ids):
+        # Agents another worker registered or brought back
+        for agent_id in agent_ids:
+            row = conn.execute("""SELECT rowid, id, ip, info, last_seen, active, reconnect_attempts, last_reconnect
+                                  FROM agents WHERE id = ?""", (agent_id,)).fetchone()
+            if row is not None:
+                self.add(AgentRecord(*row))
+
+    def add(self, record):
+        with self.lock:
+            old = self.records.get(record.id)
+            if old is not None:
+                self._unindex(old)
+            self.records[record.id] = record
+            self.by_rowid[record.rowid] = record
+            (self.active if record.active else self.inactive).add(record.id)
+            bisect.insort(self.by_seen, (record.last_seen, record.rowid))
+            bisect.insort(self.by_ip, (record.ip_order, record.rowid))
+
+    def _unindex(self, record):
+        for index, key in ((self.by_seen, (record.last_seen, record.rowid)),
+                           (self.by_ip, (record.ip_order, record.rowid))):
+            i = bisect.bisect_left(index, key)
+            if i < len(index) and index[i] == key:
+                del index[i]
+        self.active.discard(record.id)
+        self.inactive.discard(record.id)
+
+    def has(self, agent_id):
+        with self.lock:
+            return agent_id in self.records
+
+    def touch(self, agent_id, timestamp):
+        # Check-in: newest last_seen, so the key moves to (or near) the end
+        with self.lock:
+            record = self.records.get(agent_id)
+            if record is None:
+                return
+            i = bisect.bisect_left(self.by_seen, (record.last_seen, record.rowid))
+            if i < len(self.by_seen) and self.by_seen[i] == (record.last_seen, record.rowid):
+                del self.by_seen[i]
+            record.last_seen = timestamp
+            bisect.insort(self.by_seen, (timestamp, record.rowid))
+            if not record.active:
+                record.active = True
+                self.inactive.discard(agent_id)
+                self.active.add(agent_id)
+
+    def follow(self, conn, live):
+        # Check-ins merged from other workers (agent_id -> last_seen); rows are
+        # read for agents this worker has never seen
+        unknown = []
+        for agent_id, seen in live.items():
+            with self.lock:
+                record = self.records.get(agent_id)
+                current = record is not None and record.active and record.last_seen >= seen
+            if record is None:
+                unknown.append(agent_id)
+            elif not current:
+                self.touch(agent_id, max(seen, record.last_seen))
+        self.refresh(conn, unknown)
+
+    def deactivate(self, agent_ids):
+        with self.lock:
+            for agent_id in agent_ids:
+                record = self.records.get(agent_id)
+                if record is not None and record.active:
+                    record.active = False
+                    self.active.discard(agent_id)
+                    self.inactive.add(agent_id)
+
+    def count_reconnects(self, since, cutoff, now):
+        # Mirrors the cleanup UPDATE: inactive agents last seen in [since, cutoff),
+        # the agents that crossed the timeout since the previous pass
+        with self.lock:
+            start = bisect.bisect_left(self.by_seen, (since,))
+            end = bisect.bisect_left(self.by_seen, (cutoff,))
+            for _, rowid in self.by_seen[start:end]:
+                record = self.by_rowid[rowid]
+                if not record.active:
+                    record.reconnect_attempts += 1
+                    record.last_reconnect = now
+
+    def reset_reconnects(self):
+        # Mirrors the cleanup UPDATE for agents that came back
+        with self.lock:
+            for agent_id in self.active:
+                self.records[agent_id].reconnect_attempts = 0
+
+    def query(self, status='active', network=None, info=None, fields=None, seen_after=None, seen_before=None,
+              agent_ids=None, sort='last_seen', descending=True, offset=0, limit=20, after=None):
+        # (page of records, total matches). network: (low, high) ip_order
+        # range; agent_ids: ids from another index (tags); after: the sort key
+        # of the previous page's last record.
+        now = time.time()
+        if status == 'reconnecting':
+            seen_after = max(seen_after or 0, now - RECONNECT_TRACK_WINDOW)
+        elif status == 'lost':
+            seen_before = min(now if seen_before is None else seen_before, now - RECONNECT_TRACK_WINDOW)
+        info = info.lower() if info else None
+        sort_key = self.SORT_KEYS[sort]
+
+        with self.lock:
+            self.stats['queries'] += 1
+            pools = []
+            if status == 'active':
+                pools.append(self.active)
+            elif status != 'all':
+                pools.append(self.inactive)
+            if agent_ids is not None:
+                pools.append(agent_ids)
+            if network is not None:
+                pools.append(self._range(self.by_ip, network[0], network[1] + 1))
+            if seen_after is not None or seen_before is not None:
+                pools.append(self._range(self.by_seen, seen_after, seen_before))
+            candidates = min(pools, key=len) if pools else self.records
+
+            def matches(record):
+                if status == 'active' and not record.active or status not in ('active', 'all') and record.active:
+                    return False
+                if network is not None and not network[0] <= record.ip_order <= network[1]:
+                    return False
+                if seen_after is not None and record.last_seen < seen_after:
+                    return False
+                if seen_before is not None and record.last_seen >= seen_before:
+                    return False
+                if agent_ids is not None and record.id not in agent_ids:
+                    return False
+                if info and info not in (record.info or '').lower():
+                    return False
+                return not fields or all(record.fields.get(key) == value for key, value in fields.items())
+
+            indexed = not pools or len(pools) == 1 and (candidates is self.active or candidates is self.inactive)
+            if indexed and not info and not fields:
+                matched = candidates  # the status index alone answers the filter
+            else:
+                matched = {record.id for record in map(self._record, candidates) if record and matches(record)}
+
+            index = {'last_seen': self.by_seen, 'ip': self.by_ip}.get(sort)
+            if index is not None and len(matched) * 4 >= len(index):
+                # Dense match: walk the sorted index and stop at the end of the page
+                self.stats['walked'] += 1
+                if descending:
+                    start = bisect.bisect_left(index, tuple(after)) if after else len(index)
+                    positions = range(start - 1, -1, -1)
+                else:
+                    start = bisect.bisect_right(index, tuple(after)) if after else 0
+                    positions = range(start, len(index))
+                page = []
+                skip = offset
+                for i in positions:
+                    record = self.by_rowid[index[i][1]]
+                    if record.id not in matched:
+                        continue
+                    if skip:
+                        skip -= 1
+                        continue
+                    page.append(record)
+                    if len(page) >= limit:
+                        break
+            else:
+                self.stats['sorted'] += 1
+                records = [self.records[agent_id] for agent_id in matched]
+                if after:
+                    after = tuple(after)
+                    records = [r for r in records if (sort_key(r) < after if descending else sort_key(r) > after)]
+                records.sort(key=sort_key, reverse=descending)
+                page = records[offset:offset + limit]
+            return page, len(matched)
+
+    def _record(self, item):
+        # Candidate pools hold agent ids, except sorted-index ranges which hold keys
+        return self.records.get(item) if isinstance(item, str) else self.by_rowid.get(item[1])
+
+    @staticmethod
+    def _range(index, low, high):
+        start = bisect.bisect_left(index, (low,)) if low is not None else 0
+        end = bisect.bisect_left(index, (high,)) if high is not None else len(index)
+        return index[start:end]
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, agents=len(self.records), active=len(self.active), inactive=len(self.inactive))
+
+agent_registry = AgentRegistry()
+
+# Scheduler. Scheduled commands are rows in the commands table with
+# is_scheduled = 1 and scheduled_time holding the next fire time, so jobs
+# survive a restart. In memory they sit in a heap keyed by deadline; cancel and
+# reschedule bump the job version and stale heap entries are skipped lazily.
+class CommandScheduler:
+    def __init__(self, batch_size=SCHEDULER_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.heap = []  # (due, job_id, version)
+        self.jobs = {}  # job_id (commands.id) -> job dict
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.active = False  # fires jobs only while this process holds the scheduler role
+        self.stopped = False
+        self.stats = {
+            'fired': 0,
+            'batches': 0,
+            'errors': 0,
+            'lag_last': 0.0,
+            'lag_max': 0.0,
+        }
+
+    def load(self, conn):
+        rows = conn.execute("""SELECT id, agent_id, command, timestamp, scheduled_time,
+                                      is_recurring, interval_seconds
+                               FROM commands WHERE is_scheduled = 1""").fetchall()
+        with self.lock:
+            self.heap = []
+            self.jobs = {}
+            for row in rows:
+                self._push(self._job(row))
+
+    @staticmethod
+    def _job(row, version=0):
+        return {
+            'id': row['id'],
+            'agent_id': row['agent_id'],
+            'command': row['command'],
+            'due': row['scheduled_time'] or row['timestamp'],
+            'recurring': bool(row['is_recurring']),
+            'interval': row['interval_seconds'],
+            'version': version,
+        }
+
+    def refresh(self, conn, job_ids):
+        # Re-read jobs another worker added, changed, fired or cancelled
+        for job_id in job_ids:
+            row = conn.execute("""SELECT id, agent_id, command, timestamp, scheduled_time,
+                                         is_recurring, interval_seconds
+                                  FROM commands WHERE id = ? AND is_scheduled = 1""", (job_id,)).fetchone()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if row is None:
+                    self.jobs.pop(job_id, None)
+                else:
+                    self._push(self._job(row, job['version'] if job else 0))
+
+    def set_active(self, active, conn=None):
+        # A new leader reloads from SQLite; jobs may have changed while it followed
+        if active and conn is not None:
+            self.load(conn)
+        with self.lock:
+            self.active = active
+            self.wakeup.notify()
+
+    def _push(self, job):
+        # Called with self.lock held
+        job['version'] += 1
+        self.jobs[job['id']] = job
+        heapq.heappush(self.heap, (job['due'], job['id'], job['version']))
+        if self.heap[0][1] == job['id']:
+            self.wakeup.notify()
+        # Drop stale entries once they outnumber live ones
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.jobs):
+            self.heap = [(j['due'], j['id'], j['version']) for j in self.jobs.values()]
+            heapq.heapify(self.heap)
+
+    def _stale(self, entry):
+        job = self.jobs.get(entry[1])
+        return job is None or job['version'] != entry[2]
+
+    def add(self, conn, agent_id, command, due, interval=None):
+        c = conn.cursor()
+        c.execute("""INSERT INTO commands 
+                    (agent_id, command, timestamp, is_scheduled, scheduled_time, is_recurring, interval_seconds)
+                    VALUES (?, ?, ?, 1, ?, ?, ?)""",
+                 (agent_id, command, due, due, 1 if interval else 0, interval))
+        state_backend.publish(conn, 'schedule', [c.lastrowid])
+        conn.commit()
+        with self.lock:
+            self._push({
+                'id': c.lastrowid,
+                'agent_id': agent_id,
+                'command': command,
+                'due': due,
+                'recurring': bool(interval),
+                'interval': interval,
+                'version': 0,
+            })
+        return c.lastrowid
+
+    def cancel(self, conn, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        c = conn.execute("DELETE FROM commands WHERE id = ? AND is_scheduled = 1", (job_id,))
+        state_backend.publish(conn, 'schedule', [job_id])
+        conn.commit()
+        return c.rowcount > 0
+
+    def reschedule(self, conn, job_id, due=None, interval=None):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if interval:
+                job['interval'] = interval
+                job['recurring'] = True
+            if due is not None:
+                job['due'] = due
+            elif interval:
+                job['due'] = time.time() + interval
+            self._push(job)
+            job = dict(job)
+        conn.execute("""UPDATE commands SET scheduled_time = ?, is_recurring = ?, interval_seconds = ?
+                        WHERE id = ?""",
+                     (job['due'], 1 if job['recurring'] else 0, job['interval'], job_id))
+        state_backend.publish(conn, 'schedule', [job_id])
+        conn.commit()
+        return job
+
+    def _take_due(self):
+        # Called with self.lock held; sleeps until the earliest deadline
+        while not self.stopped:
+            while self.heap and self._stale(self.heap[0]):
+                heapq.heappop(self.heap)
+            now = time.time()
+            if self.active and self.heap and self.heap[0][0] <= now:
+                break
+            self.wakeup.wait(self.heap[0][0] - now if self.heap and self.active else None)
+        if self.stopped:
+            return []
+
+        due = []
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            entry = heapq.heappop(self.heap)
+            if self._stale(entry):
+                continue
+            job = self.jobs[entry[1]]
+            fired = dict(job)
+            if job['recurring'] and job['interval']:
+                # Next deadline on the original grid, skipping runs missed while down
+                job['due'] += job['interval']
+                if job['due'] <= now:
+                    job['due'] = now + job['interval'] - (now - job['due']) % job['interval']
+                self._push(job)
+                fired['next_due'] = job['due']
+            else:
+                del self.jobs[job['id']]
+            due.append(fired)
+        return due
+
+    def _fire(self, due):
+        fired = []
+        with db_pool.connection() as conn:
+            for job in due:
+                # Compare-and-set on the stored deadline: a job cancelled or moved by another
+                # worker, or already fired by a previous leader, is skipped
+                if 'next_due' in job:
+                    c = conn.execute("""UPDATE commands SET scheduled_time = ?
+                                        WHERE id = ? AND is_scheduled = 1
+                                        AND (scheduled_time = ? OR scheduled_time IS NULL)""",
+                                     (job['next_due'], job['id'], job['due']))
+                else:
+                    c = conn.execute("""DELETE FROM commands WHERE id = ? AND is_scheduled = 1
+                                        AND (scheduled_time = ? OR scheduled_time IS NULL)""",
+                                     (job['id'], job['due']))
+                if c.rowcount:
+                    fired.append(job)
+            state_backend.publish(conn, 'schedule', [job['id'] for job in due])
+            # One commit for the template updates and the queued commands
+            command_queue.add_batch(conn, [(job['agent_id'], job['command'], False, None) for job in fired])
+        skipped = [job['id'] for job in due if job not in fired]
+        if skipped:
+            with db_pool.connection() as conn:
+                self.refresh(conn, skipped)
+        return fired
+
+    def run(self):
+        while True:
+            with self.lock:
+                due = self._take_due()
+            if not due:
+                return
+            try:
+                due = self._fire(due)
+            except Exception as e:
+                log_event(logging.ERROR, 'scheduler_error', error=str(e))
+                with self.lock:
+                    self.stats['errors'] += 1
+                    # Retry one-shot jobs shortly; recurring ones already have a next run
+                    for job in due:
+                        if 'next_due' not in job:
+                            job['due'] = time.time() + 1
+                            job['version'] = 0
+                            self._push(job)
+                continue
+            if not due:
+                continue
+            for job in due:
+                events.publish('schedule', {
+                    'id': job['id'],
+                    'agent_id': job['agent_id'],
+                    'fired_at': job['due'],
+                    'next_due': job.get('next_due'),
+                }, f"schedule:{job['id']}")
+            fired_at = time.time()
+            for job in due:
+                metrics.observe('c2_scheduler_lag_seconds', fired_at - job['due'])
+            with self.lock:
+                lag = max(fired_at - job['due'] for job in due)
+                self.stats['fired'] += len(due)
+                self.stats['batches'] += 1
+                self.stats['lag_last'] = lag
+                self.stats['lag_max'] = max(self.stats['lag_max'], lag)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.wakeup.notify_all()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'jobs': len(self.jobs),
+                'heap_size': len(self.heap),
+                'next_due': min((j['due'] for j in self.jobs.values()), default=None),
+                'fired': self.stats['fired'],
+                'batches': self.stats['batches'],
+                'errors': self.stats['errors'],
+                'lag_last_ms': round(self.stats['lag_last'] * 1000, 3),
+                'lag_max_ms': round(self.stats['lag_max'] * 1000, 3),
+            }
+
+scheduler = CommandScheduler()
+
+# Dashboard event feed. State changes are published to an in-memory hub and
+# streamed to dashboards over SSE (/api/events), so open tabs no longer poll.
+# Each stream has its own bounded buffer; events with the same key (agent,
+# transfer, schedule) replace each other there, so a slow client receives the
+# latest state rather than every step. A stream that still falls behind gets
+# a 'reset' and reloads. Reconnects resume from Last-Event-ID while the event
+# is in the history ring.
+class EventStream:
+    def __init__(self, hub):
+        self.hub = hub
+        self.pending = OrderedDict()  # coalescing key -> event
+        self.ready = threading.Condition(hub.lock)
+        self.waker = None  # called on push, for streams served from an event loop
+        self.closed = False
+
+    def _push(self, event):
+        # Called with the hub lock held
+        key = event['key'] or event['id']
+        if key in self.pending:
+            del self.pending[key]
+            self.hub.stats['coalesced'] += 1
+        elif len(self.pending) >= EVENT_SUBSCRIBER_BUFFER:
+            self.pending.clear()
+            self.hub.stats['resets'] += 1
+            key = 'reset'
+            event = self.hub._event('reset', {'reason': 'overflow'})
+        self.pending[key] = event
+        self.wake()
+
+    def wake(self):
+        self.ready.notify()
+        if self.waker:
+            self.waker()
+
+    def drain(self):
+        with self.hub.lock:
+            events = list(self.pending.values())
+            self.pending.clear()
+            return events
+
+    def next(self, timeout):
+        # Wait for events; an empty list means the stream is idle
+        with self.hub.lock:
+            if not self.pending and not self.closed:
+                self.ready.wait(timeout)
+        return self.drain()
+
+class EventHub:
+    def __init__(self, history=EVENT_HISTORY):
         self.lock = threading.Lock()
-        
-    def get_connection(self):
+        self.epoch = format(int(time.time()), 'x')  # resumed ids from an older process are rejected
+        self.seq = 0
+        self.history = deque(maxlen=history)
+        self.streams = set()
+        self.last_stats = None
+        self.stopped = False
+        self.stats = {
+            'published': 0,
+            'coalesced': 0,
+            'resets': 0,
+            'resumed': 0,
+            'rejected': 0,
+        }
+
+    def _event(self, kind, data, key=None):
+        return {'id': f'{self.epoch}-{self.seq}', 'event': kind, 'key': key, 'data': data}
+
+    def publish(self, kind, data, key=None, relay=True):
         with self.lock:
-            if self.pool:
-                return self.pool.pop()
-            else:
-                conn = sqlite3.connect('c2.db', timeout=10, check_same_thread=False)
-                conn.row_factory = sqlite3.Row
-                return conn
-                
-    def return_connection(self, conn):
+            self.seq += 1
+            event = self._event(kind, data, key)
+            self.history.append((self.seq, event))
+            self.stats['published'] += 1
+            for stream in self.streams:
+                stream._push(event)
+        # Dashboards connected to other workers see it too
+        if relay:
+            state_backend.relay_event(kind, data, key)
+        return event
+
+    def subscribe(self, last_event_id=None):
         with self.lock:
-            if len(self.pool) < self.max_connections:
-                self.pool.append(conn)
-            else:
-                conn.close()
+            if len(self.streams) >= EVENT_MAX_SUBSCRIBERS:
+                self.stats['rejected'] += 1
+                return None
+            stream = EventStream(self)
+            self.streams.add(stream)
+            if last_event_id:
+                epoch, _, seq = last_event_id.partition('-')
+                oldest = self.history[0][0] if self.history else self.seq + 1
+                if epoch == self.epoch and seq.isdigit() and oldest - 1 <= int(seq) <= self.seq:
+                    for n, event in self.history:
+                        if n > int(seq):
+                            stream._push(event)
+                    self.stats['resumed'] += 1
+                else:
+                    stream._push(self._event('reset', {'reason': 'resume_unavailable'}))
+            if self.last_stats is not None:
+                stream._push(self._event('stats', self.last_stats, 'stats'))
+            return stream
 
-db_pool = DBConnectionPool(max_connections=20)
+    def unsubscribe(self, stream):
+        with self.lock:
+            stream.closed = True
+            self.streams.discard(stream)
 
-def init_db():
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS agents
-                     (id TEXT PRIMARY KEY, ip TEXT, info TEXT, last_seen REAL, active INTEGER, 
-                      reconnect_attempts INTEGER DEFAULT 0, last_reconnect REAL)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS commands
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                      agent_id TEXT, command TEXT, timestamp REAL, 
-                      is_file INTEGER DEFAULT 0, file_path TEXT, 
-                      is_scheduled INTEGER DEFAULT 0, scheduled_time REAL,
-                      is_recurring INTEGER DEFAULT 0, interval_seconds INTEGER)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS results
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      agent_id TEXT, output TEXT, timestamp REAL,
-                      is_file INTEGER DEFAULT 0, file_path TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS files
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      agent_id TEXT, filename TEXT, filepath TEXT,
-                      size INTEGER, upload_time REAL, direction TEXT)''')
+    def run(self):
+        # Stats are derived from counters, so they are pushed on change rather than per event
+        while not self.stopped:
+            time.sleep(EVENT_STATS_INTERVAL)
+            if not self.streams:
+                continue
+            try:
+                snapshot = live_stats.snapshot()
+            except Exception as e:
+                log_event(logging.ERROR, 'event_stats_error', error=str(e))
+                continue
+            snapshot.pop('timestamp')
+            if snapshot != self.last_stats:
+                with self.lock:
+                    self.last_stats = snapshot
+                    event = self._event('stats', snapshot, 'stats')
+                    for stream in self.streams:
+                        stream._push(event)
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            for stream in self.streams:
+                stream.closed = True
+                stream.wake()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'last_event_id': f'{self.epoch}-{self.seq}',
+                'history': len(self.history),
+                'subscribers': len(self.streams),
+                'buffered': sum(len(stream.pending) for stream in self.streams),
+                'published': self.stats['published'],
+                'coalesced': self.stats['coalesced'],
+                'resets': self.stats['resets'],
+                'resumed': self.stats['resumed'],
+                'rejected': self.stats['rejected'],
+            }
+
+events = EventHub()
+
+# Shared state backend. The queue, scheduler, heartbeat and event structures
+# above are per-process. The backend decides which process runs the
+# singleton roles (scheduler firing, maintenance) and carries their changes
+# to other workers. LocalBackend is the single-process default. SQLiteBackend
+# lets N worker processes on one box share the database: a lease row elects
+# one leader, and the broker table is an append-only message log every worker
+# tails. Dequeues stay exactly-once because delivery is claimed by stamping
+# commands.delivered only where it is still NULL, or flipping the fan-out's
+# deliveries row from 'pending' (deliver_command); the row stays as history.
+# Firing is claimed by a compare-and-set on the job's stored deadline
+# (CommandScheduler._fire).
+class LocalBackend:
+    name = 'local'
+
+    def start(self):
+        scheduler.set_active(True)
+
+    def is_leader(self):
+        return True
+
+    def publish(self, conn, topic, payload):
+        # Other workers' view of a change; committed with the caller's transaction
+        pass
+
+    def relay_event(self, kind, data, key):
+        pass
+
+    def stop(self):
+        pass
+
+    def metrics(self):
+        return {'backend': self.name, 'leader': True}
+
+class SQLiteBackend:
+    name = 'sqlite'
+
+    def __init__(self, lease_ttl=LEADER_LEASE_TTL, poll_interval_ms=BROKER_POLL_INTERVAL_MS):
+        self.worker_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval_ms / 1000.0
+        self.cursor = 0  # last broker message id read
+        self.leader = False
+        self.outbox = deque()  # dashboard events waiting to be relayed
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.handlers = {
+            'commands': lambda conn, items: command_queue.receive(items),
+            'fanout': command_queue.receive_fanout,
+            'delivered': lambda conn, item: command_queue.discard(*item),
+            'schedule': scheduler.refresh,
+            'events': self._receive_events,
+        }
+        self.stats = {
+            'received': 0,
+            'sent': 0,
+            'elections_won': 0,
+            'leases_lost': 0,
+            'errors': 0,
+        }
+
+    def start(self):
+        with db_pool.connection() as conn:
+            # Read the log position first, then the state: a message written in
+            # between is applied twice, which the handlers tolerate
+            self.cursor = conn.execute("SELECT COALESCE(MAX(id), 0) FROM broker").fetchone()[0]
+            command_queue.load(conn)
+            self.sync(conn)
+            self.elect(conn)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def is_leader(self):
+        return self.leader
+
+    def publish(self, conn, topic, payload):
+        conn.execute("INSERT INTO broker (origin, topic, payload, created) VALUES (?, ?, ?, ?)",
+                     (self.worker_id, topic, json.dumps(payload), time.time()))
+        with self.lock:
+            self.stats['sent'] += 1
+
+    def relay_event(self, kind, data, key):
+        with self.lock:
+            self.outbox.append([kind, data, key])
+
+    def _receive_events(self, conn, batch):
+        for kind, data, key in batch:
+            events.publish(kind, data, key, relay=False)
+
+    def elect(self, conn):
+        # One atomic upsert under the write lock: take the lease if it is free
+        # or expired, renew it if already held
+        now = time.time()
+        conn.execute("""INSERT INTO leases (name, holder, expires) VALUES ('leader', ?, ?)
+                        ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires
+                        WHERE leases.holder = excluded.holder OR leases.expires < ?""",
+                     (self.worker_id, now + self.lease_ttl, now))
         conn.commit()
-    finally:
-        db_pool.return_connection(conn)
+        holder = conn.execute("SELECT holder FROM leases WHERE name = 'leader'").fetchone()[0]
+        leader = holder == self.worker_id
+        if leader != self.leader:
+            with self.lock:
+                self.stats['elections_won' if leader else 'leases_lost'] += 1
+            log_event(logging.INFO, 'leader_changed', worker_id=self.worker_id, leader=leader)
+            self.leader = leader
+            scheduler.set_active(leader, conn)
 
-init_db()
+    def poll(self, conn, limit=1000):
+        rows = conn.execute("SELECT id, origin, topic, payload FROM broker WHERE id > ? ORDER BY id LIMIT ?",
+                            (self.cursor, limit)).fetchall()
+        for row in rows:
+            self.cursor = row['id']
+            if row['origin'] == self.worker_id:
+                continue
+            handler = self.handlers.get(row['topic'])
+            if handler:
+                handler(conn, json.loads(row['payload']))
+        with self.lock:
+            self.stats['received'] += len(rows)
+        return len(rows)
 
-# In-memory caches for performance
-active_agents = set()
-command_queue = {}
-result_cache = deque(maxlen=1000)  # Keep recent 1000 results in memory
+    def flush_events(self, conn):
+        with self.lock:
+            batch, self.outbox = list(self.outbox), deque()
+        if batch:
+            self.publish(conn, 'events', batch)
+            conn.commit()
 
-# Scheduler thread
-def run_scheduled_tasks():
-    while True:
-        schedule.run_pending()
-        time.sleep(SCHEDULER_INTERVAL)
+    def sync(self, conn):
+        added, removed = heartbeats.sync(conn, time.time() - AGENT_TIMEOUT)
+        active_agents.update(added)
+        active_agents.difference_update(removed)
+        with heartbeats.lock:
+            live = dict(heartbeats.last_seen)
+        agent_registry.follow(conn, live)
+        agent_registry.deactivate(removed)
+
+    def resync(self, conn):
+        # Counters only see this worker's inserts; re-read the shared totals
+        row_counters.load(conn)
+        live_stats.reconcile(conn)
+        agent_registry.load(conn)
+        if self.leader:
+            conn.execute("DELETE FROM broker WHERE created < ?", (time.time() - BROKER_RETENTION,))
+            conn.commit()
+
+    def run(self):
+        next_election = next_sync = time.monotonic()
+        next_resync = next_sync + BACKEND_RESYNC_INTERVAL
+        while not self.stopped:
+            try:
+                with db_pool.connection() as conn:
+                    self.flush_events(conn)
+                    while self.poll(conn) and not self.stopped:
+                        pass
+                    now = time.monotonic()
+                    if now >= next_election:
+                        self.elect(conn)
+                        next_election = now + self.lease_ttl / 3
+                    if now >= next_sync:
+                        self.sync(conn)
+                        next_sync = now + BACKEND_SYNC_INTERVAL
+                    if now >= next_resync:
+                        self.resync(conn)
+                        next_resync = now + BACKEND_RESYNC_INTERVAL
+            except Exception as e:
+                with self.lock:
+                    self.stats['errors'] += 1
+                log_event(logging.ERROR, 'state_backend_error', error=str(e))
+            time.sleep(self.poll_interval)
+
+    def stop(self):
+        self.stopped = True
+        with db_pool.connection() as conn:
+            self.flush_events(conn)
+            # Hand the role over now rather than after the lease expires
+            conn.execute("DELETE FROM leases WHERE name = 'leader' AND holder = ?", (self.worker_id,))
+            conn.commit()
+        self.leader = False
+        scheduler.set_active(False)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'backend': self.name,
+                'worker_id': self.worker_id,
+                'leader': self.leader,
+                'cursor': self.cursor,
+                'outbox': len(self.outbox),
+                'received': self.stats['received'],
+                'sent': self.stats['sent'],
+                'elections_won': self.stats['elections_won'],
+                'leases_lost': self.stats['leases_lost'],
+                'errors': self.stats['errors'],
+            }
+
+STATE_BACKENDS = {
+    'local': LocalBackend,
+    'sqlite': SQLiteBackend,
+}
+
+state_backend = STATE_BACKENDS[STATE_BACKEND]()
+
+# Maintenance. Each pass changes only agents that crossed AGENT_TIMEOUT since
+# the previous one and deletes expired rows in CLEANUP_BATCH_SIZE transactions,
+# pausing between them so check-ins and result writes never wait long on the
+# write lock.
+class MaintenanceEngine:
+    def __init__(self, retention=None, batch_size=CLEANUP_BATCH_SIZE, pause=CLEANUP_PAUSE):
+        self.retention = dict(RETENTION if retention is None else retention)
+        self.batch_size = batch_size
+        self.pause = pause
+        self.reconnect_since = None  # cutoff of the previous pass; None until the first pass as leader
+        self.lock = threading.Lock()
+        self.stats = {
+            'passes': 0,
+            'errors': 0,
+            'pass_time_max': 0.0,
+            'batch_time_max': 0.0,
+            'last_pass': {},
+        }
+
+    def _drain(self, step, report, name):
+        # Run step() until it handles less than a full batch; step returns rows handled
+        total = 0
+        batches = 0
+        while True:
+            start = time.monotonic()
+            handled = step(self.batch_size)
+            elapsed = time.monotonic() - start
+            total += handled
+            batches += 1
+            report['batch_time_max'] = max(report['batch_time_max'], elapsed)
+            if handled < self.batch_size:
+                break
+            time.sleep(self.pause)
+        report[name] = total
+        report['batches'] += batches
+        return total
+
+    def transition_agents(self, conn, now, report):
+        cutoff = now - AGENT_TIMEOUT
+
+        def mark_inactive(limit):
+            rows = conn.execute("SELECT id FROM agents WHERE active = 1 AND last_seen < ? LIMIT ?",
+                                (cutoff, limit)).fetchall()
+            ids = [row['id'] for row in rows]
+            conn.executemany("UPDATE agents SET active = 0 WHERE id = ?", [(agent_id,) for agent_id in ids])
+            conn.commit()
+            evicted = heartbeats.evict(ids, cutoff)
+            active_agents.difference_update(evicted)
+            agent_registry.deactivate(evicted)
+            for agent_id in evicted:
+                events.publish('agent', {'id': agent_id, 'active': False}, f'agent:{agent_id}')
+            return len(ids)
+
+        self._drain(mark_inactive, report, 'agents_inactivated')
+
+        # Count one reconnect attempt per agent lost since the previous pass
+        since = self.reconnect_since
+        if since is None:
+            since = self.last_reconnect_cutoff(conn, now)
+        c = conn.execute("""UPDATE agents SET reconnect_attempts = reconnect_attempts + 1, last_reconnect = ?
+                            WHERE active = 0 AND last_seen >= ? AND last_seen < ?""",
+                         (now, since, cutoff))
+        report['agents_reconnecting'] = c.rowcount
+
+        # Reset reconnect attempts if agent came back
+        c = conn.execute("UPDATE agents SET reconnect_attempts = 0 WHERE reconnect_attempts > 0 AND active = 1")
+        report['agents_reconnected'] = c.rowcount
+        conn.commit()
+        agent_registry.count_reconnects(since, cutoff, now)
+        agent_registry.reset_reconnects()
+        self.reconnect_since = cutoff
+
+    @staticmethod
+    def last_reconnect_cutoff(conn, now):
+        # A counting pass stamps last_reconnect = its now, so the latest stamp
+        # on a counted agent gives the cutoff it used. Also picks up where
+        # another leader stopped
+        row = conn.execute("""SELECT MAX(last_reconnect) FROM agents
+                              WHERE active = 0 AND reconnect_attempts > 0""").fetchone()
+        since = row[0] - AGENT_TIMEOUT if row[0] is not None else 0
+        return max(since, now - RECONNECT_TRACK_WINDOW)
+
+    def prune(self, conn, now, report):
+        if 'results' in self.retention:
+            cutoff = now - self.retention['results']
+
+            def prune_results(limit):
+                rows = conn.execute("""SELECT id, agent_id, output, spilled FROM results
+                                       WHERE timestamp < ? LIMIT ?""",
+                                    (cutoff, limit)).fetchall()
+                unindex_results(conn, rows)
+                conn.executemany("DELETE FROM results WHERE id = ?", [(row['id'],) for row in rows])
+                conn.commit()
+                for row in rows:
+                    row_counters.result_added(row['agent_id'], -1)
+                result_cache.expire(cutoff)
+                return len(rows)
+
+            self._drain(prune_results, report, 'results_deleted')
+
+        if 'files' in self.retention:
+            cutoff = now - self.retention['files']
+            self._drain(lambda limit: prune_files(conn, cutoff, limit), report, 'files_deleted')
+
+        if 'fanouts' in self.retention:
+            cutoff = now - self.retention['fanouts']
+
+            def prune_fanouts(limit):
+                rows = conn.execute("""SELECT id FROM commands
+                                       WHERE target IS NOT NULL AND timestamp < ? LIMIT ?""",
+                                    (cutoff, limit)).fetchall()
+                conn.executemany("DELETE FROM deliveries WHERE command_id = ?", [(row['id'],) for row in rows])
+                conn.executemany("DELETE FROM commands WHERE id = ?", [(row['id'],) for row in rows])
+                conn.commit()
+                for row in rows:
+                    command_queue.drop_fanout(row['id'])
+                return len(rows)
+
+            self._drain(prune_fanouts, report, 'fanouts_deleted')
+
+        if 'commands' in self.retention:
+            cutoff = now - self.retention['commands']
+
+            def prune_commands(limit):
+                rows = conn.execute("SELECT id FROM commands WHERE delivered < ? LIMIT ?", (cutoff, limit)).fetchall()
+                conn.executemany("DELETE FROM commands WHERE id = ?", [(row['id'],) for row in rows])
+                conn.commit()
+                return len(rows)
+
+            self._drain(prune_commands, report, 'commands_deleted')
+
+        sweep = {'after': ''}
+
+        def sweep_step(limit):
+            handled, sweep['after'] = sweep_blobs(conn, limit, sweep['after'])
+            return handled
+
+        self._drain(sweep_step, report, 'blobs_checked')
+        self._drain(lambda limit: expire_transfers(conn, now - TRANSFER_EXPIRY, limit),
+                    report, 'transfers_expired')
+
+    def compact(self, conn, report):
+        # Returns free pages a little at a time; a no-op unless auto_vacuum is INCREMENTAL
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # executescript steps the pragma to completion; execute() frees a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(INCREMENTAL_VACUUM_PAGES)});")
+        report['freelist_pages'] = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute("PRAGMA optimize")
+
+    def run_pass(self):
+        start = time.monotonic()
+        now = time.time()
+        report = {'started': now, 'batches': 0, 'batch_time_max': 0.0}
+        # Persist pending check-ins so the last_seen comparisons below are current
+        heartbeats.flush()
+        with db_pool.connection() as conn:
+            self.transition_agents(conn, now, report)
+            self.prune(conn, now, report)
+            self.compact(conn, report)
+            if live_stats.due():
+                live_stats.reconcile(conn)
+                report['stats_reconciled'] = True
+        elapsed = time.monotonic() - start
+        metrics.observe('c2_cleanup_pass_seconds', elapsed)
+        report['duration_ms'] = round(elapsed * 1000, 3)
+        report['batch_time_max_ms'] = round(report.pop('batch_time_max') * 1000, 3)
+        with self.lock:
+            self.stats['passes'] += 1
+            self.stats['pass_time_max'] = max(self.stats['pass_time_max'], elapsed)
+            self.stats['batch_time_max'] = max(self.stats['batch_time_max'], report['batch_time_max_ms'] / 1000)
+            self.stats['last_pass'] = report
+        return report
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'passes': self.stats['passes'],
+                'errors': self.stats['errors'],
+                'batch_size': self.batch_size,
+                'retention': self.retention,
+                'pass_time_max_ms': round(self.stats['pass_time_max'] * 1000, 3),
+                'batch_time_max_ms': round(self.stats['batch_time_max'] * 1000, 3),
+                'last_pass': dict(self.stats['last_pass']),
+            }
 
-scheduler_thread = threading.Thread(target=run_scheduled_tasks, daemon=True)
-scheduler_thread.start()
+maintenance = MaintenanceEngine()
 
 # Cleanup thread
+cleanup_stop = threading.Event()
+
 def cleanup_agents():
-    while True:
-        time.sleep(60)
-        cutoff = time.time() - 300  # 5 minutes
+    while not cleanup_stop.wait(CLEANUP_INTERVAL):
+        if not state_backend.is_leader():
+            # Another worker counts reconnects meanwhile; resume from its stamps
+            maintenance.reconnect_since = None
+            continue
         try:
-            conn = db_pool.get_connection()
-            c = conn.cursor()
-            
-            # Mark inactive agents
-            c.execute("UPDATE agents SET active = 0 WHERE last_seen < ?", (cutoff,))
-            
-            # Handle auto-reconnect for inactive agents
-            c.execute("""UPDATE agents 
-                        SET reconnect_attempts = reconnect_attempts + 1, 
-                            last_reconnect = ?
-                        WHERE active = 0 AND last_seen < ?""", 
-                     (time.time(), cutoff))
-            
-            # Reset reconnect attempts if agent came back
-            c.execute("""UPDATE agents 
-                        SET reconnect_attempts = 0 
-                        WHERE active = 1 AND reconnect_attempts > 0""")
-            
-            conn.commit()
-            
-            # Update active agents cache
-            active = c.execute("SELECT id FROM agents WHERE active = 1").fetchall()
-            active_agents.clear()
-            active_agents.update(a['id'] for a in active)
-            
-            # Clean up old results (older than 7 days)
-            week_ago = time.time() - (7 * 24 * 3600)
-            c.execute("DELETE FROM results WHERE timestamp < ?", (week_ago,))
-            
-            # Clean up old files records
-            c.execute("DELETE FROM files WHERE upload_time < ?", (week_ago,))
-            
-            conn.commit()
+            maintenance.run_pass()
         except Exception as e:
-            print(f"Cleanup error: {e}")
-        finally:
-            db_pool.return_connection(conn)
+            with maintenance.lock:
+                maintenance.stats['errors'] += 1
+            log_event(logging.ERROR, 'cleanup_error', error=str(e))
 
-cleanup_thread = threading.Thread(target=cleanup_agents, daemon=True)
-cleanup_thread.start()
+# File management. Contents live once in BLOB_FOLDER under their SHA-256;
+# every files row referencing a blob holds one count in blobs.refcount, and
+# cleanup deletes a blob from disk once nothing references it.
+blob_lock = threading.Lock()  # orders blob ingest against the cleanup sweep
 
-# File management
-def save_uploaded_file(file, agent_id):
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(UPLOAD_FOLDER, f"{agent_id}_{int(time.time())}_{filename}")
-    file.save(filepath)
-    
-    # Record file upload in database
-    conn = db_pool.get_connection()
-    try:
+def blob_path(digest):
+    return os.path.join(BLOB_FOLDER, digest[:2], digest)
+
+def spool_stream(stream):
+    # Hash while writing, so the content is read exactly once
+    temp_path = os.path.join(BLOB_FOLDER, 'tmp', str(uuid.uuid4()))
+    digest = hashlib.sha256()
+    size = 0
+    with open(temp_path, 'wb') as f:
+        for block in iter(lambda: stream.read(STREAM_BLOCK_SIZE), b''):
+            digest.update(block)
+            f.write(block)
+            size += len(block)
+    return temp_path, digest.hexdigest(), size
+
+def record_file(agent_id, filename, filepath, direction, sha256=None):
+    with db_pool.connection() as conn:
         c = conn.cursor()
+        size = os.path.getsize(filepath)
         c.execute("""INSERT INTO files 
-                    (agent_id, filename, filepath, size, upload_time, direction)
-                    VALUES (?, ?, ?, ?, ?, ?)""",
-                 (agent_id, filename, filepath, os.path.getsize(filepath), 
-                  time.time(), 'upload'))
+                    (agent_id, filename, filepath, size, upload_time, direction, sha256)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                 (agent_id, filename, filepath, size, 
+                  time.time(), direction, sha256))
+        file_id = c.lastrowid
+        if sha256:
+            c.execute("""INSERT INTO blobs (sha256, path, size, refcount, created)
+                         VALUES (?, ?, ?, 1, ?)
+                         ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1""",
+                      (sha256, filepath, size, time.time()))
         conn.commit()
-    finally:
-        db_pool.return_connection(conn)
+        row_counters.file_added(agent_id, direction)
+        live_stats.file_added(file_id, direction, size, time.time())
+        return file_id
+
+def record_blob(agent_id, filename, temp_path, digest, direction):
+    # Move spooled content into the store, or drop it if the blob already exists
+    path = blob_path(digest)
+    with blob_lock:
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        file_id = record_file(agent_id, filename, path, direction, digest)
+    return file_id, path
+
+def save_uploaded_file(file, agent_id, direction='upload'):
+    filename = secure_filename(file.filename)
+    temp_path, digest, _ = spool_stream(file.stream)
+
+    # Record file upload in database
+    _, filepath = record_blob(agent_id, filename, temp_path, digest, direction)
     
     return filepath
 
-def record_downloaded_file(agent_id, filename, filepath):
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
-        c.execute("""INSERT INTO files 
-                    (agent_id, filename, filepath, size, upload_time, direction)
-                    VALUES (?, ?, ?, ?, ?, ?)""",
-                 (agent_id, filename, filepath, os.path.getsize(filepath), 
-                  time.time(), 'download'))
+def prune_files(conn, cutoff, limit):
+    c = conn.cursor()
+    rows = c.execute("SELECT id, agent_id, direction, filepath, sha256 FROM files WHERE upload_time < ? LIMIT ?",
+                     (cutoff, limit)).fetchall()
+
+    # Release blob references held by the expiring rows
+    released = {}
+    for row in rows:
+        if row['sha256']:
+            released[row['sha256']] = released.get(row['sha256'], 0) + 1
+    c.executemany("UPDATE blobs SET refcount = refcount - ? WHERE sha256 = ?",
+                  [(count, digest) for digest, count in released.items()])
+    c.executemany("DELETE FROM files WHERE id = ?", [(row['id'],) for row in rows])
+    conn.commit()
+    for row in rows:
+        row_counters.file_added(row['agent_id'], row['direction'], -1)
+
+    # Rows written before the blob store own their file outright
+    for row in rows:
+        if not row['sha256'] and row['filepath'] and os.path.exists(row['filepath']):
+            os.remove(row['filepath'])
+    return len(rows)
+
+def sweep_blobs(conn, limit, after=''):
+    # Walks unreferenced blobs in sha256 order; returns (rows checked, last sha256)
+    c = conn.cursor()
+    with blob_lock:
+        rows = c.execute("""SELECT sha256, path FROM blobs WHERE refcount <= 0 AND sha256 > ?
+                            ORDER BY sha256 LIMIT ?""", (after, limit)).fetchall()
+        for row in rows:
+            # A queued command may still point at the blob
+            if c.execute("SELECT 1 FROM commands WHERE file_path = ? LIMIT 1", (row['path'],)).fetchone():
+                continue
+            if os.path.exists(row['path']):
+                os.remove(row['path'])
+            c.execute("DELETE FROM blobs WHERE sha256 = ?", (row['sha256'],))
         conn.commit()
-    finally:
-        db_pool.return_connection(conn)
+    return len(rows), rows[-1]['sha256'] if rows else after
 
-# Scheduled tasks
-def schedule_recurring_command(agent_id, command, interval_seconds):
-    def job():
-        conn = db_pool.get_connection()
-        try:
+# Result bodies. Outputs up to RESULT_COMPRESS_THRESHOLD stay inline in
+# results.output. Longer ones keep a RESULT_PREVIEW_CHARS preview there, with
+# spilled = 1, and the zlib-compressed full text in result_bodies, so listing
+# queries never read or inflate full bodies. results_fts indexes the full
+# text of every output. It is contentless, so deleting an entry needs the
+# original text (unindex_results).
+def pack_output(output):
+    # (inline text, compressed body or None)
+    if len(output) <= RESULT_COMPRESS_THRESHOLD:
+        return output, None
+    return output[:RESULT_PREVIEW_CHARS], zlib.compress(output.encode('utf-8'), RESULT_COMPRESS_LEVEL)
+
+def read_output(conn, result_id, inline, spilled):
+    if not spilled:
+        return inline
+    row = conn.execute("SELECT codec, body FROM result_bodies WHERE result_id = ?", (result_id,)).fetchone()
+    if row is None:
+        return inline
+    return zlib.decompress(row['body']).decode('utf-8')
+
+def unindex_results(conn, rows):
+    # rows: (id, output, spilled) of results about to be deleted
+    for row in rows:
+        text = read_output(conn, row['id'], row['output'], row['spilled'])
+        if text:
+            conn.execute("INSERT INTO results_fts (results_fts, rowid, output) VALUES ('delete', ?, ?)",
+                         (row['id'], text))
+    conn.executemany("DELETE FROM result_bodies WHERE result_id = ?", [(row['id'],) for row in rows if row['spilled']])
+
+def insert_result(c, agent_id, output, is_file, file_path, timestamp):
+    inline, body = pack_output(output)
+    c.execute("""INSERT INTO results 
+                (agent_id, output, timestamp, is_file, file_path, output_size, spilled)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+             (agent_id, inline, timestamp, 1 if is_file else 0, file_path, len(output),
+              1 if body is not None else 0))
+    result_id = c.lastrowid
+    if body is not None:
+        c.execute("INSERT INTO result_bodies (result_id, codec, body) VALUES (?, 'zlib', ?)",
+                  (result_id, body))
+    if output:
+        c.execute("INSERT INTO results_fts (rowid, output) VALUES (?, ?)", (result_id, output))
+    return result_id
+
+def result_stored(result_id, agent_id, output, is_file, file_path, timestamp):
+    # In-memory bookkeeping once the row is committed. The cache takes the row
+    # first: result_added bumps 'results' again, so a page cached between the
+    # commit and here is replaced before the 'result' event sends readers back
+    result_cache.add(result_id, agent_id, output, is_file, file_path, timestamp)
+    row_counters.result_added(agent_id)
+    live_stats.result_added(result_id, timestamp)
+    events.publish('result', {
+        'id': result_id,
+        'agent_id': agent_id,
+        'output': output[:EVENT_OUTPUT_PREVIEW],
+        'truncated': len(output) > EVENT_OUTPUT_PREVIEW,
+        'is_file': bool(is_file),
+        'timestamp': timestamp,
+    })
+
+def store_result(agent_id, output, is_file=False, file_path=None, timestamp=None):
+    # Synchronous single write; agent POSTs to /result go through result_writer
+    timestamp = time.time() if timestamp is None else timestamp
+    with db_pool.connection() as conn:
+        result_id = insert_result(conn.cursor(), agent_id, output, is_file, file_path, timestamp)
+        conn.commit()
+    result_stored(result_id, agent_id, output, is_file, file_path, timestamp)
+    return result_id
+
+# Result ingestion. /result enqueues and returns; a writer thread commits
+# queued results in batches of up to RESULT_BATCH_SIZE, waiting at most
+# RESULT_BATCH_LATENCY_MS for a batch to fill, so one fsync covers many
+# agents. Every accepted result gets a sequence number and `committed` is the
+# highest one whose batch has been written. A durable=1 request registers its
+# number and waits for its own outcome, 'stored' or 'dropped' (the row failed
+# even on its own). A full queue is refused (429) rather than grown, and stop()
+# drains what is left.
+#
+# A plain /result is acknowledged from memory: stop() runs at exit and on
+# SIGTERM, but a kill -9, crash or power loss loses whatever was still queued,
+# up to RESULT_BATCH_LATENCY_MS worth of results. Agents that cannot resend
+# should post with ?durable=1.
+class ResultWriter:
+    def __init__(self, max_queue=RESULT_QUEUE_SIZE, batch_size=RESULT_BATCH_SIZE,
+                 latency_ms=RESULT_BATCH_LATENCY_MS):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.latency = latency_ms / 1000.0
+        self.queue = deque()  # (seq, agent_id, output, is_file, file_path, timestamp)
+        self.seq = 0
+        self.committed = 0
+        self.outcomes = {}  # seq of a durable result -> 'stored', 'dropped', or None while queued
+        self.wakers = set()  # called after every batch, for waiters outside this thread model (ASGI)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)  # writer: results queued
+        self.durable = threading.Condition(self.lock)  # requests: batch committed
+        self.stopped = False
+        self.thread = None
+        self.stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'batches': 0,
+            'rows_written': 0,
+            'rows_max_batch': 0,
+            'errors': 0,
+            'dropped': 0,
+            'commit_time_total': 0.0,
+            'commit_time_max': 0.0,
+        }
+
+    def submit(self, agent_id, output, is_file=False, file_path=None, timestamp=None, durable=False):
+        # Sequence number, or None when the queue is full; a durable one is
+        # passed to wait() or outcome() and forget()
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            if len(self.queue) >= self.max_queue or self.stopped:
+                self.stats['rejected'] += 1
+                return None
+            self.seq += 1
+            self.queue.append((self.seq, agent_id, output, is_file, file_path, timestamp))
+            if durable:
+                self.outcomes[self.seq] = None
+            self.stats['accepted'] += 1
+            if len(self.queue) == 1 or len(self.queue) >= self.batch_size:
+                self.ready.notify()
+            return self.seq
+
+    def wait(self, seq, timeout=RESULT_DURABLE_TIMEOUT):
+        # 'stored', 'dropped', or None if the batch was not written within timeout
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.outcomes.get(seq) is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.outcomes.pop(seq, None)
+                    return None
+                self.durable.wait(remaining)
+            return self.outcomes.pop(seq)
+
+    def outcome(self, seq):
+        # Non-blocking wait(): the outcome once decided (and forgotten), else None
+        with self.lock:
+            outcome = self.outcomes.get(seq)
+            if outcome is not None:
+                del self.outcomes[seq]
+            return outcome
+
+    def forget(self, seq):
+        # A waiter that gave up
+        with self.lock:
+            self.outcomes.pop(seq, None)
+
+    def watch(self, wake):
+        with self.lock:
+            self.wakers.add(wake)
+
+    def unwatch(self, wake):
+        with self.lock:
+            self.wakers.discard(wake)
+
+    def _take_batch(self):
+        # Called with self.lock held: first result, then up to `latency` for the rest
+        while not self.queue and not self.stopped:
+            self.ready.wait()
+        deadline = time.monotonic() + self.latency
+        while len(self.queue) < self.batch_size and not self.stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.ready.wait(remaining)
+        return [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+
+    def _write(self, batch):
+        with db_pool.connection() as conn:
             c = conn.cursor()
-            c.execute("""INSERT INTO commands 
-                        (agent_id, command, timestamp, is_scheduled, is_recurring, interval_seconds)
-                        VALUES (?, ?, ?, 1, 1, ?)""",
-                     (agent_id, command, time.time(), interval_seconds))
+            ids = [insert_result(c, *item[1:]) for item in batch]
             conn.commit()
+        return ids
+
+    def write_batch(self, batch):
+        start = time.monotonic()
+        try:
+            written = list(zip(self._write(batch), batch))
+        except Exception as e:
+            # One commit per row, so a bad row cannot hold back the others
+            log_event(logging.ERROR, 'result_batch_error', error=str(e))
+            with self.lock:
+                self.stats['errors'] += 1
+            written = []
+            dropped = []
+            for item in batch:
+                try:
+                    written.append((self._write([item])[0], item))
+                except Exception as e:
+                    log_event(logging.ERROR, 'result_dropped', agent_id=item[1], error=str(e))
+                    dropped.append(item[0])
+            with self.lock:
+                self.stats['dropped'] += len(dropped)
+                for seq in dropped:
+                    if seq in self.outcomes:
+                        self.outcomes[seq] = 'dropped'
+        elapsed = time.monotonic() - start
+
+        for result_id, item in written:
+            result_stored(result_id, *item[1:])
+            log_event(logging.INFO, 'result_stored', agent_id=item[1], preview=item[2][:50])
+        with self.lock:
+            for _, item in written:
+                if item[0] in self.outcomes:
+                    self.outcomes[item[0]] = 'stored'
+            self.committed = max(self.committed, batch[-1][0])
+            self.durable.notify_all()
+            wakers = list(self.wakers)
+            self.stats['batches'] += 1
+            self.stats['rows_written'] += len(written)
+            self.stats['rows_max_batch'] = max(self.stats['rows_max_batch'], len(batch))
+            self.stats['commit_time_total'] += elapsed
+            self.stats['commit_time_max'] = max(self.stats['commit_time_max'], elapsed)
+        for wake in wakers:
+            wake()
+
+    def run(self):
+        while True:
+            with self.lock:
+                batch = self._take_batch()
+                if not batch and self.stopped:
+                    return
+            if batch:
+                self.write_batch(batch)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Refuse new results, then let the writer finish the batch it holds and
+        # drain the queue; whatever is left (writer not running) is written here
+        with self.lock:
+            self.stopped = True
+            self.ready.notify_all()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        while True:
+            with self.lock:
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            if not batch:
+                return
+            self.write_batch(batch)
+
+    def metrics(self):
+        with self.lock:
+            batches = self.stats['batches']
+            return {
+                'queued': len(self.queue),
+                'max_queue': self.max_queue,
+                'batch_size': self.batch_size,
+                'batch_latency_ms': self.latency * 1000,
+                'accepted': self.stats['accepted'],
+                'rejected': self.stats['rejected'],
+                'committed_seq': self.committed,
+                'durable_waiting': len(self.outcomes),
+                'batches': batches,
+                'rows_written': self.stats['rows_written'],
+                'rows_avg_batch': round(self.stats['rows_written'] / batches, 2) if batches else 0,
+                'rows_max_batch': self.stats['rows_max_batch'],
+                'errors': self.stats['errors'],
+                'dropped': self.stats['dropped'],
+                'commit_time_avg_ms': round(self.stats['commit_time_total'] / batches * 1000, 3) if batches else 0,
+                'commit_time_max_ms': round(self.stats['commit_time_max'] * 1000, 3),
+            }
+
+result_writer = ResultWriter()
+
+# Chunked transfers. A session is created up front, chunks are PUT at explicit
+# offsets and streamed straight to a partial file, and an interrupted transfer
+# resumes from the offset recorded in the transfers table. 'upload' sessions
+# stage a file for an agent (operator -> agent), 'download' sessions carry an
+# agent's file back to the server.
+transfer_events = deque(maxlen=1000)  # progress feed for the dashboard file panel
+transfer_event_seq = 0
+transfer_locks = {}
+transfer_locks_lock = threading.Lock()
+# Running whole-file sha256 per open transfer, as (bytes hashed, hash object),
+# so finishing a transfer does not read the file back. Lost on restart, in
+# which case finish_transfer hashes the file once.
+transfer_digests = {}
+
+def emit_transfer_event(kind, transfer, **extra):
+    global transfer_event_seq
+    with transfer_locks_lock:
+        transfer_event_seq += 1
+        event = {
+            'id': transfer_event_seq,
+            'event': kind,
+            'transfer_id': transfer['id'],
+            'agent_id': transfer['agent_id'],
+            'filename': transfer['filename'],
+            'direction': transfer['direction'],
+            'received': transfer['received'],
+            'total_size': transfer['total_size'],
+            'timestamp': time.time(),
+        }
+        event.update(extra)
+        transfer_events.append(event)
+    events.publish('transfer', event, f"transfer:{transfer['id']}")
+    return event
+
+def transfer_lock(transfer_id):
+    with transfer_locks_lock:
+        return transfer_locks.setdefault(transfer_id, threading.Lock())
+
+def get_transfer(transfer_id):
+    with db_pool.connection() as conn:
+        row = conn.execute("SELECT * FROM transfers WHERE id = ?", (transfer_id,)).fetchone()
+    return dict(row) if row else None
+
+def transfer_status(transfer):
+    return {
+        'transfer_id': transfer['id'],
+        'agent_id': transfer['agent_id'],
+        'filename': transfer['filename'],
+        'direction': transfer['direction'],
+        'status': transfer['status'],
+        'offset': transfer['received'],
+        'total_size': transfer['total_size'],
+        'chunk_size': transfer['chunk_size'],
+        'file_id': transfer['file_id'],
+        'progress': round(transfer['received'] / transfer['total_size'] * 100, 2) if transfer['total_size'] else 100.0,
+    }
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def release_transfer(transfer_id):
+    with transfer_locks_lock:
+        transfer_locks.pop(transfer_id, None)
+        transfer_digests.pop(transfer_id, None)
+
+def write_chunk(transfer, stream, length, expected_sha256=None):
+    # Stream the body to the end of the partial file in fixed-size blocks
+    digest = hashlib.sha256()
+    with transfer_locks_lock:
+        running = transfer_digests.get(transfer['id'])
+    if running and running[0] == transfer['received']:
+        whole = running[1].copy()
+    elif transfer['received'] == 0:
+        whole = hashlib.sha256()
+    else:
+        whole = None
+    written = 0
+    labels = (('direction', transfer['direction']),)
+    metrics.inc('c2_transfer_inflight_bytes', value=length)
+    with open(transfer['temp_path'], 'r+b' if os.path.exists(transfer['temp_path']) else 'wb') as f:
+        f.seek(transfer['received'])
+        try:
+            while written < length:
+                block = stream.read(min(STREAM_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                digest.update(block)
+                if whole is not None:
+                    whole.update(block)
+                f.write(block)
+                written += len(block)
+                metrics.inc('c2_transfer_bytes_total', labels, len(block))
+                metrics.inc('c2_transfer_inflight_bytes', value=-len(block))
         finally:
-            db_pool.return_connection(conn)
-    
-    schedule.every(interval_seconds).seconds.do(job)
-    return job
+            metrics.inc('c2_transfer_inflight_bytes', value=written - length)
 
-# API Endpoints
-@app.route('/')
-def dashboard():
-    return render_template('developc2.html')
+        if written != length or (expected_sha256 and digest.hexdigest() != expected_sha256.lower()):
+            # Drop the bad chunk so the client can resend from the same offset
+            f.truncate(transfer['received'])
+            return None
+        f.truncate(transfer['received'] + written)
+    if whole is not None:
+        with transfer_locks_lock:
+            transfer_digests[transfer['id']] = (transfer['received'] + written, whole)
+    return written
 
-@app.route('/register', methods=['POST'])
-def register():
-    data = request.json
+def finish_transfer(transfer):
+    with transfer_locks_lock:
+        running = transfer_digests.pop(transfer['id'], None)
+    if running and running[0] == transfer['total_size']:
+        digest = running[1].hexdigest()
+    else:
+        digest = file_sha256(transfer['temp_path'])
+    if transfer['sha256'] and digest != transfer['sha256'].lower():
+        os.remove(transfer['temp_path'])
+        return None
+
+    file_id, filepath = record_blob(transfer['agent_id'], transfer['filename'],
+                                    transfer['temp_path'], digest, transfer['direction'])
+
+    if transfer['direction'] == 'upload':
+        # Staged file is now complete; hand it to the agent
+        with db_pool.connection() as conn:
+            command_queue.add(conn, transfer['agent_id'], transfer['command'] or '', True, filepath)
+    else:
+        store_result(transfer['agent_id'], transfer['command'] or transfer['filename'], True, filepath)
+    return file_id, filepath
+
+def advance_transfer(transfer):
+    # Record received bytes and finish the transfer once the last byte is in
+    transfer['updated'] = time.time()
+    if transfer['received'] == transfer['total_size']:
+        finished = finish_transfer(transfer)
+        if finished is None:
+            transfer['status'] = 'failed'
+            emit_transfer_event('failed', transfer, error='File checksum mismatch')
+        else:
+            transfer['file_id'], _ = finished
+            transfer['status'] = 'complete'
+            emit_transfer_event('complete', transfer, file_id=transfer['file_id'])
+    else:
+        emit_transfer_event('progress', transfer)
+
+    with db_pool.connection() as conn:
+        conn.execute("""UPDATE transfers SET received = ?, status = ?, file_id = ?, updated = ?
+                        WHERE id = ?""",
+                     (transfer['received'], transfer['status'], transfer['file_id'],
+                      transfer['updated'], transfer['id']))
+        conn.commit()
+
+    if transfer['status'] != 'open':
+        release_transfer(transfer['id'])
+
+def expire_transfers(conn, cutoff, limit):
+    stale = conn.execute("""SELECT id, temp_path FROM transfers
+                            WHERE status = 'open' AND updated < ? LIMIT ?""",
+                         (cutoff, limit)).fetchall()
+    for row in stale:
+        if row['temp_path'] and os.path.exists(row['temp_path']):
+            os.remove(row['temp_path'])
+        conn.execute("UPDATE transfers SET status = 'expired', updated = ? WHERE id = ?",
+                     (time.time(), row['id']))
+        release_transfer(row['id'])
+    conn.commit()
+    return len(stale)
+
+# Request handling shared by the Flask routes and the ASGI entry point (asgiC2.py)
+def agent_known(agent_id):
+    # Registered agents are never deleted; one not in memory yet may have
+    # registered on another worker
+    if agent_registry.has(agent_id):
+        return True
+    with db_pool.connection() as conn:
+        agent_registry.refresh(conn, [agent_id])
+    return agent_registry.has(agent_id)
+
+def register_agent(ip, info):
     agent_id = str(uuid.uuid4())
-    ip = request.remote_addr
-    info = data.get('info', '')
-    
-    conn = db_pool.get_connection()
-    try:
+    now = time.time()
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute("""INSERT INTO agents 
                      (id, ip, info, last_seen, active, reconnect_attempts, last_reconnect)
                      VALUES (?, ?, ?, ?, 1, 0, ?)""",
-                  (agent_id, ip, info, time.time(), time.time()))
+                  (agent_id, ip, info, now, now))
         conn.commit()
-    finally:
-        db_pool.return_connection(conn)
     
+    agent_registry.add(AgentRecord(c.lastrowid, agent_id, ip, info, now, True, 0, now))
+    heartbeats.seen(agent_id, now)
     active_agents.add(agent_id)
-    print(f"[+] Agent registered: {agent_id} from {ip}")
-    return jsonify({'agent_id': agent_id})
+    result_cache.agent_registered(agent_id, ip)
+    # The commit bumped 'agents' before the registry had the row; bump again
+    # so an /api/agents page cached in between is not kept
+    table_versions.bump(('agents',))
+    events.publish('agent', {
+        'id': agent_id,
+        'ip': ip,
+        'info': info,
+        'last_seen': now,
+        'reconnect_attempts': 0,
+        'active': True,
+    }, f'agent:{agent_id}')
+    log_event(logging.INFO, 'agent_registered', agent_id=agent_id, ip=ip)
+    return agent_id
 
-@app.route('/checkin/<agent_id>', methods=['GET'])
-def checkin(agent_id):
-    # Update last seen time
-    conn = db_pool.get_connection()
+def parse_wait(value):
     try:
-        c = conn.cursor()
-        c.execute("UPDATE agents SET last_seen = ?, active = 1 WHERE id = ?", 
-                  (time.time(), agent_id))
-        
-        # Get pending command
-        command = c.execute("""SELECT id, command, is_file, file_path 
-                              FROM commands 
-                              WHERE agent_id = ? 
-                              ORDER BY id ASC LIMIT 1""", 
-                           (agent_id,)).fetchone()
-        
-        if command:
-            c.execute("DELETE FROM commands WHERE id = ?", (command['id'],))
-            conn.commit()
-            
-            if command['is_file']:
-                # For file commands, send the file path
-                response = {
-                    'command': command['command'],
-                    'is_file': True,
-                    'file_path': command['file_path']
-                }
+        return min(max(float(value), 0), LONG_POLL_MAX_WAIT)
+    except ValueError:
+        return 0
+
+def deliver_command(agent_id, command, seen):
+    # Check-in response. Stamping the row delivered (or, for a fan-out, flipping
+    # this agent's delivery row) claims the command: with several workers only
+    # one statement succeeds, and a losing worker moves to the next one
+    while command:
+        with db_pool.connection() as conn:
+            if command.get('fanout'):
+                claimed = conn.execute("""UPDATE deliveries SET status = 'delivered', delivered = ?
+                                          WHERE command_id = ? AND agent_id = ? AND status = 'pending'""",
+                                       (time.time(), command['id'], agent_id)).rowcount
             else:
-                response = {
-                    'command': command['command'],
-                    'is_file': False
-                }
+                claimed = conn.execute("""UPDATE commands SET delivered = ?
+                                          WHERE id = ? AND is_scheduled = 0 AND delivered IS NULL""",
+                                       (time.time(), command['id'])).rowcount
+            if claimed:
+                state_backend.publish(conn, 'delivered', [agent_id, command['id']])
+            conn.commit()
+        if claimed:
+            break
+        command = command_queue.pop(agent_id)
+
+    if command:
+        if command['is_file']:
+            # For file commands, send the file path
+            response = {
+                'command': command['command'],
+                'is_file': True,
+                'file_path': command['file_path']
+            }
         else:
-            response = {'command': ''}
-            
-        conn.commit()
-    finally:
-        db_pool.return_connection(conn)
+            response = {
+                'command': command['command'],
+                'is_file': False
+            }
+    else:
+        response = {'command': ''}
     
     if agent_id not in active_agents:
         active_agents.add(agent_id)
+        events.publish('agent', {'id': agent_id, 'last_seen': seen, 'active': True}, f'agent:{agent_id}')
     
-    return jsonify(response)
+    return response
+
+def submit_result(agent_id, output, is_file, file_path, timestamp, durable=False):
+    # (seq, response); the response is None for a durable result, which waits on seq
+    seq = result_writer.submit(agent_id, output, is_file, file_path, timestamp, durable)
+    if seq is None:
+        return None, ({'error': 'Result queue full, retry later'}, 429,
+                      {'Retry-After': str(RESULT_RETRY_AFTER)})
+    return seq, (None if durable else ({'status': 'received'}, 200, {}))
+
+def stored_response(outcome):
+    # (body, status, headers) for a durable result's outcome; None means it timed out
+    if outcome is None:
+        return {'status': 'queued'}, 202, {}
+    if outcome == 'dropped':
+        return {'error': 'Result could not be stored'}, 500, {}
+    return {'status': 'stored'}, 200, {}
+
+def accept_result(agent_id, output, is_file, file_path, timestamp, durable=False):
+    # (body, status, headers) for /result
+    seq, response = submit_result(agent_id, output, is_file, file_path, timestamp, durable)
+    return response or stored_response(result_writer.wait(seq))
+
+def queue_command(agent_id, cmd, is_file=False, file_path=None):
+    with db_pool.connection() as conn:
+        command_queue.add(conn, agent_id, cmd, is_file, file_path)
+
+def valid_tag(tag):
+    # '*' is reserved for commands.target meaning every active agent
+    return isinstance(tag, str) and 0 < len(tag) <= MAX_TAG_LENGTH and tag != '*' and '/' not in tag
+
+def agent_tags(conn, agent_ids):
+    # agent_id -> sorted tag list, for the agents given
+    tags = {}
+    for i in range(0, len(agent_ids), 500):
+        chunk = agent_ids[i:i + 500]
+        rows = conn.execute(f"""SELECT agent_id, tag FROM agent_tags
+                                WHERE agent_id IN ({','.join('?' * len(chunk))})
+                                ORDER BY agent_id, tag""", chunk)
+        for row in rows:
+            tags.setdefault(row['agent_id'], []).append(row['tag'])
+    return tags
+
+def broadcast_command(cmd, is_file=False, file_path=None, tag=None):
+    # Every active agent, or the active members of one tag; returns (command_id, count)
+    with db_pool.connection() as conn:
+        return command_queue.add_fanout(conn, cmd, is_file, file_path, tag)
+
+# Admission control for the agent endpoints (/register, /checkin, /result) and
+# /api/*. A request takes a token from its source address's bucket and, for
+# /checkin and /result, from its agent id's bucket, then one of
+# ADMISSION_MAX_CONCURRENT slots; agent traffic may not take the last
+# ADMISSION_DASHBOARD_RESERVED of them, so the dashboard still answers during a
+# reconnect storm. Refusals are 429s whose Retry-After is the time until the
+# bucket refills. Buckets are spread over RATE_LIMIT_SHARDS maps with a lock
+# each, so check-ins rarely wait on one another. Limits apply per worker process.
+class AdmissionControl:
+    SWEEP_INTERVAL = 30  # seconds between dropping a shard's refilled buckets
+
+    def __init__(self, agent=(RATE_LIMIT_AGENT_RATE, RATE_LIMIT_AGENT_BURST),
+                 ip=(RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST),
+                 dashboard=(RATE_LIMIT_DASHBOARD_RATE, RATE_LIMIT_DASHBOARD_BURST),
+                 max_concurrent=ADMISSION_MAX_CONCURRENT, reserved=ADMISSION_DASHBOARD_RESERVED,
+                 shards=RATE_LIMIT_SHARDS):
+        self.limits = {'agent': agent, 'ip': ip, 'dashboard': dashboard}  # scope -> (tokens per second, burst)
+        self.max_concurrent = max_concurrent
+        self.reserved = min(reserved, max_concurrent)
+        self.shards = [{} for _ in range(max(shards, 1))]  # (scope, key) -> [tokens, updated]
+        self.shard_locks = [threading.Lock() for _ in self.shards]
+        self.next_sweep = [0.0] * len(self.shards)
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            'admitted': 0,
+            'rejected_agent': 0,
+            'rejected_ip': 0,
+            'rejected_dashboard': 0,
+            'rejected_concurrency': 0,
+            'max_inflight': 0,
+        }
+
+    def take(self, scope, key, now):
+        # 0 when a token was taken, else seconds until one is available
+        rate, burst = self.limits[scope]
+        if rate <= 0:
+            return 0
+        index = hash((scope, key)) % len(self.shards)
+        buckets = self.shards[index]
+        with self.shard_locks[index]:
+            bucket = buckets.get((scope, key))
+            if bucket is None:
+                bucket = buckets[(scope, key)] = [burst, now]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            wait = 0 if bucket[0] >= 1 else (1 - bucket[0]) / rate
+            if not wait:
+                bucket[0] -= 1
+            if now >= self.next_sweep[index]:
+                self._sweep(buckets, now)
+                self.next_sweep[index] = now + self.SWEEP_INTERVAL
+            return wait
+
+    def _sweep(self, buckets, now):
+        # A bucket that has refilled is the same as no bucket; called with its shard lock held
+        for scope_key, (tokens, updated) in list(buckets.items()):
+            rate, burst = self.limits[scope_key[0]]
+            if tokens + (now - updated) * rate >= burst:
+                del buckets[scope_key]
+
+    def enter(self, kind, agent_id, ip):
+        # kind is 'agent' or 'dashboard'. None when admitted (the caller then
+        # holds a slot until leave()), else (reason, Retry-After seconds)
+        now = time.monotonic()
+        checks = [('dashboard', ip)] if kind == 'dashboard' else [('ip', ip), ('agent', agent_id)]
+        for scope, key in checks:
+            if key is None:
+                continue
+            wait = self.take(scope, key, now)
+            if wait:
+                return self._reject(scope, int(wait) + 1)
+        limit = self.max_concurrent - (0 if kind == 'dashboard' else self.reserved)
+        with self.lock:
+            if self.max_concurrent and self.inflight >= limit:
+                self.stats['rejected_concurrency'] += 1
+                return 'concurrency', ADMISSION_RETRY_AFTER
+            self.inflight += 1
+            self.stats['admitted'] += 1
+            self.stats['max_inflight'] = max(self.stats['max_inflight'], self.inflight)
+        return None
+
+    def _reject(self, reason, retry_after):
+        with self.lock:
+            self.stats[f'rejected_{reason}'] += 1
+        return reason, retry_after
+
+    def leave(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def metrics(self):
+        buckets = sum(len(shard) for shard in self.shards)
+        with self.lock:
+            return dict(self.stats,
+                        inflight=self.inflight,
+                        max_concurrent=self.max_concurrent,
+                        dashboard_reserved=self.reserved,
+                        buckets=buckets,
+                        limits={scope: {'rate': rate, 'burst': burst} for scope, (rate, burst) in self.limits.items()})
+
+admission = AdmissionControl()
+metrics.describe('c2_admission_rejected_total', 'counter', 'Requests refused with a 429 by admission control, by class and reason')
+metrics.describe('c2_admission_inflight', 'gauge', 'Agent and /api/* requests being processed', lambda: admission.inflight)
+
+AGENT_ENDPOINTS = {'register', 'checkin', 'result'}
+UNMETERED_ENDPOINTS = {'event_feed'}  # SSE streams are capped by EVENT_MAX_SUBSCRIBERS
+
+def request_class(endpoint, path):
+    # 'agent', 'dashboard', or None for requests admission control leaves alone
+    if endpoint in AGENT_ENDPOINTS:
+        return 'agent'
+    if path.startswith('/api/') and endpoint not in UNMETERED_ENDPOINTS:
+        return 'dashboard'
+    return None
+
+def admit_request(kind, agent_id, ip):
+    # None when admitted, else (body, status, headers) for a 429
+    rejected = admission.enter(kind, agent_id, ip)
+    if rejected is None:
+        return None
+    reason, retry_after = rejected
+    metrics.inc('c2_admission_rejected_total', (('class', kind), ('reason', reason)))
+    log_event(logging.WARNING, 'request_throttled', kind=kind, reason=reason, ip=ip, agent_id=agent_id)
+    return ({'error': 'Too many requests, retry later', 'reason': reason, 'retry_after': retry_after}, 429,
+            {'Retry-After': str(retry_after)})
+
+def record_request(route, method, status, elapsed):
+    metrics.inc('c2_http_requests_total', (('route', route), ('method', method), ('status', status)))
+    metrics.observe('c2_http_request_seconds', elapsed, (('route', route), ('method', method)))
+
+@app.before_request
+def start_request_timer():
+    request.environ['c2.request_start'] = time.perf_counter()
+
+@app.after_request
+def finish_request_timer(response):
+    start = request.environ.get('c2.request_start')
+    if start is not None:
+        # Labelled by the URL rule, not the path, so agent ids do not create new series
+        record_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method,
+                       response.status_code, time.perf_counter() - start)
+    return response
+
+@app.before_request
+def admit():
+    kind = request_class(request.endpoint, request.path)
+    if kind is None:
+        return None
+    rejected = admit_request(kind, (request.view_args or {}).get('agent_id'), request.remote_addr)
+    if rejected:
+        body, status, headers = rejected
+        return jsonify(body), status, headers
+    # The instance that granted the slot, in case configure() replaces it meanwhile
+    request.environ['c2.admission'] = admission
+    return None
+
+def release_slot():
+    # Idempotent; streamed bodies (exports) give the slot back before they are sent
+    granted = request.environ.pop('c2.admission', None)
+    if granted is not None:
+        granted.leave()
+
+@app.after_request
+def release_after_request(response):
+    release_slot()
+    return response
+
+@app.teardown_request
+def release_on_teardown(exc):
+    release_slot()
+
+# API Endpoints
+@app.route('/')
+def dashboard():
+    return render_template('developc2.html')
+
+@app.route('/register', methods=['POST'])
+def register():
+    data = request.json
+    agent_id = register_agent(request.remote_addr, data.get('info', ''))
+    return jsonify({'agent_id': agent_id})
+
+@app.route('/checkin/<agent_id>', methods=['GET'])
+def checkin(agent_id):
+    # Optional long poll: hold the request until a command is queued or ?wait=N expires
+    wait = parse_wait(request.args.get('wait', 0))
+    if not agent_known(agent_id):
+        return jsonify({'error': 'Agent not found'}), 404
+
+    # Update last seen time; written back to SQLite in batches
+    seen = heartbeats.beat(agent_id)
+
+    # Get pending command; empty polls never touch the database. A long poll
+    # waits without its admission slot, LONG_POLL_MAX_WAITERS bounds those
+    if wait:
+        release_slot()
+    command = command_queue.pop(agent_id, wait)
+    if wait:
+        heartbeats.beat(agent_id)
+    return jsonify(deliver_command(agent_id, command, seen))
 
 @app.route('/result/<agent_id>', methods=['POST'])
 def result(agent_id):
@@ -268,37 +3492,21 @@ def result(agent_id):
     
     file_path = None
     if is_file and file:
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(DOWNLOAD_FOLDER, f"{agent_id}_{int(time.time())}_{filename}")
-        file.save(file_path)
-        record_downloaded_file(agent_id, filename, file_path)
-    
-    # Store in database
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
-        c.execute("""INSERT INTO results 
-                    (agent_id, output, timestamp, is_file, file_path)
-                    VALUES (?, ?, ?, ?, ?)""",
-                 (agent_id, output, timestamp, 1 if is_file else 0, file_path))
-        conn.commit()
-    finally:
-        db_pool.return_connection(conn)
-    
-    # Cache recent result
-    result_cache.append({
-        'agent_id': agent_id,
-        'output': output,
-        'timestamp': timestamp,
-        'is_file': is_file,
-        'file_path': file_path
-    })
+        file_path = save_uploaded_file(file, agent_id, 'download')
     
-    print(f"[+] Result from {agent_id}: {output[:50]}...")
-    return jsonify({'status': 'received'})
+    # Queued for the next group commit; ?durable=1 waits until it is written
+    body, status, headers = accept_result(agent_id, output, is_file, file_path, timestamp,
+                                          request.args.get('durable') == '1')
+    return jsonify(body), status, headers
 
 @app.route('/command/<agent_id>', methods=['POST'])
 def send_command(agent_id):
+    # Reject oversized uploads before the body is parsed and buffered; the
+    # limit also stops a body sent without Content-Length at MAX_FILE_SIZE
+    if request.content_length and request.content_length > MAX_FILE_SIZE:
+        return jsonify({'error': 'File too large'}), 413
+    request.max_content_length = MAX_FILE_SIZE
+
     cmd = request.json.get('command', '')
     is_file = request.json.get('is_file', False)
     file = request.files.get('file') if is_file else None
@@ -308,66 +3516,78 @@ def send_command(agent_id):
     
     file_path = None
     if is_file and file:
-        if file.content_length > MAX_FILE_SIZE:
-            return jsonify({'error': 'File too large'}), 413
         file_path = save_uploaded_file(file, agent_id)
     
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
-        c.execute("""INSERT INTO commands 
-                    (agent_id, command, timestamp, is_file, file_path)
-                    VALUES (?, ?, ?, ?, ?)""",
-                 (agent_id, cmd, time.time(), 1 if is_file else 0, file_path))
-        conn.commit()
-    finally:
-        db_pool.return_connection(conn)
+    queue_command(agent_id, cmd, is_file, file_path)
     
     return jsonify({'status': f'Command queued for {agent_id}'})
 
 @app.route('/command_all', methods=['POST'])
 def send_to_all():
+    # Reject oversized uploads before the body is parsed and buffered; the
+    # limit also stops a body sent without Content-Length at MAX_FILE_SIZE
+    if request.content_length and request.content_length > MAX_FILE_SIZE:
+        return jsonify({'error': 'File too large'}), 413
+    request.max_content_length = MAX_FILE_SIZE
+
     cmd = request.json.get('command', '')
     is_file = request.json.get('is_file', False)
+    tag = request.json.get('tag') or None
     file = request.files.get('file') if is_file else None
     
     if not cmd and not is_file:
         return jsonify({'error': 'No command or file provided'}), 400
+    if tag is not None and not valid_tag(tag):
+        return jsonify({'error': 'Invalid tag'}), 400
     
     file_path = None
     if is_file and file:
-        if file.content_length > MAX_FILE_SIZE:
-            return jsonify({'error': 'File too large'}), 413
-        
-        # Save file once and share path with all agents
-        temp_filename = f"broadcast_{int(time.time())}_{secure_filename(file.filename)}"
-        file_path = os.path.join(UPLOAD_FOLDER, temp_filename)
-        file.save(file_path)
-    
-    timestamp = time.time()
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
-        
-        # Get all active agents
-        agents = c.execute("SELECT id FROM agents WHERE active = 1").fetchall()
-        
-        # Queue command for each agent
-        for agent in agents:
-            c.execute("""INSERT INTO commands 
-                        (agent_id, command, timestamp, is_file, file_path)
-                        VALUES (?, ?, ?, ?, ?)""",
-                     (agent['id'], cmd, timestamp, 1 if is_file else 0, file_path))
-        
-        conn.commit()
-    finally:
-        db_pool.return_connection(conn)
+        # Store the content once; the agentless row holds the blob reference
+        file_path = save_uploaded_file(file, None)
     
+    command_id, count = broadcast_command(cmd, is_file, file_path, tag)
     return jsonify({
-        'status': f'Command sent to {len(agents)} agents',
-        'count': len(agents)
+        'status': f'Command sent to {count} agents',
+        'count': count,
+        'command_id': command_id,
+        'tag': tag
     })
 
+@app.route('/tags/<agent_id>', methods=['POST'])
+def add_agent_tags(agent_id):
+    tags = request.json.get('tags', [])
+    if isinstance(tags, str):
+        tags = [tags]
+    if not tags or not all(valid_tag(tag) for tag in tags):
+        return jsonify({'error': 'Invalid tag'}), 400
+
+    with db_pool.connection() as conn:
+        if not conn.execute("SELECT 1 FROM agents WHERE id = ?", (agent_id,)).fetchone():
+            return jsonify({'error': 'Agent not found'}), 404
+        conn.executemany("INSERT OR IGNORE INTO agent_tags (tag, agent_id) VALUES (?, ?)",
+                         [(tag, agent_id) for tag in tags])
+        conn.commit()
+        return jsonify({'agent_id': agent_id, 'tags': agent_tags(conn, [agent_id]).get(agent_id, [])})
+
+@app.route('/tags/<agent_id>/<tag>', methods=['DELETE'])
+def remove_agent_tag(agent_id, tag):
+    with db_pool.connection() as conn:
+        removed = conn.execute("DELETE FROM agent_tags WHERE tag = ? AND agent_id = ?", (tag, agent_id)).rowcount
+        conn.commit()
+
+    if not removed:
+        return jsonify({'error': 'Tag not found'}), 404
+    return jsonify({'status': f'Tag {tag} removed from {agent_id}'})
+
+def parse_schedule_time(value):
+    # The dashboard's datetime-local input sends YYYY-MM-DDTHH:MM
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(value)
+
 @app.route('/schedule/<agent_id>', methods=['POST'])
 def schedule_command(agent_id):
     cmd = request.json.get('command', '')
@@ -381,70 +3601,91 @@ def schedule_command(agent_id):
     if not schedule_time and not is_recurring:
         return jsonify({'error': 'No schedule time provided'}), 400
     
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
+    if is_recurring:
+        try:
+            interval_seconds = int(interval_seconds)
+        except (TypeError, ValueError):
+            interval_seconds = 0
+        if interval_seconds <= 0:
+            return jsonify({'error': 'interval_seconds must be a positive integer'}), 400
         
-        if is_recurring:
-            # Schedule recurring command
-            job = schedule_recurring_command(agent_id, cmd, interval_seconds)
-            scheduled_time = time.time() + interval_seconds
-            
-            c.execute("""INSERT INTO commands 
-                        (agent_id, command, timestamp, is_scheduled, is_recurring, interval_seconds)
-                        VALUES (?, ?, ?, 1, 1, ?)""",
-                     (agent_id, cmd, scheduled_time, interval_seconds))
-            
-            response = {
-                'status': f'Recurring command scheduled every {interval_seconds} seconds for {agent_id}',
-                'interval': interval_seconds
-            }
-        else:
-            # Schedule one-time command
-            try:
-                scheduled_time = datetime.strptime(schedule_time, '%Y-%m-%d %H:%M:%S').timestamp()
-            except ValueError:
-                return jsonify({'error': 'Invalid time format. Use YYYY-MM-DD HH:MM:SS'}), 400
-            
-            if scheduled_time < time.time():
-                return jsonify({'error': 'Schedule time must be in the future'}), 400
-                
-            c.execute("""INSERT INTO commands 
-                        (agent_id, command, timestamp, is_scheduled, scheduled_time)
-                        VALUES (?, ?, ?, 1, ?)""",
-                     (agent_id, cmd, scheduled_time, scheduled_time))
-            
-            # Schedule the job
-            def job():
-                conn = db_pool.get_connection()
-                try:
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO commands 
-                                (agent_id, command, timestamp)
-                                VALUES (?, ?, ?)""",
-                             (agent_id, cmd, time.time()))
-                    conn.commit()
-                finally:
-                    db_pool.return_connection(conn)
-            
-            schedule_time_datetime = datetime.fromtimestamp(scheduled_time)
-            schedule.every().day.at(schedule_time_datetime.strftime('%H:%M')).do(job)
-            
-            response = {
-                'status': f'Command scheduled for {schedule_time} for {agent_id}',
-                'scheduled_time': schedule_time
-            }
+        # Schedule recurring command
+        with db_pool.connection() as conn:
+            task_id = scheduler.add(conn, agent_id, cmd, time.time() + interval_seconds, interval_seconds)
         
-        conn.commit()
-    finally:
-        db_pool.return_connection(conn)
+        response = {
+            'status': f'Recurring command scheduled every {interval_seconds} seconds for {agent_id}',
+            'interval': interval_seconds,
+            'task_id': task_id
+        }
+    else:
+        # Schedule one-time command
+        try:
+            scheduled_time = parse_schedule_time(schedule_time)
+        except ValueError:
+            return jsonify({'error': 'Invalid time format. Use YYYY-MM-DD HH:MM:SS'}), 400
+
+        if scheduled_time < time.time():
+            return jsonify({'error': 'Schedule time must be in the future'}), 400
+
+        with db_pool.connection() as conn:
+            task_id = scheduler.add(conn, agent_id, cmd, scheduled_time)
+
+        response = {
+            'status': f'Command scheduled for {schedule_time} for {agent_id}',
+            'scheduled_time': schedule_time,
+            'task_id': task_id
+        }
     
     return jsonify(response)
 
+@app.route('/schedule/<int:task_id>', methods=['DELETE'])
+def cancel_scheduled_command(task_id):
+    with db_pool.connection() as conn:
+        cancelled = scheduler.cancel(conn, task_id)
+
+    if not cancelled:
+        return jsonify({'error': 'Scheduled task not found'}), 404
+    return jsonify({'status': f'Scheduled task {task_id} cancelled'})
+
+@app.route('/schedule/<int:task_id>', methods=['PUT'])
+def reschedule_command(task_id):
+    schedule_time = request.json.get('time', None)
+    interval_seconds = request.json.get('interval_seconds', None)
+
+    due = None
+    if schedule_time:
+        try:
+            due = parse_schedule_time(schedule_time)
+        except ValueError:
+            return jsonify({'error': 'Invalid time format. Use YYYY-MM-DD HH:MM:SS'}), 400
+        if due < time.time():
+            return jsonify({'error': 'Schedule time must be in the future'}), 400
+    if interval_seconds is not None:
+        try:
+            interval_seconds = int(interval_seconds)
+        except (TypeError, ValueError):
+            interval_seconds = 0
+        if interval_seconds <= 0:
+            return jsonify({'error': 'interval_seconds must be a positive integer'}), 400
+    if due is None and interval_seconds is None:
+        return jsonify({'error': 'No schedule time or interval provided'}), 400
+
+    with db_pool.connection() as conn:
+        job = scheduler.reschedule(conn, task_id, due, interval_seconds)
+
+    if job is None:
+        return jsonify({'error': 'Scheduled task not found'}), 404
+    return jsonify({
+        'status': f'Scheduled task {task_id} rescheduled',
+        'task_id': task_id,
+        'scheduled_time': datetime.fromtimestamp(job['due']).strftime('%Y-%m-%d %H:%M:%S'),
+        'interval': job['interval'] if job['recurring'] else None
+    })
+
 @app.route('/download/<int:file_id>', methods=['GET'])
 def download_file(file_id):
-    conn = db_pool.get_connection()
-    try:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         file_info = c.execute("""SELECT filepath, filename FROM files 
                                WHERE id = ? AND direction = 'download'""",
@@ -453,135 +3694,527 @@ def download_file(file_id):
         if not file_info:
             return jsonify({'error': 'File not found'}), 404
             
-        return send_file(file_info['filepath'], as_attachment=True, download_name=file_info['filename'])
-    finally:
-        db_pool.return_connection(conn)
+        # conditional=True answers Range requests with 206 partial content
+        return send_file(os.path.abspath(file_info['filepath']), as_attachment=True, download_name=file_info['filename'],
+                         conditional=True)
+
+@app.route('/transfer/<agent_id>', methods=['POST'])
+def create_transfer(agent_id):
+    filename = secure_filename(request.json.get('filename', ''))
+    direction = request.json.get('direction', 'download')
+    try:
+        chunk_size = int(request.json.get('chunk_size', TRANSFER_CHUNK_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'chunk_size must be an integer'}), 400
+    try:
+        total_size = int(request.json.get('size', -1))
+    except (TypeError, ValueError):
+        total_size = -1
+
+    if not filename:
+        return jsonify({'error': 'No filename provided'}), 400
+    if direction not in ('upload', 'download'):
+        return jsonify({'error': "Direction must be 'upload' or 'download'"}), 400
+    if total_size < 0:
+        return jsonify({'error': 'No file size provided'}), 400
+    if total_size > MAX_TRANSFER_SIZE:
+        return jsonify({'error': 'File too large'}), 413
+    chunk_size = min(max(chunk_size, STREAM_BLOCK_SIZE), MAX_FILE_SIZE)
+
+    transfer_id = str(uuid.uuid4())
+    now = time.time()
+    transfer = {
+        'id': transfer_id,
+        'agent_id': agent_id,
+        'filename': filename,
+        'direction': direction,
+        'command': request.json.get('command', ''),
+        'total_size': total_size,
+        'received': 0,
+        'chunk_size': chunk_size,
+        'sha256': request.json.get('sha256'),
+        'temp_path': os.path.join(TRANSFER_FOLDER, f"{transfer_id}.part"),
+        'status': 'open',
+        'file_id': None,
+        'created': now,
+        'updated': now,
+    }
+    with db_pool.connection() as conn:
+        conn.execute("""INSERT INTO transfers 
+                        (id, agent_id, filename, direction, command, total_size, received,
+                         chunk_size, sha256, temp_path, status, file_id, created, updated)
+                        VALUES (:id, :agent_id, :filename, :direction, :command, :total_size, :received,
+                                :chunk_size, :sha256, :temp_path, :status, :file_id, :created, :updated)""",
+                     transfer)
+        conn.commit()
+    open(transfer['temp_path'], 'wb').close()
+
+    emit_transfer_event('started', transfer)
+    if total_size == 0:
+        advance_transfer(transfer)
+    return jsonify(transfer_status(transfer)), 201
+
+@app.route('/transfer/<transfer_id>', methods=['GET'])
+def get_transfer_status(transfer_id):
+    transfer = get_transfer(transfer_id)
+    if not transfer:
+        return jsonify({'error': 'Transfer not found'}), 404
+    return jsonify(transfer_status(transfer))
+
+@app.route('/transfer/<transfer_id>/chunk', methods=['PUT'])
+def upload_chunk(transfer_id):
+    # Only open transfers get a lock entry; release_transfer() drops it when they close
+    transfer = get_transfer(transfer_id)
+    if not transfer:
+        return jsonify({'error': 'Transfer not found'}), 404
+    if transfer['status'] != 'open':
+        return jsonify(transfer_status(transfer)), 409
+    if request.content_length is None:
+        return jsonify({'error': 'Chunk needs a Content-Length'}), 411
+
+    with transfer_lock(transfer_id):
+        transfer = get_transfer(transfer_id)
+        if transfer['status'] != 'open':
+            # Closed while this request waited; its entry may have been recreated
+            release_transfer(transfer_id)
+            return jsonify(transfer_status(transfer)), 409
+
+        # Chunks must arrive in order; a client that lost track resumes from 'offset'
+        try:
+            offset = int(request.args.get('offset', transfer['received']))
+        except ValueError:
+            return jsonify(dict(transfer_status(transfer), error='offset must be an integer')), 400
+        if offset != transfer['received']:
+            return jsonify(dict(transfer_status(transfer), error='Offset mismatch')), 409
+
+        length = request.content_length
+        if length > transfer['chunk_size']:
+            return jsonify({'error': 'Chunk larger than chunk_size'}), 413
+        if transfer['received'] + length > transfer['total_size']:
+            return jsonify({'error': 'Chunk exceeds declared file size'}), 416
+
+        written = write_chunk(transfer, request.stream, length, request.headers.get('X-Chunk-SHA256'))
+        if written is None:
+            emit_transfer_event('chunk_rejected', transfer)
+            return jsonify(dict(transfer_status(transfer), error='Chunk checksum mismatch')), 422
+
+        transfer['received'] += written
+        advance_transfer(transfer)
+
+    if transfer['status'] == 'failed':
+        return jsonify(dict(transfer_status(transfer), error='File checksum mismatch')), 422
+    return jsonify(transfer_status(transfer))
+
+@app.route('/transfer/<transfer_id>/data', methods=['GET'])
+def download_transfer(transfer_id):
+    # Lets an agent fetch a staged upload, resuming with a Range header
+    with db_pool.connection() as conn:
+        file_info = conn.execute("""SELECT f.filepath, f.filename FROM transfers t
+                                    JOIN files f ON f.id = t.file_id
+                                    WHERE t.id = ? AND t.status = 'complete'""",
+                                 (transfer_id,)).fetchone()
+
+    if not file_info:
+        return jsonify({'error': 'File not found'}), 404
+
+    return send_file(os.path.abspath(file_info['filepath']), as_attachment=True, download_name=file_info['filename'],
+                     conditional=True)
+
+@app.route('/api/transfers', methods=['GET'])
+def get_transfers():
+    since = int(request.args.get('since', 0))
+
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT * FROM transfers WHERE status = 'open'
+                     ORDER BY updated DESC""")
+        transfers = [transfer_status(dict(row)) for row in c.fetchall()]
+
+    with transfer_locks_lock:
+        events = [e for e in transfer_events if e['id'] > since]
+
+    return jsonify({
+        'transfers': transfers,
+        'events': events,
+        'last_event_id': events[-1]['id'] if events else since
+    })
+
+@app.route('/api/events', methods=['GET'])
+def event_feed():
+    # EventSource sends Last-Event-ID on reconnect; ?last_event_id= works for a first connect
+    stream = events.subscribe(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    if stream is None:
+        return jsonify({'error': 'Too many event streams'}), 503
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while not stream.closed:
+                batch = stream.next(EVENT_KEEPALIVE)
+                if not batch:
+                    yield ": keepalive\n\n"
+                    continue
+                yield ''.join(f"id: {e['id']}\nevent: {e['event']}\ndata: {json.dumps(e['data'])}\n\n"
+                              for e in batch)
+        finally:
+            events.unsubscribe(stream)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/event_feed', methods=['GET'])
+def get_event_feed_metrics():
+    return jsonify(events.metrics())
 
 # API endpoints for dashboard data
+# Pagination. page/per_page keeps working for the dashboard; passing cursor
+# (empty for the first page) switches to keyset pagination on the sort key,
+# so every page costs the same as the first.
+def encode_cursor(*key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(value):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(value.encode()))
+    except (ValueError, TypeError):
+        return None
+    return key if isinstance(key, list) and len(key) == 2 else None
+
+def page_args(default_per_page):
+    page = max(int(request.args.get('page', 1)), 1)
+    per_page = max(int(request.args.get('per_page', default_per_page)), 1)
+    cursor = request.args.get('cursor')
+    return page, per_page, cursor
+
+def page_response(key, items, total, page, per_page, cursor, next_key):
+    response = {
+        key: items,
+        'total': total,
+        'per_page': per_page,
+        'total_pages': (total + per_page - 1) // per_page
+    }
+    if cursor is None:
+        response['page'] = page
+    else:
+        response['next_cursor'] = encode_cursor(*next_key) if next_key and len(items) == per_page else None
+    return response
+
+# Dashboard list responses, cached per path and query string until a table
+# they read from changes. With the sqlite state backend other workers' writes
+# do not reach table_versions, so entries and ETags also age out after
+# RESPONSE_CACHE_SHARED_MAX_AGE seconds.
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_BYTES,
+                 shared_max_age=RESPONSE_CACHE_SHARED_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared_max_age = shared_max_age
+        self.entries = OrderedDict()  # key -> (etag, body), most recently used last
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'not_modified': 0,
+            'evictions': 0,
+        }
+
+    def etag(self, key, versions):
+        # Identifies the response for these table versions without building it
+        state = (table_versions.epoch, key, versions)
+        if state_backend.name != 'local':
+            state += (int(time.time() // self.shared_max_age),)
+        return hashlib.blake2b(repr(state).encode(), digest_size=12).hexdigest()
+
+    def get(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, etag, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous:
+                self.size -= len(previous[1])
+            self.entries[key] = (etag, body)
+            self.size += len(body)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def not_modified(self):
+        with self.lock:
+            self.stats['not_modified'] += 1
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats,
+                        entries=len(self.entries),
+                        bytes=self.size,
+                        max_entries=self.max_entries,
+                        max_bytes=self.max_bytes,
+                        hit_ratio=round(self.stats['hits'] / lookups, 4) if lookups else 0,
+                        versions=dict(table_versions.versions))
+
+response_cache = ResponseCache()
+
+def cached_response(*tables, uncached=None):
+    # For GET views whose body depends only on the query string and these
+    # tables; uncached(args) is true for requests that also depend on the clock
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if uncached is not None and uncached(request.args):
+                return view(*args, **kwargs)
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            etag = response_cache.etag(key, table_versions.get(tables))
+            if request.if_none_match.contains(etag):
+                response_cache.not_modified()
+                response = Response(status=304)
+            else:
+                body = response_cache.get(key, etag)
+                if body is None:
+                    response = app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    response_cache.put(key, etag, response.get_data())
+                else:
+                    response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            # Browsers revalidate with If-None-Match on every dashboard refresh
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def agents_uncached(args):
+    # Only active agents' status does not change with time alone
+    return (args.get('status', 'active') != 'active' or bool(args.get('seen_within'))
+            or bool(args.get('inactive_for')))
+
 @app.route('/api/agents', methods=['GET'])
+@cached_response('agents', 'agent_tags', uncached=agents_uncached)
 def get_agents():
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 20))
-    offset = (page - 1) * per_page
-    
-    conn = db_pool.get_connection()
+    # Answered from agent_registry. Filters: status=active (default) |
+    # reconnecting | lost | inactive | all, ip= (address or CIDR subnet),
+    # info= (substring), info.<field>= (parsed info field), tag=,
+    # seen_within= / inactive_for= (seconds). sort=last_seen | ip |
+    # reconnect_attempts, '-' prefix for descending; default -last_seen.
+    page, per_page, cursor = page_args(20)
+    status = request.args.get('status', 'active')
+    if status not in AGENT_STATUSES + ('inactive', 'all'):
+        return jsonify({'error': 'Invalid status'}), 400
+    sort = request.args.get('sort', '-last_seen')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in AgentRegistry.SORT_KEYS:
+        return jsonify({'error': 'Invalid sort'}), 400
+
+    network = None
+    if request.args.get('ip'):
+        try:
+            network = ipaddress.ip_network(request.args['ip'], strict=False)
+        except ValueError:
+            return jsonify({'error': 'Invalid ip'}), 400
+        network = (ip_order(network.network_address), ip_order(network.broadcast_address))
+    fields = {key[len('info.'):].lower(): value for key, value in request.args.items() if key.startswith('info.')}
+    now = time.time()
     try:
-        c = conn.cursor()
-        
-        # Get paginated agents
-        c.execute("""SELECT id, ip, info, last_seen, reconnect_attempts, last_reconnect 
-                    FROM agents WHERE active = 1 
-                    ORDER BY last_seen DESC LIMIT ? OFFSET ?""", 
-                 (per_page, offset))
-        agents = [{
-            'id': row['id'],
-            'ip': row['ip'],
-            'info': row['info'],
-            'last_seen': row['last_seen'],
-            'last_seen_human': datetime.fromtimestamp(row['last_seen']).strftime('%Y-%m-%d %H:%M:%S'),
-            'reconnect_attempts': row['reconnect_attempts'],
-            'last_reconnect': datetime.fromtimestamp(row['last_reconnect']).strftime('%Y-%m-%d %H:%M:%S') if row['last_reconnect'] else None
-        } for row in c.fetchall()]
-        
-        # Get total count
-        total = c.execute("SELECT COUNT(*) FROM agents WHERE active = 1").fetchone()[0]
-        
-        return jsonify({
-            'agents': agents,
-            'total': total,
-            'page': page,
-            'per_page': per_page,
-            'total_pages': (total + per_page - 1) // per_page
-        })
-    finally:
-        db_pool.return_connection(conn)
+        seen_after = now - float(request.args['seen_within']) if request.args.get('seen_within') else None
+        seen_before = now - float(request.args['inactive_for']) if request.args.get('inactive_for') else None
+    except ValueError:
+        return jsonify({'error': 'seen_within and inactive_for are seconds'}), 400
+    after = None
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+    agent_ids = None
+    tag = request.args.get('tag')
+    if tag:
+        with db_pool.connection() as conn:
+            agent_ids = {row[0] for row in conn.execute("SELECT agent_id FROM agent_tags WHERE tag = ?", (tag,))}
+
+    records, total = agent_registry.query(status, network, request.args.get('info'), fields, seen_after, seen_before,
+                                          agent_ids, sort, descending,
+                                          0 if cursor is not None else (page - 1) * per_page, per_page, after)
+    agents = [{
+        'id': record.id,
+        'ip': record.ip,
+        'info': record.info,
+        'fields': record.fields,
+        'status': record.status(now),
+        'last_seen': record.last_seen,
+        'last_seen_human': datetime.fromtimestamp(record.last_seen).strftime('%Y-%m-%d %H:%M:%S'),
+        'reconnect_attempts': record.reconnect_attempts,
+        'last_reconnect': datetime.fromtimestamp(record.last_reconnect).strftime('%Y-%m-%d %H:%M:%S') if record.last_reconnect else None
+    } for record in records]
+    if agents:
+        with db_pool.connection() as conn:
+            tags = agent_tags(conn, [agent['id'] for agent in agents])
+        for agent in agents:
+            agent['tags'] = tags.get(agent['id'], [])
+
+    next_key = AgentRegistry.SORT_KEYS[sort](records[-1]) if records else None
+    return jsonify(page_response('agents', agents, total, page, per_page, cursor, next_key))
 
 @app.route('/api/results', methods=['GET'])
+@cached_response('results')
 def get_results():
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
-    offset = (page - 1) * per_page
+    page, per_page, cursor = page_args(10)
     agent_id = request.args.get('agent_id', None)
+    search = request.args.get('q', '').strip()
     
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
-        
-        query = """SELECT r.id, r.agent_id, a.ip, r.output, r.timestamp, r.is_file, r.file_path 
-                  FROM results r JOIN agents a ON r.agent_id = a.id"""
-        params = []
-        
-        if agent_id:
-            query += " WHERE r.agent_id = ?"
-            params.append(agent_id)
-        
-        query += " ORDER BY r.timestamp DESC LIMIT ? OFFSET ?"
-        params.extend([per_page, offset])
-        
-        c.execute(query, params)
-        results = [{
-            'id': row['id'],
-            'agent_id': row['agent_id'],
-            'ip': row['ip'],
-            'output': row['output'],
-            'timestamp': row['timestamp'],
-            'timestamp_human': datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
-            'is_file': bool(row['is_file']),
-            'file_path': row['file_path'],
-            'file_id': row['id'] if bool(row['is_file']) else None
-        } for row in c.fetchall()]
-        
-        # Get total count
-        count_query = "SELECT COUNT(*) FROM results"
-        if agent_id:
-            count_query += " WHERE agent_id = ?"
-            c.execute(count_query, (agent_id,))
-        else:
-            c.execute(count_query)
-        
-        total = c.fetchone()[0]
-        
-        return jsonify({
-            'results': results,
-            'total': total,
-            'page': page,
-            'per_page': per_page,
-            'total_pages': (total + per_page - 1) // per_page
-        })
-    finally:
-        db_pool.return_connection(conn)
+    query = """SELECT r.id, r.agent_id, a.ip, r.output, r.output_size, r.spilled,
+                      r.timestamp, r.is_file, r.file_path 
+               FROM results r JOIN agents a ON r.agent_id = a.id"""
+    where_clauses = []
+    params = []
+
+    if search:
+        # FTS5 query syntax: words, "phrases", prefix*, AND/OR/NOT
+        query += " JOIN results_fts ON results_fts.rowid = r.id"
+        where_clauses.append("results_fts MATCH ?")
+        params.append(search)
+    if agent_id:
+        where_clauses.append("r.agent_id = ?")
+        params.append(agent_id)
+    if cursor:
+        key = decode_cursor(cursor)
+        if key is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        where_clauses.append("(r.timestamp, r.id) < (?, ?)")
+        params.extend(key)
+
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+
+    query += " ORDER BY r.timestamp DESC, r.id DESC LIMIT ?"
+    params.append(per_page)
+    if cursor is None:
+        query += " OFFSET ?"
+        params.append((page - 1) * per_page)
+
+    rows = None
+    if not search:
+        total = row_counters.results(agent_id)
+        # Recent pages come from the hot tier; older ones fall through to SQLite
+        rows = result_cache.page(agent_id, total, per_page,
+                                 0 if cursor is not None else (page - 1) * per_page,
+                                 key if cursor else None)
+
+    if rows is None:
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            try:
+                c.execute(query, params)
+            except sqlite3.OperationalError:
+                if not search:
+                    raise
+                return jsonify({'error': 'Invalid search query'}), 400
+            rows = c.fetchall()
+
+            if search:
+                # Matches are not tracked by the row counters
+                count_query = "SELECT COUNT(*) FROM results_fts"
+                count_params = [search]
+                if agent_id:
+                    count_query += " JOIN results r ON r.id = results_fts.rowid WHERE results_fts MATCH ? AND r.agent_id = ?"
+                    count_params.append(agent_id)
+                else:
+                    count_query += " WHERE results_fts MATCH ?"
+                total = c.execute(count_query, count_params).fetchone()[0]
+
+    # Previews only; the full text of a truncated output comes from /api/results/<id>
+    results = [{
+        'id': row['id'],
+        'agent_id': row['agent_id'],
+        'ip': row['ip'],
+        'output': row['output'],
+        'output_size': row['output_size'],
+        'truncated': bool(row['spilled']),
+        'timestamp': row['timestamp'],
+        'timestamp_human': datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
+        'is_file': bool(row['is_file']),
+        'file_path': row['file_path'],
+        'file_id': row['id'] if bool(row['is_file']) else None
+    } for row in rows]
+
+    next_key = (results[-1]['timestamp'], results[-1]['id']) if results else None
+    return jsonify(page_response('results', results, total, page, per_page, cursor, next_key))
+
+@app.route('/api/results/<int:result_id>', methods=['GET'])
+def get_result(result_id):
+    with db_pool.connection() as conn:
+        row = conn.execute("""SELECT r.id, r.agent_id, a.ip, r.output, r.output_size, r.spilled,
+                                     r.timestamp, r.is_file, r.file_path
+                              FROM results r JOIN agents a ON r.agent_id = a.id
+                              WHERE r.id = ?""", (result_id,)).fetchone()
+        if not row:
+            return jsonify({'error': 'Result not found'}), 404
+        output = read_output(conn, row['id'], row['output'], row['spilled'])
+
+    return jsonify({
+        'id': row['id'],
+        'agent_id': row['agent_id'],
+        'ip': row['ip'],
+        'output': output,
+        'output_size': row['output_size'],
+        'truncated': False,
+        'timestamp': row['timestamp'],
+        'timestamp_human': datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
+        'is_file': bool(row['is_file']),
+        'file_path': row['file_path'],
+        'file_id': row['id'] if bool(row['is_file']) else None
+    })
 
 @app.route('/api/files', methods=['GET'])
+@cached_response('files')
 def get_files():
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
-    offset = (page - 1) * per_page
+    page, per_page, cursor = page_args(10)
     agent_id = request.args.get('agent_id', None)
     direction = request.args.get('direction', None)  # 'upload' or 'download'
     
-    conn = db_pool.get_connection()
-    try:
+    query = """SELECT f.id, f.agent_id, a.ip, f.filename, f.filepath, 
+                      f.size, f.upload_time, f.direction
+               FROM files f JOIN agents a ON f.agent_id = a.id"""
+    where_clauses = []
+    params = []
+
+    if agent_id:
+        where_clauses.append("f.agent_id = ?")
+        params.append(agent_id)
+    if direction:
+        where_clauses.append("f.direction = ?")
+        params.append(direction)
+    if cursor:
+        key = decode_cursor(cursor)
+        if key is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        where_clauses.append("(f.upload_time, f.id) < (?, ?)")
+        params.extend(key)
+
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+
+    query += " ORDER BY f.upload_time DESC, f.id DESC LIMIT ?"
+    params.append(per_page)
+    if cursor is None:
+        query += " OFFSET ?"
+        params.append((page - 1) * per_page)
+
+    with db_pool.connection() as conn:
         c = conn.cursor()
-        
-        query = """SELECT f.id, f.agent_id, a.ip, f.filename, f.filepath, 
-                          f.size, f.upload_time, f.direction
-                  FROM files f JOIN agents a ON f.agent_id = a.id"""
-        where_clauses = []
-        params = []
-        
-        if agent_id:
-            where_clauses.append("f.agent_id = ?")
-            params.append(agent_id)
-        if direction:
-            where_clauses.append("f.direction = ?")
-            params.append(direction)
-        
-        if where_clauses:
-            query += " WHERE " + " AND ".join(where_clauses)
-        
-        query += " ORDER BY f.upload_time DESC LIMIT ? OFFSET ?"
-        params.extend([per_page, offset])
-        
         c.execute(query, params)
         files = [{
             'id': row['id'],
@@ -595,29 +4228,15 @@ def get_files():
             'upload_time_human': datetime.fromtimestamp(row['upload_time']).strftime('%Y-%m-%d %H:%M:%S'),
             'direction': row['direction']
         } for row in c.fetchall()]
-        
-        # Get total count
-        count_query = "SELECT COUNT(*) FROM files"
-        if where_clauses:
-            count_query += " WHERE " + " AND ".join(where_clauses)
-        
-        c.execute(count_query, params[:-2])  # Remove LIMIT and OFFSET params
-        total = c.fetchone()[0]
-        
-        return jsonify({
-            'files': files,
-            'total': total,
-            'page': page,
-            'per_page': per_page,
-            'total_pages': (total + per_page - 1) // per_page
-        })
-    finally:
-        db_pool.return_connection(conn)
+
+    total = row_counters.files(agent_id, direction)
+    next_key = (files[-1]['upload_time'], files[-1]['id']) if files else None
+    return jsonify(page_response('files', files, total, page, per_page, cursor, next_key))
 
 @app.route('/api/scheduled', methods=['GET'])
+@cached_response('commands')
 def get_scheduled_tasks():
-    conn = db_pool.get_connection()
-    try:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         
         c.execute("""SELECT c.id, c.agent_id, a.ip, c.command, c.timestamp, 
@@ -640,63 +4259,402 @@ def get_scheduled_tasks():
         } for row in c.fetchall()]
         
         return jsonify({'tasks': tasks})
-    finally:
-        db_pool.return_connection(conn)
+
+@app.route('/api/tags', methods=['GET'])
+@cached_response('agent_tags', 'agents')
+def get_tags():
+    with db_pool.connection() as conn:
+        rows = conn.execute("""SELECT t.tag, COUNT(*) AS agents, SUM(a.active) AS active
+                               FROM agent_tags t JOIN agents a ON a.id = t.agent_id
+                               GROUP BY t.tag""").fetchall()
+
+    return jsonify({'tags': [{'tag': row['tag'], 'agents': row['agents'], 'active': row['active']}
+                             for row in rows]})
+
+@app.route('/api/fanout', methods=['GET'])
+def get_fanouts():
+    limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+    with db_pool.connection() as conn:
+        rows = conn.execute("""SELECT id, command, is_file, target, timestamp FROM commands
+                               WHERE target IS NOT NULL
+                               ORDER BY timestamp DESC LIMIT ?""", (limit,)).fetchall()
+        fanouts = [fanout_summary(conn, row) for row in rows]
+
+    return jsonify({'fanouts': fanouts})
+
+@app.route('/api/fanout/<int:command_id>', methods=['GET'])
+def get_fanout(command_id):
+    # Per-recipient delivery state; ?status=pending|delivered narrows the agent list
+    page, per_page, _ = page_args(100)
+    status = request.args.get('status')
+
+    query = "SELECT agent_id, status, delivered FROM deliveries WHERE command_id = ?"
+    params = [command_id]
+    if status:
+        query += " AND status = ?"
+        params.append(status)
+    query += " ORDER BY agent_id LIMIT ? OFFSET ?"
+    params.extend([per_page, (page - 1) * per_page])
+
+    with db_pool.connection() as conn:
+        row = conn.execute("""SELECT id, command, is_file, target, timestamp FROM commands
+                              WHERE id = ? AND target IS NOT NULL""", (command_id,)).fetchone()
+        if not row:
+            return jsonify({'error': 'Fan-out not found'}), 404
+        response = fanout_summary(conn, row)
+        response['agents'] = [{
+            'agent_id': delivery['agent_id'],
+            'status': delivery['status'],
+            'delivered': delivery['delivered']
+        } for delivery in conn.execute(query, params)]
+
+    total = response['counts'].get(status, 0) if status else response['recipients']
+    response.update(page=page, per_page=per_page, total_pages=(total + per_page - 1) // per_page)
+    return jsonify(response)
+
+def fanout_summary(conn, row):
+    # Both counts come from indexes: the primary key and the partial pending index
+    recipients = conn.execute("SELECT COUNT(*) FROM deliveries WHERE command_id = ?", (row['id'],)).fetchone()[0]
+    pending = conn.execute("SELECT COUNT(*) FROM deliveries WHERE command_id = ? AND status = 'pending'",
+                           (row['id'],)).fetchone()[0]
+    return {
+        'id': row['id'],
+        'command': row['command'],
+        'is_file': bool(row['is_file']),
+        'tag': None if row['target'] == '*' else row['target'],
+        'timestamp': row['timestamp'],
+        'timestamp_human': datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
+        'recipients': recipients,
+        'counts': {'pending': pending, 'delivered': recipients - pending},
+    }
+
+# Bulk export for engagement reports: /api/export/<results|files|commands>
+#   ?format=ndjson|csv  &compress=gzip  &agent_id=  &since=  &until= (epoch seconds)
+#   &direction=upload|download (files only)  &cursor= (resume after a checkpoint)
+# Rows keep their table's columns, results with the full output, in (time, id)
+# order. They are read EXPORT_BATCH_SIZE at a time on a connection held for
+# that batch only, so memory stays flat at any size, no read transaction
+# outlives a batch and check-ins never queue behind an export. NDJSON writes
+# {"checkpoint": cursor} after each batch; CSV rows end with a cursor column,
+# the cursor= that resumes after that row.
+# The commands export is the command history: commands queued for one agent
+# (delivered carries the delivery time, kept for RETENTION['commands']),
+# scheduled templates, and fan-outs (target set; per-agent delivery is in
+# /api/fanout/<id>).
+EXPORTS = {  # kind (table) -> (time column, exported columns)
+    'results': ('timestamp', ('id', 'agent_id', 'output', 'output_size', 'timestamp', 'is_file', 'file_path')),
+    'files': ('upload_time', ('id', 'agent_id', 'filename', 'filepath', 'size', 'upload_time', 'direction', 'sha256')),
+    'commands': ('timestamp', ('id', 'agent_id', 'command', 'timestamp', 'is_file', 'file_path', 'is_scheduled',
+                               'scheduled_time', 'is_recurring', 'interval_seconds', 'target', 'delivered')),
+}
+
+def export_batch(kind, filters, key):
+    time_column, columns = EXPORTS[kind]
+    selected = columns + ('spilled',) if kind == 'results' else columns
+    where_clauses = [f"({time_column}, id) > (?, ?)"]
+    params = list(key)
+    for column in ('agent_id', 'direction'):
+        if filters.get(column):
+            where_clauses.append(f"{column} = ?")
+            params.append(filters[column])
+    if filters.get('since') is not None:
+        where_clauses.append(f"{time_column} >= ?")
+        params.append(filters['since'])
+    if filters.get('until') is not None:
+        where_clauses.append(f"{time_column} < ?")
+        params.append(filters['until'])
+    params.append(EXPORT_BATCH_SIZE)
+
+    with db_pool.connection() as conn:
+        rows = conn.execute(f"""SELECT {', '.join(selected)} FROM {kind}
+                                WHERE {' AND '.join(where_clauses)}
+                                ORDER BY {time_column}, id LIMIT ?""", params).fetchall()
+        records = [{column: row[column] for column in columns} for row in rows]
+        if kind == 'results':
+            for record, row in zip(records, rows):
+                record['output'] = read_output(conn, row['id'], row['output'], row['spilled'])
+    return records
+
+def export_chunks(kind, filters, key, fmt):
+    # Encoded export body, one chunk per batch
+    time_column, columns = EXPORTS[kind]
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns + ('cursor',))
+    while True:
+        records = export_batch(kind, filters, key)
+        if records:
+            key = (records[-1][time_column], records[-1]['id'])
+        if fmt == 'csv':
+            writer.writerows([record[column] for column in columns] + [encode_cursor(record[time_column], record['id'])]
+                             for record in records)
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            chunk = ''.join(json.dumps(record) + '\n' for record in records)
+            if records:
+                chunk += json.dumps({'checkpoint': encode_cursor(*key)}) + '\n'
+        if chunk:
+            yield chunk.encode()
+        if len(records) < EXPORT_BATCH_SIZE:
+            return
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(EXPORT_COMPRESS_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip framing
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_request(kind, args):
+    # (body chunk generator, response headers); ValueError for bad arguments
+    fmt = args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        raise ValueError('format is ndjson or csv')
+    compress = args.get('compress') or None
+    if compress not in (None, 'gzip'):
+        raise ValueError('compress is gzip')
+    filters = {'agent_id': args.get('agent_id'), 'direction': args.get('direction')}
+    if filters['direction'] and (kind != 'files' or filters['direction'] not in ('upload', 'download')):
+        raise ValueError('direction is upload or download, for files only')
+    try:
+        filters['since'] = float(args['since']) if args.get('since') else None
+        filters['until'] = float(args['until']) if args.get('until') else None
+    except ValueError:
+        raise ValueError('since and until are epoch seconds')
+    key = (float('-inf'), 0)
+    if args.get('cursor'):
+        key = decode_cursor(args['cursor'])
+        if key is None:
+            raise ValueError('Invalid cursor')
+
+    chunks = export_chunks(kind, filters, key, fmt)
+    filename = f"{kind}.{fmt}"
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv'
+    if compress:
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return chunks, {'Content-Type': mimetype, 'Content-Disposition': f'attachment; filename="{filename}"',
+                    'X-Accel-Buffering': 'no'}
+
+@app.route('/api/export/<kind>', methods=['GET'])
+def export(kind):
+    if kind not in EXPORTS:
+        return jsonify({'error': 'Unknown export'}), 404
+    try:
+        chunks, headers = export_request(kind, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(chunks, headers=headers)
 
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
-    conn = db_pool.get_connection()
-    try:
-        c = conn.cursor()
-        
-        # Active agents count
-        active_count = c.execute("SELECT COUNT(*) FROM agents WHERE active = 1").fetchone()[0]
-        
-        # Recent results count (last hour)
-        recent_results = c.execute("SELECT COUNT(*) FROM results WHERE timestamp > ?", 
-                                 (time.time() - 3600,)).fetchone()[0]
-        
-        # Commands pending
-        pending_commands = c.execute("SELECT COUNT(*) FROM commands WHERE is_scheduled = 0").fetchone()[0]
-        
-        # Scheduled tasks count
-        scheduled_tasks = c.execute("SELECT COUNT(*) FROM commands WHERE is_scheduled = 1").fetchone()[0]
-        
-        # File transfer stats
-        upload_stats = c.execute("""SELECT COUNT(*) as count, SUM(size) as total_size 
-                                  FROM files 
-                                  WHERE direction = 'upload' AND upload_time > ?""",
-                               (time.time() - 86400,)).fetchone()
-        download_stats = c.execute("""SELECT COUNT(*) as count, SUM(size) as total_size 
-                                    FROM files 
-                                    WHERE direction = 'download' AND upload_time > ?""",
-                                 (time.time() - 86400,)).fetchone()
-        
-        return jsonify({
-            'active_agents': active_count,
-            'recent_results': recent_results,
-            'pending_commands': pending_commands,
-            'scheduled_tasks': scheduled_tasks,
-            'uploads_last_24h': upload_stats['count'],
-            'downloads_last_24h': download_stats['count'],
-            'upload_volume_mb': round(upload_stats['total_size'] / (1024 * 1024), 2) if upload_stats['total_size'] else 0,
-            'download_volume_mb': round(download_stats['total_size'] / (1024 * 1024), 2) if download_stats['total_size'] else 0,
-            'timestamp': time.time()
-        })
-    finally:
-        db_pool.return_connection(conn)
+    # Served from live counters; no queries on the request path
+    return jsonify(live_stats.snapshot())
+
+@app.route('/api/pool', methods=['GET'])
+def get_pool_metrics():
+    return jsonify(db_pool.metrics())
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_metrics():
+    return jsonify(scheduler.metrics())
+
+@app.route('/api/cleanup', methods=['GET'])
+def get_cleanup_metrics():
+    return jsonify(maintenance.metrics())
+
+@app.route('/api/ingest', methods=['GET'])
+def get_ingest_metrics():
+    return jsonify(result_writer.metrics())
+
+@app.route('/api/backend', methods=['GET'])
+def get_backend_metrics():
+    return jsonify(state_backend.metrics())
+
+metrics.describe('c2_pending_commands', 'gauge', 'Commands waiting for their agent to check in',
+                 lambda: command_queue.pending())
+metrics.describe('c2_long_polls', 'gauge', 'Check-ins held open waiting for a command',
+                 lambda: command_queue.total_waiting)
+metrics.describe('c2_live_agents', 'gauge', 'Agents seen within AGENT_TIMEOUT', lambda: len(heartbeats.last_seen))
+metrics.describe('c2_scheduled_jobs', 'gauge', 'Scheduled commands held by the scheduler', lambda: len(scheduler.jobs))
+metrics.describe('c2_result_queue_depth', 'gauge', 'Results accepted but not yet committed',
+                 lambda: len(result_writer.queue))
+metrics.describe('c2_db_pool_connections', 'gauge', 'Pooled SQLite connections by state',
+                 lambda: {(('state', 'in_use'),): db_pool.in_use, (('state', 'idle'),): len(db_pool.pool),
+                          (('state', 'waiting'),): db_pool.waiters})
+metrics.describe('c2_event_subscribers', 'gauge', 'Open /api/events streams', lambda: len(events.streams))
+metrics.describe('c2_leader', 'gauge', '1 while this worker runs the scheduler and maintenance',
+                 lambda: int(state_backend.is_leader()))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/cache', methods=['GET'])
+def get_cache_metrics():
+    return jsonify(response_cache.metrics())
+
+@app.route('/api/result_cache', methods=['GET'])
+def get_result_cache_metrics():
+    return jsonify(result_cache.metrics())
+
+@app.route('/api/registry', methods=['GET'])
+def get_registry_metrics():
+    return jsonify(agent_registry.metrics())
+
+@app.route('/api/admission', methods=['GET'])
+def get_admission_metrics():
+    return jsonify(admission.metrics())
+
+@app.route('/api/heartbeats', methods=['GET'])
+def get_heartbeat_metrics():
+    return jsonify(heartbeats.metrics())
+
+# Startup. Importing this module only defines the app and its components;
+# create_app(config) applies settings before anything touches disk, and the
+# first request (or start_services() called directly) opens the database,
+# loads the in-memory state and starts the background threads, once per process.
+services_lock = threading.Lock()
+services_pid = None  # process that started the services; a forked child starts its own
+
+def configure(config):
+    global db_pool, result_cache, heartbeats, scheduler, events, state_backend, maintenance
+    global result_writer, response_cache, admission
+    unknown = sorted(set(config) - CONFIG_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown config keys: {', '.join(unknown)}")
+    globals().update(config)
+    # Rebuild the components that copy their settings at construction
+    db_pool = DBConnectionPool(DB_PATH, max_connections=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, pragmas=DB_PRAGMAS)
+    result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_PER_AGENT, RESULT_CACHE_AGENTS)
+    heartbeats = HeartbeatBuffer(HEARTBEAT_FLUSH_INTERVAL_MS, HEARTBEAT_BATCH_SIZE)
+    scheduler = CommandScheduler(SCHEDULER_BATCH_SIZE)
+    events = EventHub(EVENT_HISTORY)
+    state_backend = (SQLiteBackend(LEADER_LEASE_TTL, BROKER_POLL_INTERVAL_MS) if STATE_BACKEND == 'sqlite'
+                     else STATE_BACKENDS[STATE_BACKEND]())
+    maintenance = MaintenanceEngine(RETENTION, CLEANUP_BATCH_SIZE, CLEANUP_PAUSE)
+    result_writer = ResultWriter(RESULT_QUEUE_SIZE, RESULT_BATCH_SIZE, RESULT_BATCH_LATENCY_MS)
+    response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_SHARED_MAX_AGE)
+    admission = AdmissionControl((RATE_LIMIT_AGENT_RATE, RATE_LIMIT_AGENT_BURST), (RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST),
+                                 (RATE_LIMIT_DASHBOARD_RATE, RATE_LIMIT_DASHBOARD_BURST),
+                                 ADMISSION_MAX_CONCURRENT, ADMISSION_DASHBOARD_RESERVED, RATE_LIMIT_SHARDS)
+    logger.setLevel(LOG_LEVEL)
+
+def create_app(config=None):
+    # config: {setting name: value} for any name in CONFIG_KEYS, e.g.
+    #   create_app({'DB_PATH': '/var/lib/c2/c2.db', 'DB_POOL_SIZE': 8, 'CLEANUP_INTERVAL': 30})
+    with services_lock:
+        if config:
+            if services_pid == os.getpid():
+                raise RuntimeError('Services already started; configure before the first request')
+            configure(config)
+    return app
+
+# Warm start. The row counters are the only in-memory state whose load scans
+# whole tables (results, files), so a clean shutdown stores them in warm_state
+# and the next start reads and deletes the row instead. Triggers delete it on
+# any write to those tables in between, e.g. by an external tool.
+def save_warm_state(conn):
+    conn.execute("INSERT OR REPLACE INTO warm_state (name, body, written) VALUES ('row_counters', ?, ?)",
+                 (json.dumps(row_counters.snapshot()), time.time()))
+    conn.commit()
+
+def load_warm_state(conn):
+    row = conn.execute("SELECT body FROM warm_state WHERE name = 'row_counters'").fetchone()
+    conn.execute("DELETE FROM warm_state")
+    conn.commit()
+    # Other workers keep writing while one restarts; only a single process owns the file
+    if row is None or state_backend.name != 'local':
+        return False
+    row_counters.restore(json.loads(row['body']))
+    return True
+
+def start_services():
+    global services_pid
+    if services_pid == os.getpid():
+        return
+    with services_lock:
+        if services_pid == os.getpid():
+            return
+        start = time.monotonic()
+        for folder in (UPLOAD_FOLDER, DOWNLOAD_FOLDER, TRANSFER_FOLDER, os.path.join(BLOB_FOLDER, 'tmp')):
+            os.makedirs(folder, exist_ok=True)
+        init_db()
+        with db_pool.connection() as conn:
+            warm = load_warm_state(conn)
+            if not warm:
+                row_counters.load(conn)
+            command_queue.load(conn)
+            live_stats.reconcile(conn)
+            result_cache.load(conn)
+            heartbeats.load(conn)
+            agent_registry.load(conn)
+            scheduler.load(conn)
+        active_agents.clear()
+        active_agents.update(heartbeats.last_seen)
+        cleanup_stop.clear()
+        for target in (heartbeats.run, scheduler.run, events.run, cleanup_agents):
+            threading.Thread(target=target, daemon=True).start()
+        result_writer.start()
+        state_backend.start()
+        services_pid = os.getpid()
+        atexit.register(stop_services)
+        log_event(logging.INFO, 'services_started', warm=warm, duration_ms=round((time.monotonic() - start) * 1000, 3))
+
+@app.before_request
+def ensure_services():
+    start_services()
 
 # Clean up on exit
-def cleanup():
-    print("Cleaning up before exit...")
-    # Cancel all scheduled jobs
-    schedule.clear()
+def stop_services():
+    global services_pid
+    with services_lock:
+        if services_pid != os.getpid():
+            return
+        services_pid = None
+    atexit.unregister(stop_services)
+    log_event(logging.INFO, 'shutdown')
+    cleanup_stop.set()
+    # Write back buffered check-in times
+    try:
+        heartbeats.stop()
+    except Exception as e:
+        log_event(logging.ERROR, 'heartbeat_flush_error', error=str(e))
+    # Commit results accepted but not yet written
+    try:
+        result_writer.stop()
+    except Exception as e:
+        log_event(logging.ERROR, 'result_drain_error', error=str(e))
+    # Stop the scheduler; pending jobs stay in the commands table for the next start
+    scheduler.stop()
+    # End open dashboard streams; EventSource reconnects with Last-Event-ID
+    events.stop()
+    # Give up the leader role so another worker takes it without waiting for the lease
+    try:
+        state_backend.stop()
+    except Exception as e:
+        log_event(logging.ERROR, 'state_backend_stop_error', error=str(e))
+    # Everything is flushed; leave the counters for the next start
+    if state_backend.name == 'local':
+        try:
+            with db_pool.connection() as conn:
+                save_warm_state(conn)
+        except Exception as e:
+            log_event(logging.ERROR, 'warm_state_error', error=str(e))
     # Close all database connections
-    while db_pool.pool:
-        conn = db_pool.pool.pop()
-        conn.close()
-
-atexit.register(cleanup)
+    db_pool.close_all()
+    # Stopped components do not restart; a later start_services() gets new ones
+    with services_lock:
+        configure({})
 
 if __name__ == '__main__':
+    # Scheduled commands fire from launch, not from the first request
+    start_services()
+    # SIGTERM unwinds through atexit, so queued results and check-ins are written out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host='0.0.0.0', port=443, ssl_context=('Requires valid cert for HTTPS.pem', 'Requires valid cert for HTTPSkey.pem'), threaded=True)
\ No newline at end of file